@@ -14,32 +14,137 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
+import collections
+import contextlib
 import time
 import logging
+import multiprocessing
+import queue
+import signal
+import sys
+import threading
 import traceback
+from datetime import datetime
 
-from fink_client.consumer import AlertConsumer
+from dateutil.parser import parse as parse_date
 
 from tom_alertstreams.alertstreams.alertstream import AlertStream
-from tom_targets.models import Target, TargetList
+from tom_common.hooks import run_hook
+from tom_fink.filters import AlertFilter
+from tom_fink.fink import OBJECT_COLUMNS, FinkDataService
+from tom_fink.instrumentation import instrumentation
+from tom_fink.known_objects import DEFAULT_MAX_SIZE as DEFAULT_KNOWN_OBJECTS_SIZE, known_objects
+from tom_fink.metrics import MetricsServer, StreamMetrics, prometheus_stream_metrics
+from tom_fink.replay import Pacer, iter_alert_batches, latency_percentiles
+from tom_fink.spill import DEFAULT_SEGMENT_SIZE, SpillLog
+from tom_targets.models import Target, TargetExtra, TargetList, TargetName
 
-from psycopg2.errors import UniqueViolation
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, connection, connections, transaction
 from django.db.utils import IntegrityError as DJ_IntegrityError
+from django.db.utils import InterfaceError, OperationalError
 from sqlite3 import IntegrityError as SQL_IntegrityError
+
+try:
+    from psycopg2.errors import UniqueViolation
+except ImportError:
+    # psycopg2 is only installed with PostgreSQL, and Django wraps its errors in IntegrityError anyway
+    UniqueViolation = DJ_IntegrityError
 from django.contrib.auth.models import Group
 from guardian.shortcuts import assign_perm
 
 logger = logging.getLogger(__name__)
 
+# tom_fink.consumer (fink_client.consumer, which imports pandas and pyarrow, confluent_kafka
+# and fastavro) is imported when a consumer is started, so that importing this module stays cheap
+
+FINK_PORTAL_URL = "https://fink-portal.org/{}"
+
+# Key of TOPIC_HANDLERS used for the topics without a handler of their own
+DEFAULT_TOPIC_HANDLER = "fink.stream"
+
+# Errors of handlers which mean that the database cannot be reached
+DATABASE_UNAVAILABLE_ERRORS = (OperationalError, InterfaceError)
+
+# Columns of the photometry saved from the alerts, as for the objects queried from the REST API
+ALERT_PHOTOMETRY_COLUMNS = OBJECT_COLUMNS.split(",")
+
 
 class FinkAlertStream(AlertStream):
-    """Poll alerts from a stream generated by Fink"""
+    """Poll alerts from a stream generated by Fink
+
+    One consumer can subscribe to several topics with the TOPICS option
+    (a list), instead of TOPIC. Alerts are passed to the TOPIC_HANDLERS
+    entry of their topic, or to the 'fink.stream' one by default, and the
+    targets returned by the handler are added to the target list named
+    from the topic.
+
+    With the optional BATCH_SIZE option (default 1), up to BATCH_SIZE alerts
+    are consumed at once, waiting at most BATCH_TIMEOUT milliseconds (default 1000),
+    and each batch is passed as a list to the topic handler
+    (e.g. `alert_batch_logger`). Handlers of lists of alerts are marked with
+    `handles_batches = True`; the others (e.g. `alert_logger`) are called
+    once per alert of the batch.
+
+    With the optional WRITER_THREADS option (default 0), alerts are
+    polled by one thread and passed through a queue of at most QUEUE_SIZE
+    items (default 1000) to WRITER_THREADS threads that run the handlers,
+    and offsets are only committed once the alerts are handled
+    (see `run_pipeline`).
+
+    With the optional NUM_WORKERS option (default 1), `listen` forks
+    NUM_WORKERS consumer processes in the same GROUP_ID, so that Kafka
+    spreads the partitions of the topics across them (see `supervise`).
+
+    With the optional SPILL_DIR option, alerts that cannot be handled
+    because the database is unavailable (or, in pipeline mode, because
+    the queue is full) are written to an on-disk log in SPILL_DIR, and
+    replayed in the background once the database is back
+    (see `dispatch_alerts` and `tom_fink.spill`).
+
+    The names of the objects found to be targets (at most KNOWN_OBJECTS_SIZE,
+    default 50,000; 0 to disable) are kept in memory, so that the handlers
+    skip the next alerts of these objects without querying the database
+    (see `tom_fink.known_objects`). With PRELOAD_KNOWN_OBJECTS, the names
+    and aliases of the most recent targets are loaded at startup.
+
+    With the optional FILTERS option, alerts that do not pass cuts on
+    their fields (e.g. {'magpsf': {'max': 19.5}, 'drb': {'min': 0.5}})
+    are dropped before reaching the handlers (see
+    `tom_fink.filters.AlertFilter`).
+
+    With the optional INGEST_PHOTOMETRY option (default False), the
+    detections of the alerts (the candidate and its `prv_candidates`)
+    are also saved as the Fink photometry of their target, once the
+    handler has run (see `ingest_alert_photometry`).
+
+    Alerts are decoded by a `FinkConsumer`, which parses each Avro schema
+    once. With the optional ALERT_FIELDS option (e.g. ['objectId',
+    'candidate', 'prv_candidates']), only these top-level fields are kept
+    in the alerts, and the others (e.g. the cutouts) are released right
+    after decoding.
+
+    The poll, decode and handle stages are timed when the instrumentation
+    of FinkDataService is enabled (see `tom_fink.instrumentation`).
+
+    Archived alerts can also be read from local Avro or Parquet files
+    instead of Kafka, and passed to the same handlers (see `replay`).
+
+    The consumer keeps live metrics: polls, alerts, bytes received,
+    throughput, latency of the handlers and of their database queries,
+    and the lag of each partition, i.e. the number of messages between
+    the committed offset and the end of the partition (see `stats` and
+    `tom_fink.metrics`). With the optional METRICS_PORT option, they are
+    served over HTTP on localhost, at /metrics in the Prometheus text
+    format and at /stats in JSON (worker N of NUM_WORKERS listens on
+    METRICS_PORT + N).
+    """
 
     required_keys = [
         "URL",
         "GROUP_ID",
         "USERNAME",
-        "TOPIC",
         "TOPIC_HANDLERS",
         "MAX_POLL_NUMBER",
         "TIMEOUT",
@@ -50,60 +155,809 @@ class FinkAlertStream(AlertStream):
         "USERNAME",
         "PASSWORD",
         "TOPIC",
+        "TOPICS",
         "TOPIC_HANDLERS",
         "MAX_POLL_NUMBER",
         "TIMEOUT",
+        "BATCH_SIZE",
+        "BATCH_TIMEOUT",
+        "SURVEY",
+        "NUM_WORKERS",
+        "WRITER_THREADS",
+        "QUEUE_SIZE",
+        "SPILL_DIR",
+        "SPILL_SEGMENT_SIZE",
+        "KNOWN_OBJECTS_SIZE",
+        "PRELOAD_KNOWN_OBJECTS",
+        "FILTERS",
+        "INGEST_PHOTOMETRY",
+        "ALERT_FIELDS",
+        "METRICS_PORT",
     ]
 
+    # defaults of the optional keys
+    batch_size = 1
+    batch_timeout = 1000
+    survey = "ztf"
+    num_workers = 1
+    writer_threads = 0
+    queue_size = 1000
+    spill_dir = None
+    spill_segment_size = DEFAULT_SEGMENT_SIZE
+    known_objects_size = DEFAULT_KNOWN_OBJECTS_SIZE
+    preload_known_objects = False
+    filters = None
+    ingest_photometry = False
+    alert_fields = None
+    metrics_port = None
+
+    # seconds between two checks of the worker processes, and between two throughput logs
+    supervisor_interval = 1.0
+    # seconds before restarting a crashed worker, doubled after each crash of that worker up to
+    # max_restart_delay, and reset once the worker has run that long
+    restart_delay = 1.0
+    max_restart_delay = 60.0
+    # the pool is stopped, as failed, after more than max_restarts restarts within restart_window seconds
+    max_restarts = 10
+    restart_window = 600.0
+    stats_interval = 60.0
+    # seconds given to the workers to close their consumer on shutdown
+    shutdown_timeout = 30.0
+    # seconds between two offset commits in pipeline mode
+    commit_interval = 1.0
+    # seconds between two attempts to replay the spill log
+    spill_drain_interval = 10.0
+    # seconds between two measurements of the consumer lag
+    lag_interval = 30.0
+    # index of the worker process in `supervise`, which offsets METRICS_PORT
+    worker_index = 0
+
     def __init__(self, *args, **kwargs) -> None:
-        """Initialise credentials and target list"""
+        """Initialise credentials and target lists"""
         super().__init__(*args, **kwargs)
 
-        # Define target list based on topics
-        public_group, _ = Group.objects.get_or_create(name="Public")
-        tl, is_created = TargetList.objects.get_or_create(name=self.topic)
-        assign_perm("tom_targets.view_targetlist", public_group, tl)
+        self.topics = list(kwargs.get("TOPICS") or [])
+        if kwargs.get("TOPIC"):
+            self.topics.insert(0, kwargs["TOPIC"])
+        if not self.topics:
+            raise ImproperlyConfigured(
+                f"One of TOPIC or TOPICS is required in the configuration OPTIONS of "
+                f"{self._get_stream_classname()}. Check your ALERT_STREAMS setting."
+            )
+        self.topics = list(dict.fromkeys(self.topics))
+
+        # Define target lists based on topics, once for all
+        self.target_lists = {}
+        for topic in self.topics:
+            self.get_target_list(topic)
+
+        # number of alerts passed to the handlers
+        self.alerts_handled = 0
+        self._alerts_handled_lock = threading.Lock()
+        self.metrics = StreamMetrics()
+        self._last_lag_check = time.monotonic()
+
+        self.spill = None
+        # True while new alerts must go behind the spilled ones (see dispatch_alerts)
+        self.spilling = False
+        self._spill_lock = threading.Lock()
+        # serializes the replays of the spill log, so that they are in order
+        self._drain_lock = threading.Lock()
+        # set when a replay emptied the log, cleared when alerts start being spilled
+        self._spill_caught_up = threading.Event()
+        if self.spill_dir:
+            self.spill = SpillLog(self.spill_dir, segment_size=int(self.spill_segment_size))
+            self.spilling = self.spill.has_pending()
+
+        self.alert_filter = AlertFilter(self.filters) if self.filters else None
+
+        # kept across batches, for its photometry watermarks
+        self.data_service = FinkDataService() if self.ingest_photometry else None
+
+        # timing spans of the poll, decode and handle stages, configured as for FinkDataService
+        FinkDataService.get_instrumentation()
+
+        known_objects.max_size = int(self.known_objects_size)
+        if self.preload_known_objects:
+            known_objects.preload()
+        self._last_stats_log = time.monotonic()
+
+    def get_target_list(self, topic):
+        """Return the target list named from `topic`, creating it on first use"""
+        target_list = self.target_lists.get(topic)
+        if target_list is None:
+            public_group, _ = Group.objects.get_or_create(name="Public")
+            target_list, is_created = TargetList.objects.get_or_create(name=topic)
+            assign_perm("tom_targets.view_targetlist", public_group, target_list)
+            self.target_lists[topic] = target_list
+        return target_list
+
+    def handle_alerts(self, alerts, topic):
+        """Pass an alert (or a list of alerts in batch mode) to the handler of `topic`,
+        and add the targets it returns to the target list of the topic.
+
+        Handlers return the created Target (a list of Targets in batch mode),
+        or None if they did not create any. Lists of alerts are passed one alert
+        at a time to the handlers that do not have `handles_batches` set.
+        With INGEST_PHOTOMETRY, the photometry of the alerts is then saved
+        (see `ingest_alert_photometry`).
+        """
+        handler = self.alert_handler.get(topic) or self.alert_handler[DEFAULT_TOPIC_HANDLER]
+        if isinstance(alerts, list) and not getattr(handler, "handles_batches", False):
+            handler = _handle_one_by_one(handler)
+        num_alerts = len(alerts) if isinstance(alerts, list) else 1
+        start = time.perf_counter()
+        self.metrics.start_handler()
+        with connection.execute_wrapper(self.metrics.time_query):
+            with instrumentation.span("stream.handle", profile=True, rows=num_alerts, topic=topic):
+                targets = handler(alerts, topic)
+            if self.data_service is not None:
+                with instrumentation.span("stream.photometry", rows=num_alerts):
+                    ingest_alert_photometry(alerts if isinstance(alerts, list) else [alerts], self.data_service)
+        self.metrics.record_handler(num_alerts, time.perf_counter() - start)
+        with self._alerts_handled_lock:
+            self.alerts_handled += num_alerts
+        if isinstance(targets, Target):
+            targets = [targets]
+        if targets:
+            self.get_target_list(topic).targets.add(*targets)
+
+        now = time.monotonic()
+        if now - self._last_stats_log >= self.stats_interval:
+            self._last_stats_log = now
+            logger.info(f"FinkAlertStream.handle_alerts stats: {self.stats()}")
+
+    def stats(self):
+        """Return the number of alerts handled, the hits (skipped inserts) of the known objects,
+        the number of alerts that passed the FILTERS, and the metrics of the consumer
+        (see `tom_fink.metrics.StreamMetrics.stats`)"""
+        stats = {"alerts_handled": self.alerts_handled, "known_objects": known_objects.stats()}
+        if self.alert_filter is not None:
+            stats["filters"] = self.alert_filter.stats()
+        stats["metrics"] = self.metrics.stats()
+        return stats
+
+    def prometheus(self):
+        """Return the metrics of the consumer, and the timing spans if the instrumentation
+        is enabled, in the Prometheus text exposition format"""
+        text = prometheus_stream_metrics(self.stats())
+        if instrumentation.enabled:
+            text += instrumentation.prometheus()
+        return text
+
+    def update_lag(self, consumer, force=False):
+        """Measure the lag of the partitions assigned to `consumer`, every `lag_interval` seconds
+
+        Errors are logged, since the lag is only informative.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_lag_check < self.lag_interval:
+            return
+        self._last_lag_check = now
+        try:
+            self.metrics.update_lag(consumer.lag())
+        except Exception as ex:
+            logger.warning(f"FinkAlertStream.update_lag could not measure the consumer lag: {ex}")
+
+    @contextlib.contextmanager
+    def metrics_server(self):
+        """Serve the metrics over HTTP on METRICS_PORT (plus the worker index), if set"""
+        if self.metrics_port is None:
+            yield None
+            return
+        server = MetricsServer(self.stats, self.prometheus, int(self.metrics_port) + self.worker_index).start()
+        try:
+            yield server
+        finally:
+            server.close()
+
+    def dispatch_alerts(self, alerts, topic):
+        """Pass alerts to `handle_alerts`, or to the spill log if the database is unavailable
+
+        Alerts that do not pass the FILTERS are dropped first. Without SPILL_DIR,
+        this is then the same as `handle_alerts`. Otherwise, alerts are appended
+        to the spill log if the handler fails because the database cannot be
+        reached, and then behind the spilled ones (so that alerts are handled in order),
+        until the spill drainer has replayed the log. The alerts spilled since are
+        then replayed here, and alerts are handled directly again.
+
+        Returns
+        ----------
+        out: bool
+            True if the alerts were handled (or dropped), False if they were spilled
+        """
+        if self.alert_filter is not None:
+            if isinstance(alerts, list):
+                alerts = self.alert_filter.apply(alerts)
+                if not alerts:
+                    return True
+            elif not self.alert_filter.apply([alerts]):
+                return True
+        if self.spill is None:
+            self.handle_alerts(alerts, topic)
+            return True
+        if self.spilling:
+            with self._spill_lock:
+                if self.spilling and not self.catch_up_spill():
+                    self._spill(alerts, topic)
+                    return False
+        try:
+            self.handle_alerts(alerts, topic)
+        except DATABASE_UNAVAILABLE_ERRORS as ex:
+            logger.warning(f"FinkAlertStream.dispatch_alerts database unavailable ({ex}), spilling alerts")
+            close_old_connections()
+            self.spill_alerts(alerts, topic)
+            return False
+        return True
+
+    def catch_up_spill(self):
+        """Replay the alerts spilled since the spill drainer emptied the log, and stop spilling
+
+        Called with `_spill_lock` held, so that no alert is spilled meanwhile.
+
+        Returns
+        ----------
+        out: bool
+            True if alerts can be handled directly again
+        """
+        if not self._spill_caught_up.is_set():
+            return False
+        try:
+            self.drain_spill()
+        except DATABASE_UNAVAILABLE_ERRORS as ex:
+            logger.warning(f"FinkAlertStream.catch_up_spill database unavailable ({ex}), still spilling alerts")
+            close_old_connections()
+            self._spill_caught_up.clear()
+            return False
+        self.spilling = False
+        return True
+
+    def spill_alerts(self, alerts, topic):
+        """Append an alert (or a list of alerts) to the spill log"""
+        with self._spill_lock:
+            self._spill(alerts, topic)
+
+    def _spill(self, alerts, topic):
+        if not self.spilling:
+            self.spilling = True
+            self._spill_caught_up.clear()
+        self.spill.append(topic, alerts if isinstance(alerts, list) else [alerts])
+
+    def drain_spill(self):
+        """Pass the alerts of the spill log to the topic handlers, in batches if BATCH_SIZE > 1
+
+        Once the log has been replayed, the next call to `dispatch_alerts` replays the alerts
+        spilled meanwhile and stops spilling (see `catch_up_spill`).
+
+        Returns
+        ----------
+        out: int
+            Number of alerts replayed
+        """
+        batch_size = int(self.batch_size)
+
+        def handle(records):
+            alerts_for_topic = {}
+            for topic, alert in records:
+                alerts_for_topic.setdefault(topic, []).append(alert)
+            for topic, alerts in alerts_for_topic.items():
+                if batch_size > 1:
+                    self.handle_alerts(alerts, topic)
+                else:
+                    for alert in alerts:
+                        self.handle_alerts(alert, topic)
+
+        with self._drain_lock:
+            num_alerts = self.spill.drain(handle)
+            self._spill_caught_up.set()
+        return num_alerts
+
+    @contextlib.contextmanager
+    def spill_drainer(self):
+        """Replay the spill log in a background thread, every `spill_drain_interval` seconds"""
+        if self.spill is None:
+            yield
+            return
+
+        header = "FinkAlertStream.spill_drainer"
+        stop = threading.Event()
+
+        def drain_loop():
+            try:
+                while not stop.wait(self.spill_drain_interval):
+                    if not self.spill.has_pending():
+                        continue
+                    try:
+                        num_alerts = self.drain_spill()
+                        logger.info(f"{header} replayed {num_alerts} alerts from {self.spill.directory}")
+                    except DATABASE_UNAVAILABLE_ERRORS as ex:
+                        logger.warning(f"{header} database still unavailable: {ex}")
+                        close_old_connections()
+                    except Exception as ex:
+                        logger.error(f"{header}: {ex}")
+                        logger.error(traceback.format_exc())
+            finally:
+                connections.close_all()
+
+        thread = threading.Thread(target=drain_loop, name="FinkAlertStream-spill-drainer", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+            self.spill.close()
 
     def listen(self):
-        """Listen to one topic from Fink Kafka server
+        """Listen to the topics from Fink Kafka server, with a single consumer
 
         Each alert is saved into the target list named from
-        the topic.
+        its topic (see `handle_alerts`).
 
-        Note
-        ----------
-        This only handles one topic at once for the moment.
+        If BATCH_SIZE is larger than 1, alerts are consumed and handled
+        in batches (see `consume_batch`). If NUM_WORKERS is larger than 1,
+        several consumer processes are run (see `supervise`).
         """
         super().listen()
 
+        num_workers = int(self.num_workers)
+        if num_workers > 1:
+            if self.supervise(num_workers)["failed"]:
+                # let the process manager (systemd, supervisord, ...) see the failure
+                sys.exit(1)
+        else:
+            self.run_consumer()
+
+    def run_consumer(self, stop_event=None, progress=None):
+        """Poll the topics until MAX_POLL_NUMBER is reached, an error occurs, or `stop_event` is set
+
+        Parameters
+        ----------
+        stop_event: multiprocessing.Event, optional
+            Set to stop polling and close the consumer
+        progress: callable, optional
+            Called without arguments after each poll
+
+        Returns
+        ----------
+        out: bool
+            True if polling stopped because of an error
+        """
+        with self.metrics_server(), self.spill_drainer():
+            if int(self.writer_threads) > 0:
+                return self.run_pipeline(stop_event=stop_event, progress=progress)
+            return self.run_poll_loop(stop_event=stop_event, progress=progress)
+
+    def run_poll_loop(self, stop_event=None, progress=None):
+        """Poll and handle alerts one after the other. See `run_consumer`."""
+        from tom_fink.consumer import FinkConsumer
+
         myconfig = {
             "username": self.username,
             "bootstrap.servers": self.url,
             "group.id": self.group_id,
         }
 
-        consumer = AlertConsumer([self.topic], myconfig, schema_path=None)
+        consumer = FinkConsumer(
+            self.topics, myconfig, self.survey, fields=self.alert_fields, metrics=self.metrics, schema_path=None
+        )
 
+        batch_size = int(self.batch_size)
         poll_number = 0
         header = "FinkAlertStream.listen"
+        failed = False
         while poll_number < int(self.max_poll_number):
+            if stop_event is not None and stop_event.is_set():
+                logger.info(f"{header} stopping")
+                break
             try:
                 logger.info(
                     f"{header} opening stream: {self.url} with group.id: {self.group_id} (call number: {poll_number})"
                 )
-                topic, alert, key = consumer.poll(timeout=int(self.timeout))
+                if batch_size > 1:
+                    poll_number += self.consume_batch(consumer, batch_size)
+                    self.update_lag(consumer)
+                    if progress is not None:
+                        progress()
+                    continue
+
+                with instrumentation.span("stream.poll") as span:
+                    topic, alert, key = consumer.poll(timeout=int(self.timeout))
+                    span.set(rows=int(topic is not None))
+                self.metrics.record_poll(int(topic is not None))
 
                 if topic is not None:
                     # TODO: handle MMA vs regular streams
-                    self.alert_handler["fink.stream"](alert, topic)
+                    self.dispatch_alerts(alert, topic)
                 else:
                     logger.info("No alerts received")
                 poll_number += 1
+                self.update_lag(consumer)
+                if progress is not None:
+                    progress()
             except Exception as ex:
                 logger.error(f"{header}: {ex}")
                 logger.error(traceback.format_exc())
+                failed = True
                 break
         consumer.close()
+        return failed
+
+    def run_pipeline(self, stop_event=None, progress=None):
+        """Same as `run_consumer`, but polling and handling alerts run concurrently
+
+        This thread polls and decodes alerts (in batches if BATCH_SIZE is
+        larger than 1), and puts them in a queue of at most QUEUE_SIZE
+        items. WRITER_THREADS threads pass them to the handlers. When the
+        queue is full, polling waits for the writers (backpressure), or
+        the alerts are spilled to disk if SPILL_DIR is set.
+
+        Auto-commit is disabled: the offset of a message is committed
+        (every `commit_interval` seconds) only once it, and all the
+        previous messages of its partition, have been handled. If a
+        handler fails, polling stops and the offsets of the failed alert
+        and of the following ones are not committed, so these alerts are
+        consumed again at the next start.
+        """
+        from tom_fink.consumer import FinkConsumer, OffsetTracker
+
+        myconfig = {
+            "username": self.username,
+            "bootstrap.servers": self.url,
+            "group.id": self.group_id,
+        }
+        consumer = FinkConsumer(
+            self.topics,
+            myconfig,
+            self.survey,
+            kafka_config={"enable.auto.commit": False},
+            fields=self.alert_fields,
+            metrics=self.metrics,
+            schema_path=None,
+        )
+
+        header = "FinkAlertStream.run_pipeline"
+        batch_size = int(self.batch_size)
+        work_queue = queue.Queue(maxsize=int(self.queue_size))
+        tracker = OffsetTracker()
+        failed = threading.Event()
+
+        def writer():
+            try:
+                while True:
+                    item = work_queue.get()
+                    if item is None:
+                        break
+                    topic, alerts, positions = item
+                    if failed.is_set():
+                        continue  # drain the queue without handling, nor committing
+                    try:
+                        self.dispatch_alerts(alerts, topic)
+                    except Exception as ex:
+                        logger.error(f"{header}: {ex}")
+                        logger.error(traceback.format_exc())
+                        failed.set()
+                        continue
+                    for partition, offset in positions:
+                        tracker.done(topic, partition, offset)
+            finally:
+                # each thread has its own database connection
+                connections.close_all()
+
+        def put(item):
+            if self.spill is not None:
+                try:
+                    work_queue.put_nowait(item)
+                except queue.Full:
+                    # the writers cannot keep up: spill instead of waiting
+                    topic, alerts, positions = item
+                    self.spill_alerts(alerts, topic)
+                    for partition, offset in positions:
+                        tracker.done(topic, partition, offset)
+                return True
+            # wait for room in the queue, unless the writers failed or we are asked to stop
+            while not failed.is_set() and not (stop_event is not None and stop_event.is_set()):
+                try:
+                    work_queue.put(item, timeout=self.supervisor_interval)
+                    return True
+                except queue.Full:
+                    logger.debug(f"{header} queue full, waiting for the writers")
+            return False
+
+        def commit():
+            offsets = tracker.pop_committable()
+            if offsets:
+                consumer.commit_offsets(offsets)
+
+        writers = [
+            threading.Thread(target=writer, name=f"FinkAlertStream-writer-{index}", daemon=True)
+            for index in range(int(self.writer_threads))
+        ]
+        for thread in writers:
+            thread.start()
+
+        poll_number = 0
+        last_commit = time.monotonic()
+        try:
+            while poll_number < int(self.max_poll_number) and not failed.is_set():
+                if stop_event is not None and stop_event.is_set():
+                    logger.info(f"{header} stopping")
+                    break
+                logger.info(
+                    f"{header} opening stream: {self.url} with group.id: {self.group_id} (call number: {poll_number})"
+                )
+                with instrumentation.span("stream.poll") as span:
+                    if batch_size > 1:
+                        messages = consumer.consume_messages(batch_size, timeout=float(self.batch_timeout) / 1000)
+                    else:
+                        message = consumer.poll_message(timeout=int(self.timeout))
+                        messages = [message] if message is not None else []
+                    span.set(rows=len(messages))
+                self.metrics.record_poll(len(messages))
+                if not messages:
+                    logger.info("No alerts received")
+
+                items = {}
+                for message in messages:
+                    topic, alert, key = consumer.process_message(message)
+                    tracker.add(topic, message.partition(), message.offset())
+                    if batch_size > 1:
+                        alerts, positions = items.setdefault(topic, ([], []))
+                        alerts.append(alert)
+                        positions.append((message.partition(), message.offset()))
+                    elif not put((topic, alert, [(message.partition(), message.offset())])):
+                        break
+                for topic, (alerts, positions) in items.items():
+                    if not put((topic, alerts, positions)):
+                        break
+                poll_number += max(len(messages), 1)
+
+                if time.monotonic() - last_commit >= self.commit_interval:
+                    commit()
+                    last_commit = time.monotonic()
+                self.update_lag(consumer)
+                if progress is not None:
+                    progress()
+        except Exception as ex:
+            logger.error(f"{header}: {ex}")
+            logger.error(traceback.format_exc())
+            failed.set()
+        finally:
+            for _ in writers:
+                work_queue.put(None)
+            for thread in writers:
+                thread.join()
+            try:
+                commit()
+            finally:
+                consumer.close()
+            logger.info(f"{header} stopped, {tracker.num_pending()} alerts left uncommitted")
+        return failed.is_set()
+
+    def supervise(self, num_workers):
+        """Run `num_workers` consumer processes in the same consumer group, and supervise them
+
+        Workers that crash are restarted after `restart_delay` seconds,
+        doubled after each new crash of the same worker up to
+        `max_restart_delay`. If there are more than `max_restarts` restarts
+        within `restart_window` seconds, the failure is persistent (e.g.
+        bad credentials, or an unreachable broker), and the pool is stopped
+        as failed. The combined throughput of the pool is logged every
+        `stats_interval` seconds. On SIGINT or SIGTERM, the workers are
+        asked to close their consumer (which leaves the group cleanly) and
+        are terminated if they do not exit within `shutdown_timeout`
+        seconds. Returns when all workers have stopped, e.g. when each of
+        them reached MAX_POLL_NUMBER.
+
+        Note
+        ----------
+        Workers are forked, which requires a POSIX system.
+
+        Returns
+        ----------
+        out: dict
+            Number of alerts handled by the pool, of worker restarts,
+            and whether the pool was stopped after too many restarts
+        """
+        context = multiprocessing.get_context("fork")
+        stop_event = context.Event()
+        alert_counts = context.Array("q", num_workers)
+        workers = [None] * num_workers
+        started = [0.0] * num_workers
+        delays = [self.restart_delay] * num_workers
+        # monotonic time at which each crashed worker is restarted
+        pending_restarts = {}
+        restart_times = collections.deque()
+        restarts = 0
+        failed = False
+        header = "FinkAlertStream.supervise"
+
+        def start_worker(index):
+            worker = context.Process(
+                target=_run_worker,
+                args=(self, index, stop_event, alert_counts),
+                name=f"FinkAlertStream-worker-{index}",
+            )
+            worker.start()
+            workers[index] = worker
+            started[index] = time.monotonic()
+
+        def request_stop(signum, frame):
+            logger.info(f"{header} received signal {signum}, stopping the workers")
+            stop_event.set()
+
+        # forked workers must not share the database connections of the parent
+        connections.close_all()
+        previous_handlers = {
+            signum: signal.signal(signum, request_stop) for signum in (signal.SIGINT, signal.SIGTERM)
+        }
+        try:
+            for index in range(num_workers):
+                start_worker(index)
+            logger.info(f"{header} started {num_workers} workers in group.id: {self.group_id}")
+
+            last_total, last_time = 0, time.monotonic()
+            while any(workers) or pending_restarts:
+                stop_event.wait(self.supervisor_interval)
+                now = time.monotonic()
+                for index, worker in enumerate(workers):
+                    if worker is None or worker.is_alive():
+                        continue
+                    worker.join()
+                    workers[index] = None
+                    if worker.exitcode == 0 or stop_event.is_set():
+                        continue
+                    while restart_times and now - restart_times[0] > self.restart_window:
+                        restart_times.popleft()
+                    if len(restart_times) >= self.max_restarts:
+                        logger.error(
+                            f"{header} worker {index} exited with code {worker.exitcode}, and workers were "
+                            f"restarted {len(restart_times)} times in {self.restart_window:.0f}s, "
+                            f"stopping the workers"
+                        )
+                        failed = True
+                        stop_event.set()
+                        continue
+                    if now - started[index] >= self.max_restart_delay:
+                        delays[index] = self.restart_delay
+                    logger.warning(
+                        f"{header} worker {index} exited with code {worker.exitcode}, "
+                        f"restarting it in {delays[index]:.1f}s"
+                    )
+                    restart_times.append(now)
+                    pending_restarts[index] = now + delays[index]
+                    delays[index] = min(delays[index] * 2, self.max_restart_delay)
+
+                if stop_event.is_set():
+                    pending_restarts.clear()
+                for index, restart_time in list(pending_restarts.items()):
+                    if now >= restart_time:
+                        del pending_restarts[index]
+                        restarts += 1
+                        start_worker(index)
+
+                if now - last_time >= self.stats_interval:
+                    total = sum(alert_counts[:])
+                    logger.info(
+                        f"{header} {sum(w is not None for w in workers)} workers, {total} alerts handled, "
+                        f"{(total - last_total) / (now - last_time):.1f} alerts/s, {restarts} restarts"
+                    )
+                    last_total, last_time = total, now
+
+                if stop_event.is_set():
+                    deadline = time.monotonic() + self.shutdown_timeout
+                    for worker in filter(None, workers):
+                        worker.join(max(deadline - time.monotonic(), 0))
+                        if worker.is_alive():
+                            logger.warning(f"{header} {worker.name} did not stop in time, terminating it")
+                            worker.terminate()
+                            worker.join()
+                    break
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+        stats = {"alerts": sum(alert_counts[:]), "restarts": restarts, "failed": failed}
+        logger.info(f"{header} all workers stopped: {stats}")
+        return stats
+
+    def replay(self, paths, topic=None, rate=None, batch_size=None):
+        """Pass archived alerts read from local files to the handlers, as `listen` does with Kafka alerts
+
+        Alerts go through `dispatch_alerts` (FILTERS, spill log, handler of the
+        topic), one at a time, or in lists of BATCH_SIZE alerts.
+
+        Parameters
+        ----------
+        paths: list of str
+            Avro or Parquet files, or directories (see `tom_fink.replay`)
+        topic: str, optional
+            Topic of the alerts, which selects their handler and target list.
+            Default is the first topic of the stream.
+        rate: float, optional
+            Maximum number of alerts per second. Default is as fast as possible.
+        batch_size: int, optional
+            Default is BATCH_SIZE.
+
+        Returns
+        ----------
+        out: dict
+            Number of alerts, duration (s), throughput (alerts/s), and
+            percentiles of the latency (ms) of the handler calls
+        """
+        topic = topic or self.topics[0]
+        batch_size = int(batch_size or self.batch_size)
+        pacer = Pacer(rate)
+        latencies = []
+        num_alerts = 0
+        start = time.monotonic()
+        with self.spill_drainer():
+            for alerts in iter_alert_batches(paths, batch_size):
+                pacer.wait(len(alerts))
+                call_start = time.monotonic()
+                self.dispatch_alerts(alerts if batch_size > 1 else alerts[0], topic)
+                latencies.append(time.monotonic() - call_start)
+                num_alerts += len(alerts)
+        duration = time.monotonic() - start
+        stats = {
+            "alerts": num_alerts,
+            "seconds": duration,
+            "alerts_per_second": num_alerts / duration if duration > 0 else 0.0,
+            "latency_ms": latency_percentiles(latencies),
+        }
+        logger.info(f"FinkAlertStream.replay {topic}: {stats}")
+        return stats
+
+    def consume_batch(self, consumer, batch_size):
+        """Consume up to `batch_size` alerts, and pass them to the topic handlers as lists
+
+        Parameters
+        ----------
+        consumer: FinkConsumer
+            Consumer subscribed to the topics
+        batch_size: int
+            Maximum number of alerts to consume. Fewer are returned
+            if BATCH_TIMEOUT (in milliseconds) runs out first.
+
+        Returns
+        ----------
+        out: int
+            Number of alerts consumed, or 1 if there were none
+            (each empty call counts as a poll, as in `listen`).
+        """
+        with instrumentation.span("stream.poll") as span:
+            messages = consumer.consume(batch_size, timeout=float(self.batch_timeout) / 1000)
+            span.set(rows=len(messages))
+        self.metrics.record_poll(sum(topic is not None for topic, _, _ in messages))
+
+        alerts_for_topic = {}
+        for topic, alert, key in messages:
+            if topic is not None:
+                alerts_for_topic.setdefault(topic, []).append(alert)
+
+        if not alerts_for_topic:
+            logger.info("No alerts received")
+        for topic, alerts in alerts_for_topic.items():
+            self.dispatch_alerts(alerts, topic)
+        return max(len(messages), 1)
+
+
+def _run_worker(stream, index, stop_event, alert_counts):
+    """Entry point of the worker processes of `FinkAlertStream.supervise`"""
+    # the supervisor handles Ctrl-C, and passes it on through stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+    # alerts handled by the previous runs of this worker, if it was restarted
+    previous_alerts = alert_counts[index]
+    stream.worker_index = index
+
+    def progress():
+        alert_counts[index] = previous_alerts + stream.alerts_handled
+
+    failed = stream.run_consumer(stop_event=stop_event, progress=progress)
+    progress()
+    sys.exit(1 if failed else 0)
 
 
 def alert_logger(alert, topic):
@@ -124,8 +978,15 @@ def alert_logger(alert, topic):
     UniqueViolation, SQL_IntegrityError, DJ_IntegrityError
         If the target is already saved
 
+    Returns
+    ----------
+    out: Target
+        The new target, or None if it was not saved
+
     Raises
     ------
+    OperationalError, InterfaceError
+        If the database cannot be reached.
     Exception (base)
         for any other failures than name clash when
         saving the target in the database.
@@ -139,6 +1000,10 @@ def alert_logger(alert, topic):
         )
     )
 
+    if known_objects.check(alert["objectId"]):
+        logger.info(f"Target {alert['objectId']} already in the database")
+        return None
+
     mytarget = Target(
         name=alert["objectId"],
         type="SIDEREAL",
@@ -150,14 +1015,240 @@ def alert_logger(alert, topic):
     try:
         mytarget.save(
             extras={
-                "fink broker link": "https://fink-portal.org/{}".format(
-                    alert["objectId"]
-                )
+                "fink broker link": FINK_PORTAL_URL.format(alert["objectId"])
             }
         )
     except (UniqueViolation, SQL_IntegrityError, DJ_IntegrityError):
         logger.warning(f"Target {mytarget} already in the database")
-        pass
+        known_objects.add([mytarget.name])
+        return None
+    except DATABASE_UNAVAILABLE_ERRORS:
+        # let FinkAlertStream spill the alert, or stop
+        raise
     except Exception:
         logger.error("error when trying to save new alerts in the db", exc_info=1)
         logger.error(traceback.format_exc())
+        return None
+    known_objects.add([mytarget.name])
+    return mytarget
+
+
+def alert_batch_logger(alerts, topic):
+    """Batch alert handler for Fink
+
+    Same as `alert_logger`, but for a list of alerts (see BATCH_SIZE
+    in `FinkAlertStream`). Alerts are deduplicated on objectId (the
+    most recent one is kept), objects that are already known as a
+    target name or alias (in memory, or else in the database) are
+    skipped, and the new targets and their
+    extras are inserted with a few bulk queries in one transaction.
+
+    Parameters
+    ----------
+    alerts: list of dic
+        Dictionaries containing alert data. See `consumer.consume`.
+    topic: str
+        Topic name
+
+    Returns
+    ----------
+    out: list of Target
+        The targets created
+    """
+    utc = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    logger.info(
+        f"fink.alert_batch_logger topic: {topic}, {len(alerts)} alerts (received {utc})"
+    )
+
+    latest_alerts = {}
+    for alert in alerts:
+        previous = latest_alerts.get(alert["objectId"])
+        if previous is None or alert["candidate"]["jd"] > previous["candidate"]["jd"]:
+            latest_alerts[alert["objectId"]] = alert
+
+    # only the objects that are not known in memory need a query
+    unknown_names = [name for name in latest_alerts if not known_objects.check(name)]
+    known_names = set(
+        Target.objects.filter(name__in=unknown_names).values_list("name", flat=True)
+    )
+    known_names.update(
+        TargetName.objects.filter(name__in=unknown_names).values_list("name", flat=True)
+    )
+    known_objects.add(known_names)
+    new_targets = [
+        Target(
+            name=objectId,
+            type="SIDEREAL",
+            ra=latest_alerts[objectId]["candidate"]["ra"],
+            dec=latest_alerts[objectId]["candidate"]["dec"],
+            epoch=latest_alerts[objectId]["candidate"]["jd"],
+        )
+        for objectId in unknown_names
+        if objectId not in known_names
+    ]
+    logger.info(
+        f"fink.alert_batch_logger {len(latest_alerts)} objects, {len(new_targets)} new"
+    )
+    if not new_targets:
+        return []
+
+    try:
+        with transaction.atomic():
+            Target.objects.bulk_create(new_targets)
+            if any(target.pk is None for target in new_targets):
+                # the database backend does not return the primary keys of bulk inserts
+                new_targets = list(Target.objects.filter(name__in=[t.name for t in new_targets]))
+            TargetExtra.objects.bulk_create(
+                [
+                    _target_extra(target, key, value)
+                    for target in new_targets
+                    for key, value in _new_target_extras(target).items()
+                ]
+            )
+    except (UniqueViolation, SQL_IntegrityError, DJ_IntegrityError):
+        # another process created some of the targets in the meantime
+        logger.warning(
+            "fink.alert_batch_logger name clash in bulk insert, saving targets one by one"
+        )
+        for target in new_targets:
+            alert_logger(latest_alerts[target.name], topic)
+        return list(Target.objects.filter(name__in=[t.name for t in new_targets]))
+
+    known_objects.add(target.name for target in new_targets)
+    # bulk_create does not call Target.save, which runs the target_post_save hook
+    for target in new_targets:
+        run_hook("target_post_save", target=target, created=True)
+    return new_targets
+
+
+# takes lists of alerts (see FinkAlertStream.handle_alerts)
+alert_batch_logger.handles_batches = True
+
+
+def alert_photometry(alert):
+    """Return the detections of an alert (its candidate and `prv_candidates`),
+    as the rows returned by the Fink REST API for the photometry of an object
+
+    Only the columns requested from the REST API are kept (see `OBJECT_COLUMNS`).
+    The 'd:' columns, added by Fink to the alert, only apply to its candidate.
+    Non-detections (upper limits, without `magpsf`) are skipped.
+    """
+    candidates = [alert["candidate"]] + list(alert.get("prv_candidates") or [])
+    rows = []
+    for index, candidate in enumerate(candidates):
+        if candidate.get("magpsf") is None:
+            continue
+        row = {}
+        for column in ALERT_PHOTOMETRY_COLUMNS:
+            prefix, name = column.split(":")
+            if name == "objectId":
+                row[column] = alert["objectId"]
+            elif prefix == "i" and name in candidate:
+                row[column] = candidate[name]
+            elif index == 0 and name in alert:
+                row[column] = alert[name]
+        rows.append(row)
+    return rows
+
+
+def ingest_alert_photometry(alerts, data_service=None):
+    """Save the detections of alerts as the Fink photometry of their targets
+
+    The detections of all the alerts of an object are merged (the
+    history of successive alerts overlaps), and passed to
+    `FinkDataService.create_reduced_datums_from_query` with bulk inserts,
+    which only keeps those more recent than the latest Fink photometry of
+    the target and deduplicates them on `candid`. Targets are looked up
+    by name and alias with two queries. Alerts of objects that are not
+    targets are skipped.
+
+    Parameters
+    ----------
+    alerts: list of dic
+        Dictionaries containing alert data
+    data_service: FinkDataService, optional
+        Data service whose photometry watermarks are used and updated.
+        Pass the same instance across calls to skip the watermark queries.
+
+    Returns
+    ----------
+    out: dict
+        The reduced datums created (or retrieved) for each Target
+    """
+    if data_service is None:
+        data_service = FinkDataService()
+
+    photometry = {}
+    for alert in alerts:
+        photometry.setdefault(alert["objectId"], []).extend(alert_photometry(alert))
+
+    targets = {
+        target.name: target for target in Target.objects.filter(name__in=list(photometry))
+    }
+    for alias in TargetName.objects.filter(name__in=list(photometry)).select_related("target"):
+        targets.setdefault(alias.name, alias.target)
+
+    data_service.load_photometry_watermarks(
+        [target for target in targets.values() if target.pk not in data_service.photometry_watermarks]
+    )
+    reduced_datums = {}
+    for objectId, target in targets.items():
+        reduced_datums[target] = data_service.create_reduced_datums_from_query(
+            target, photometry[objectId], "photometry", bulk=True, incremental=True
+        )
+    logger.debug(
+        f"fink.ingest_alert_photometry {len(alerts)} alerts, {len(targets)} of {len(photometry)} objects are targets"
+    )
+    return reduced_datums
+
+
+def _handle_one_by_one(handler):
+    """Wrap a handler of single alerts, to pass it the alerts of a list one at a time"""
+    def handle_batch(alerts, topic):
+        targets = []
+        for alert in alerts:
+            target = handler(alert, topic)
+            if isinstance(target, Target):
+                targets.append(target)
+            elif target:
+                targets.extend(target)
+        return targets
+
+    return handle_batch
+
+
+def _new_target_extras(target):
+    """TargetExtras of a new target: the EXTRA_FIELDS defaults and the Fink portal link"""
+    extras = {
+        extra_field["name"]: extra_field["default"]
+        for extra_field in settings.EXTRA_FIELDS
+        if extra_field.get("default") is not None
+    }
+    extras["fink broker link"] = FINK_PORTAL_URL.format(target.name)
+    return extras
+
+
+def _target_extra(target, key, value):
+    """Unsaved TargetExtra, with the typed values (float, bool, time) that `TargetExtra.save` sets
+
+    The extras are inserted with `bulk_create`, which does not call `save`,
+    so its conversion of the value is done here, in the same way.
+    """
+    if value is None:
+        value = "None"
+    target_extra = TargetExtra(target=target, key=key, value=value)
+    try:
+        target_extra.float_value = float(value)
+    except (TypeError, ValueError, OverflowError):
+        target_extra.float_value = None
+    try:
+        target_extra.bool_value = bool(value)
+    except (TypeError, ValueError, OverflowError):
+        target_extra.bool_value = None
+    target_extra.time_value = None
+    if not target_extra.float_value:
+        try:
+            target_extra.time_value = value if isinstance(value, datetime) else parse_date(value)
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return target_extra
@@ -1,6 +1,7 @@
 from typing import Dict, List
 
 from django.apps import AppConfig
+from django.urls import include, path
 
 
 class TomFinkConfig(AppConfig):
@@ -15,3 +16,10 @@ class TomFinkConfig(AppConfig):
         This method should return a list of dictionaries containing dot separated DataService classes.
         """
         return [{"class": f"{self.name}.fink.FinkDataService"}]
+
+    def include_url_paths(self):
+        """Add the Prometheus endpoint of the Fink timing spans (see `tom_fink.views.metrics`).
+
+        This is the TOMToolkit integration point for adding URL patterns to the TOM.
+        """
+        return [path("fink/", include(f"{self.name}.urls", namespace=self.name))]
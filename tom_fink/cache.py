@@ -0,0 +1,257 @@
+# Copyright (c) 2025 Julien Peloton
+#
+# This file is part of TOM Toolkit
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import datetime
+import hashlib
+import json
+import logging
+import pickle
+import threading
+import uuid
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+
+logger = logging.getLogger(__name__)
+
+# Hour (UTC) after which the Fink databases hold the data of the previous night
+DEFAULT_REFRESH_HOUR_UTC = 14
+KEY_PREFIX = "tom_fink"
+# Cache in settings.CACHES used by default. The tom_dataservices views clear the
+# 'default' cache whenever a new query is run, so Fink responses are kept apart.
+DEFAULT_CACHE_ALIAS = "fink"
+# Payload keys of queries that are relative to the current time (the class search by date
+# sends the current time as `stopdate`), whose responses would never be read back
+UNCACHEABLE_PAYLOAD_KEYS = ("startdate", "stopdate")
+# Lifetime (s) of the stored query results, as the rows cached by the tom_dataservices views
+DEFAULT_RESULT_TIMEOUT = 3600
+# Largest stored query result entry (bytes), below the default item size limit of memcached (1 MiB)
+MAX_RESULT_ENTRY_SIZE = 1_000_000
+# Largest total size (bytes) of the stored results of a query
+MAX_RESULT_QUERY_SIZE = 50_000_000
+
+
+def normalize_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Return a copy of a Fink API payload that does not depend on formatting details.
+
+    Surrounding whitespace is stripped from string values and empty values are dropped,
+    so that e.g. {'class': 'AGN', 'n': ' 15'} and {'n': '15', 'class': 'AGN'} share a key.
+    """
+    normalized = {}
+    for key, value in payload.items():
+        if isinstance(value, str):
+            value = value.strip()
+        if value in ("", None):
+            continue
+        normalized[key] = value
+    return normalized
+
+
+_fallback_backend = None
+_fallback_lock = threading.Lock()
+
+
+def get_cache_backend(alias: str = DEFAULT_CACHE_ALIAS):
+    """Return the Django cache `alias`.
+
+    If the CACHES setting has no DEFAULT_CACHE_ALIAS entry, a local-memory cache
+    private to tom_fink is used instead of the 'default' cache.
+    """
+    global _fallback_backend
+    if alias != DEFAULT_CACHE_ALIAS or alias in settings.CACHES:
+        return caches[alias]
+    with _fallback_lock:
+        if _fallback_backend is None:
+            _fallback_backend = LocMemCache(KEY_PREFIX, {"OPTIONS": {"MAX_ENTRIES": 300}})
+        return _fallback_backend
+
+
+def seconds_until_refresh(refresh_hour: int = DEFAULT_REFRESH_HOUR_UTC,
+                          now: Optional[datetime.datetime] = None) -> int:
+    """Return the number of seconds until the next Fink database update (`refresh_hour` UTC)."""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    refresh = now.replace(hour=refresh_hour, minute=0, second=0, microsecond=0)
+    if refresh <= now:
+        refresh += datetime.timedelta(days=1)
+    return max(int((refresh - now).total_seconds()), 1)
+
+
+class FinkQueryCache:
+    """Cache of Fink REST API responses on top of a Django cache backend.
+
+    Entries are keyed on the endpoint and the normalized query payload. By default
+    they expire when the Fink databases are next updated (once a day), since a query
+    cannot return anything new before then.
+
+    Memory is bounded by the Django backend: the local-memory backend evicts the least
+    recently used entries once its OPTIONS['MAX_ENTRIES'] is reached.
+
+    Queries relative to the current time (see UNCACHEABLE_PAYLOAD_KEYS) are not cached.
+
+    Parameters
+    ----------
+    alias: str, optional
+        Name of the cache in the CACHES setting. Default is 'fink'
+        (see `get_cache_backend`).
+    timeout: int, optional
+        Lifetime of the entries in seconds. If None (default), entries
+        expire at the next Fink database update.
+    refresh_hour: int, optional
+        Hour (UTC) of the daily Fink database update.
+    """
+
+    def __init__(self, alias: str = DEFAULT_CACHE_ALIAS, timeout: Optional[int] = None,
+                 refresh_hour: int = DEFAULT_REFRESH_HOUR_UTC) -> None:
+        self.alias = alias
+        self.timeout = timeout
+        self.refresh_hour = refresh_hour
+
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def backend(self):
+        return get_cache_backend(self.alias)
+
+    @staticmethod
+    def cacheable(payload: Dict[str, Any]) -> bool:
+        """Return False for the queries relative to the current time, which are never repeated."""
+        return not any(payload.get(key) for key in UNCACHEABLE_PAYLOAD_KEYS)
+
+    def make_key(self, endpoint: str, payload: Dict[str, Any]) -> str:
+        """Return the cache key of a query to `endpoint` with `payload`."""
+        normalized = json.dumps(normalize_payload(payload), sort_keys=True, default=str)
+        digest = hashlib.sha256(f"{endpoint}:{normalized}".encode()).hexdigest()
+        return f"{KEY_PREFIX}:{endpoint}:{digest}"
+
+    def get(self, endpoint: str, payload: Dict[str, Any]) -> Tuple[bool, Any]:
+        """Return (hit, data) for a query. `data` is None on a miss."""
+        data = self.backend.get(self.make_key(endpoint, payload))
+        with self._lock:
+            if data is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        return data is not None, data
+
+    def set(self, endpoint: str, payload: Dict[str, Any], data: Any) -> None:
+        """Store the response `data` of a query."""
+        timeout = self.timeout
+        if timeout is None:
+            timeout = seconds_until_refresh(self.refresh_hour)
+        self.backend.set(self.make_key(endpoint, payload), data, timeout)
+
+    def stats(self) -> Dict[str, int]:
+        """Return the hit and miss counters."""
+        with self._lock:
+            return {"hits": self._hits, "misses": self._misses}
+
+
+class QueryResultStore:
+    """Server-side storage of the alerts of `FinkDataService.query_targets` results.
+
+    The alerts of each object of a query are stored in their own cache entry, under
+    a random query id. The rows of the target selection table then only carry
+    a reference to them ({'query_id': ..., 'objectId': ...}, see `reference`),
+    and the alerts of the selected targets are loaded when the targets are created.
+
+    The alerts are stored pickled, so that their size is known before they reach the
+    backend. Backends drop the values larger than their item size limit (1 MB by default
+    for memcached) without an error, so the alerts of an object larger than
+    `max_entry_size` are not stored, nor those past `max_query_size` for the whole query,
+    nor those that the backend failed to store (see `save`). The number of stored queries
+    is bounded by the backend only: the local-memory fallback of `get_cache_backend` keeps
+    at most 300 entries, whatever their size.
+
+    Parameters
+    ----------
+    alias: str, optional
+        Name of the cache in the CACHES setting. Default is 'fink'
+        (see `get_cache_backend`).
+    timeout: int, optional
+        Lifetime of the stored results in seconds.
+    max_entry_size: int, optional
+        Largest size of the alerts of an object, in bytes once pickled.
+    max_query_size: int, optional
+        Largest total size of the alerts of a query, in bytes once pickled.
+    """
+
+    def __init__(self, alias: str = DEFAULT_CACHE_ALIAS, timeout: int = DEFAULT_RESULT_TIMEOUT,
+                 max_entry_size: int = MAX_RESULT_ENTRY_SIZE, max_query_size: int = MAX_RESULT_QUERY_SIZE) -> None:
+        self.alias = alias
+        self.timeout = timeout
+        self.max_entry_size = max_entry_size
+        self.max_query_size = max_query_size
+
+    @property
+    def backend(self):
+        return get_cache_backend(self.alias)
+
+    def make_key(self, query_id: str, objectId: str) -> str:
+        """Return the cache key of the alerts of an object of a query."""
+        return f"{KEY_PREFIX}:results:{query_id}:{objectId}"
+
+    def save(self, alerts_for_target: Dict[str, List[Dict[str, Any]]]) -> Tuple[str, Set[str]]:
+        """Store the alerts of each object of a query.
+
+        Returns the id of the query and the objects whose alerts were stored.
+        The others are logged, and should be kept by the caller.
+        """
+        query_id = uuid.uuid4().hex
+        entries = {}
+        query_size = 0
+        for objectId, alerts in alerts_for_target.items():
+            data = pickle.dumps(alerts, pickle.HIGHEST_PROTOCOL)
+            if len(data) > self.max_entry_size:
+                logger.warning(f"QueryResultStore -- alerts of {objectId} not stored: {len(data)} bytes "
+                               f"> {self.max_entry_size}")
+                continue
+            if query_size + len(data) > self.max_query_size:
+                logger.warning(f"QueryResultStore -- alerts of {objectId} not stored: results of query "
+                               f"{query_id} > {self.max_query_size} bytes")
+                continue
+            query_size += len(data)
+            entries[self.make_key(query_id, objectId)] = (objectId, data)
+        if not entries:
+            return query_id, set()
+        try:
+            failed = self.backend.set_many({key: data for key, (_, data) in entries.items()}, self.timeout) or []
+        except Exception as e:
+            logger.warning(f"QueryResultStore -- results of query {query_id} not stored: {e}")
+            return query_id, set()
+        if failed:
+            logger.warning(f"QueryResultStore -- {len(failed)} of {len(entries)} objects of query "
+                           f"{query_id} not stored by the cache '{self.alias}'")
+        failed = set(failed)
+        return query_id, {objectId for key, (objectId, _) in entries.items() if key not in failed}
+
+    def load(self, query_id: str, objectId: str) -> Optional[List[Dict[str, Any]]]:
+        """Return the alerts of an object of a query, or None if they expired."""
+        data = self.backend.get(self.make_key(query_id, objectId))
+        return pickle.loads(data) if data is not None else None
+
+    @staticmethod
+    def reference(query_id: str, objectId: str) -> Dict[str, str]:
+        """Return the reference to the alerts of an object that replaces them in a selection table row."""
+        return {"query_id": query_id, "objectId": objectId}
+
+    @staticmethod
+    def is_reference(data: Any) -> bool:
+        """Return True if `data` is a reference returned by `reference`."""
+        return isinstance(data, dict) and "query_id" in data and "objectId" in data
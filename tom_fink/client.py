@@ -0,0 +1,288 @@
+# Copyright (c) 2025 Julien Peloton
+#
+# This file is part of TOM Toolkit
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import codecs
+import inspect
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from tom_fink import __version__ as fink_version
+
+logger = logging.getLogger(__name__)
+
+# Read timeouts (in seconds) per Fink API endpoint. Class searches over
+# several days can take much longer than a single object lookup.
+DEFAULT_TIMEOUTS = {
+    "objects": 60,
+    "conesearch": 60,
+    "latests": 120,
+}
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_BACKOFF_JITTER = 0.5
+# No limit on the request rate by default
+DEFAULT_MAX_REQUESTS_PER_SECOND = None
+
+# 429 (Too Many Requests) and transient server errors are worth retrying
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Retry only takes backoff_jitter from urllib3 2.0 (1.26 is still pinned by e.g. older botocore)
+RETRY_SUPPORTS_JITTER = "backoff_jitter" in inspect.signature(Retry.__init__).parameters
+
+# Size in bytes of the chunks read from streamed responses
+STREAM_CHUNK_SIZE = 64 * 1024
+JSON_WHITESPACE = " \t\n\r"
+
+
+def iter_json_array(chunks: Iterable[str]) -> Iterator[Any]:
+    """Incrementally decode a JSON array, yielding its items as soon as they are complete.
+
+    Parameters
+    ----------
+    chunks: iterable of str
+        Successive pieces of the JSON document, split anywhere.
+
+    Raises
+    ------
+    ValueError
+        If the document is not a JSON array, or is truncated or malformed.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    in_array = False
+    for chunk in chunks:
+        buffer += chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in JSON_WHITESPACE:
+                position += 1
+            if position >= len(buffer):
+                break
+            if not in_array:
+                if buffer[position] != "[":
+                    raise ValueError(f"Expected a JSON array, got: {buffer[position:position + 80]}")
+                in_array = True
+                position += 1
+                continue
+            if buffer[position] == ",":
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            start = position
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break  # incomplete item, wait for the next chunk
+            position = end
+            while position < len(buffer) and buffer[position] in JSON_WHITESPACE:
+                position += 1
+            if position >= len(buffer) or buffer[position] not in ",]":
+                # a number cut by the end of the chunk (e.g. '2.' of '2.5') is not complete yet
+                position = start
+                break
+            yield item
+        buffer = buffer[position:]
+    raise ValueError("Truncated or malformed JSON array")
+
+
+def iter_response_items(response: requests.Response, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[Any]:
+    """Yield the items of a streamed JSON array response without loading the whole body."""
+    decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")()
+    try:
+        chunks = (decoder.decode(chunk) for chunk in response.iter_content(chunk_size=chunk_size))
+        yield from iter_json_array(chunks)
+    finally:
+        response.close()
+
+
+class RateLimiter:
+    """Thread-safe limiter that spaces calls to `wait` at least 1/`rate` seconds apart.
+
+    Parameters
+    ----------
+    rate: float
+        Maximum number of calls per second, shared by all threads.
+    """
+
+    def __init__(self, rate: float) -> None:
+        if rate <= 0:
+            raise ValueError(f"The request rate must be positive, got {rate}")
+        self.rate = rate
+        self.interval = 1.0 / rate
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def wait(self) -> float:
+        """Block until the next call is allowed. Return the time spent waiting, in seconds."""
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(self._next_slot, now) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+            return delay
+        return 0.0
+
+
+class FinkClient:
+    """Connection-pooled HTTP client for the Fink REST API.
+
+    A single `requests.Session` is kept alive so that consecutive queries
+    reuse the same TCP+TLS connections. Failed requests are retried with
+    a jittered exponential backoff on 429 and 5xx responses.
+
+    Parameters
+    ----------
+    base_url: str
+        Root of the Fink API, e.g. https://api.ztf.fink-portal.org/api/v1/
+    pool_size: int, optional
+        Maximum number of connections kept alive per host.
+    timeouts: dict, optional
+        Read timeouts in seconds, keyed by endpoint name. Missing
+        endpoints fall back on `read_timeout`.
+    read_timeout: float, optional
+        Default read timeout in seconds.
+    connect_timeout: float, optional
+        Timeout in seconds to establish a connection.
+    max_retries: int, optional
+        Number of retries on connection errors, 429 and 5xx responses.
+    backoff_factor: float, optional
+        Base of the exponential backoff between retries, in seconds.
+    backoff_jitter: float, optional
+        Upper bound of the random delay added to each backoff, in seconds.
+        Ignored with urllib3 < 2.0.
+    gzip: bool, optional
+        If True (default), ask the server for compressed responses.
+    max_requests_per_second: float, optional
+        If set, requests sent by all threads are spaced to stay under this rate.
+        Retries sent by urllib3 are not counted.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        timeouts: Optional[Dict[str, float]] = None,
+        read_timeout: float = DEFAULT_READ_TIMEOUT,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+        backoff_jitter: float = DEFAULT_BACKOFF_JITTER,
+        gzip: bool = True,
+        max_requests_per_second: Optional[float] = DEFAULT_MAX_REQUESTS_PER_SECOND,
+    ) -> None:
+        self.base_url = base_url
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.read_timeout = read_timeout
+        self.connect_timeout = connect_timeout
+
+        retry_options = {}
+        if RETRY_SUPPORTS_JITTER:
+            retry_options["backoff_jitter"] = backoff_jitter
+        elif backoff_jitter:
+            logger.debug("FinkClient -- backoff_jitter requires urllib3>=2.0, retrying without jitter")
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            # Fink queries are read-only, so POST is safe to retry
+            allowed_methods=frozenset(["GET", "POST"]),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+            **retry_options,
+        )
+        self._adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+        self._session = requests.Session()
+        self._session.mount("https://", self._adapter)
+        self._session.mount("http://", self._adapter)
+        self._session.headers.update({
+            "User-Agent": f"tom-fink/{fink_version}",
+            "Accept-Encoding": "gzip, deflate" if gzip else "identity",
+        })
+
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._errors = 0
+        self._throttled_seconds = 0.0
+        self.rate_limiter: Optional[RateLimiter] = None
+        self.set_rate_limit(max_requests_per_second)
+
+    def get_timeout(self, endpoint: str):
+        """Return the (connect, read) timeout tuple for `endpoint`."""
+        return self.connect_timeout, self.timeouts.get(endpoint, self.read_timeout)
+
+    def set_rate_limit(self, max_requests_per_second: Optional[float]) -> None:
+        """Limit the request rate of the client, or remove the limit if None."""
+        self.rate_limiter = RateLimiter(max_requests_per_second) if max_requests_per_second else None
+
+    def post(self, endpoint: str, json: Optional[Dict[str, Any]] = None, **kwargs) -> requests.Response:
+        """POST `json` to the Fink API `endpoint` (e.g. 'objects') using the pooled session.
+
+        Extra keyword arguments are passed on to `requests.Session.post`.
+        """
+        kwargs.setdefault("timeout", self.get_timeout(endpoint))
+        rate_limiter = self.rate_limiter
+        throttled = rate_limiter.wait() if rate_limiter is not None else 0.0
+        with self._lock:
+            self._requests += 1
+            self._throttled_seconds += throttled
+        try:
+            return self._session.post(self.base_url + endpoint, json=json, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self._errors += 1
+            raise
+
+    def stats(self) -> Dict[str, float]:
+        """Return connection usage counters.
+
+        `connections_reused` is the number of HTTP requests (retries included)
+        that were sent over an already-open connection of the pool, and
+        `throttled_seconds` the total time requests waited for the rate limiter.
+        """
+        pools = self._adapter.poolmanager.pools
+        connections = 0
+        wire_requests = 0
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            wire_requests += pool.num_requests
+        with self._lock:
+            return {
+                "requests": self._requests,
+                "errors": self._errors,
+                "connections_opened": connections,
+                "connections_reused": max(wire_requests - connections, 0),
+                "throttled_seconds": self._throttled_seconds,
+            }
+
+    def close(self) -> None:
+        """Close all pooled connections."""
+        self._session.close()
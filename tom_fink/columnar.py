@@ -0,0 +1,130 @@
+# Copyright (c) 2025 Julien Peloton
+#
+# This file is part of TOM Toolkit
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""Columnar (Parquet) transfer of Fink alerts, aggregated per object with NumPy.
+
+This requires the optional `pyarrow` package (`pip install pyarrow`).
+"""
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+OUTPUT_FORMAT = "parquet"
+
+
+def _import_pyarrow():
+    """Import pyarrow, which is an optional dependency of tom_fink."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError(
+            "The columnar mode of tom_fink requires pyarrow: pip install pyarrow"
+        ) from e
+    return pyarrow
+
+
+def read_parquet(content: bytes):
+    """Load a Parquet response body into a `pyarrow.Table` without copying it."""
+    pyarrow = _import_pyarrow()
+    return pyarrow.parquet.read_table(pyarrow.py_buffer(content))
+
+
+def group_indices(codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Sort rows by group code.
+
+    Parameters
+    ----------
+    codes: np.ndarray of int
+        Group code of each row, e.g. the dictionary indices of `i:objectId`.
+
+    Returns
+    -------
+    order: np.ndarray
+        Indices that sort the rows by group, keeping the row order within a group.
+    starts: np.ndarray
+        Position of the first row of each group in the sorted rows.
+    counts: np.ndarray
+        Number of rows in each group.
+    """
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    counts = np.diff(np.r_[starts, len(sorted_codes)])
+    return order, starts, counts
+
+
+def grouped_median(values: np.ndarray, order: np.ndarray, starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Median of `values` within each group defined by `group_indices`."""
+    groups = np.repeat(np.arange(len(starts)), counts)
+    sorted_values = values[order]
+    # sort by value within each group; groups stay in place since they are the primary key
+    sorted_values = sorted_values[np.lexsort((sorted_values, groups))]
+    low = sorted_values[starts + (counts - 1) // 2]
+    high = sorted_values[starts + counts // 2]
+    return (low + high) / 2
+
+
+def summarize_alerts(table) -> List[Dict[str, Any]]:
+    """Build the rows of the target selection table from a table of alerts.
+
+    Medians of ra/dec/magpsf, the jd range and the number of alerts are computed
+    for every `i:objectId` at once, with a single sort of the table.
+
+    Parameters
+    ----------
+    table: pyarrow.Table
+        Alerts, one per row, with at least the columns `i:objectId`,
+        `i:ra`, `i:dec`, `i:magpsf` and `i:jd`.
+
+    Returns
+    -------
+    rows: list of dict
+        One row per object, in order of first appearance in `table`
+        (see `FinkDataService.query_targets`).
+    """
+    if table.num_rows == 0:
+        return []
+
+    # dictionary codes are assigned in order of first appearance
+    encoded = table.column("i:objectId").combine_chunks().dictionary_encode()
+    names = encoded.dictionary.to_pylist()
+    order, starts, counts = group_indices(encoded.indices.to_numpy())
+
+    def column(name):
+        return table.column(name).to_numpy().astype(np.float64, copy=False)
+
+    median_ra = grouped_median(column("i:ra"), order, starts, counts)
+    median_dec = grouped_median(column("i:dec"), order, starts, counts)
+    median_mag = grouped_median(column("i:magpsf"), order, starts, counts)
+    sorted_jd = column("i:jd")[order]
+    jd_min = np.minimum.reduceat(sorted_jd, starts)
+    jd_max = np.maximum.reduceat(sorted_jd, starts)
+
+    sorted_alerts = table.take(order).to_pylist()
+    rows = []
+    for group, (start, count) in enumerate(zip(starts.tolist(), counts.tolist())):
+        rows.append({
+            "name": names[group],
+            "ra": float(median_ra[group]),
+            "dec": float(median_dec[group]),
+            "mag": float(median_mag[group]),
+            "jd_min": float(jd_min[group]),
+            "jd_max": float(jd_max[group]),
+            "num_alerts": count,
+            "reduced_datums": {"photometry": sorted_alerts[start:start + count]},
+        })
+    return rows
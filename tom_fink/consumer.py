@@ -0,0 +1,193 @@
+# Copyright (c) 2025 Julien Peloton
+#
+# This file is part of TOM Toolkit
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""Kafka consumer helpers for FinkAlertStream"""
+import collections
+import io
+import json
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import confluent_kafka
+import fastavro
+from fink_client.consumer import AlertConsumer
+
+from tom_fink.instrumentation import instrumentation
+
+Partition = Tuple[str, int]
+
+# Distinct schemas kept by FinkConsumer. Topics normally share one or two.
+MAX_CACHED_SCHEMAS = 16
+
+
+class FinkConsumer(AlertConsumer):
+    """AlertConsumer with access to the raw Kafka messages, manual offset commits, and a faster decoder
+
+    Fink sends the Avro schema of each alert as the key of its message.
+    `AlertConsumer` parses it again for every alert, while this consumer
+    parses each distinct schema once. With `fields`, only these top-level
+    fields are kept in the alerts, so that the others (e.g. the cutouts)
+    are released right after decoding, instead of being queued, spilled
+    to disk or passed to the handlers.
+
+    Parameters
+    ----------
+    topics: list of str
+        Topics to subscribe to
+    config: dict
+        Configuration of `AlertConsumer` (username, group.id, ...)
+    survey: str
+        Survey name among ztf or lsst
+    kafka_config: dict, optional
+        Extra librdkafka settings, which take precedence over those
+        derived from `config`, e.g. {'enable.auto.commit': False}.
+    fields: list of str, optional
+        Top-level fields of the alerts to keep, e.g.
+        ['objectId', 'candidate', 'prv_candidates']. All fields by default.
+    metrics: tom_fink.metrics.StreamMetrics, optional
+        Counts the bytes of the messages received.
+    """
+
+    def __init__(self, topics, config, survey, kafka_config=None, fields=None, metrics=None, **kwargs):
+        self.extra_kafka_config = dict(kafka_config or {})
+        self.fields = list(fields) if fields else None
+        self.metrics = metrics
+        # (parsed schema, decoded key) of each message key
+        self._schemas: Dict[bytes, Tuple[Any, str]] = {}
+        super().__init__(topics, config, survey, **kwargs)
+
+    @property
+    def _kafka_config(self):
+        return self._fink_kafka_config
+
+    @_kafka_config.setter
+    def _kafka_config(self, value):
+        # AlertConsumer.__init__ sets the librdkafka settings right before creating the consumer
+        self._fink_kafka_config = {**value, **self.extra_kafka_config}
+
+    def _get_schema(self, key: bytes) -> Optional[Tuple[Any, str]]:
+        """Return the parsed schema and the decoded message key, or None if the key is not a schema"""
+        schemas = self._schemas.get(key)
+        if schemas is None:
+            try:
+                schema = json.loads(key)
+            except (TypeError, ValueError):
+                return None
+            if not isinstance(schema, dict):
+                return None
+            schemas = (fastavro.parse_schema(schema), key.decode("utf8"))
+            if len(self._schemas) >= MAX_CACHED_SCHEMAS:
+                self._schemas.clear()
+            self._schemas[key] = schemas
+        return schemas
+
+    def process_message(self, msg):
+        """Decode a Kafka message into (topic, alert, key). See `AlertConsumer.process_message`."""
+        key = msg.key()
+        if self.metrics is not None and msg.error() is None:
+            self.metrics.record_bytes(len(msg.value() or b""))
+        schemas = None
+        if msg.error() is None and isinstance(key, bytes):
+            schemas = self._get_schema(key)
+        if schemas is None:
+            # errors, and schemas from a file or from the Fink servers
+            topic, alert, key = super().process_message(msg)
+        else:
+            schema, key = schemas
+            topic = msg.topic()
+            value = msg.value()
+            with instrumentation.span('stream.decode', rows=1, bytes=len(value)):
+                alert = fastavro.schemaless_reader(io.BytesIO(value), schema)
+        if self.fields is not None:
+            alert = {field: alert[field] for field in self.fields if field in alert}
+        return topic, alert, key
+
+    def poll_message(self, timeout: float = -1):
+        """Return the next raw Kafka message, or None on timeout. See `process_message` to decode it."""
+        return self._consumer.poll(timeout)
+
+    def consume_messages(self, num_messages: int = 1, timeout: float = -1) -> list:
+        """Return up to `num_messages` raw Kafka messages, waiting at most `timeout` seconds"""
+        return [msg for msg in self._consumer.consume(num_messages, timeout) if msg is not None]
+
+    def commit_offsets(self, offsets: Dict[Partition, int]) -> None:
+        """Commit the next offset to consume of each (topic, partition)"""
+        self._consumer.commit(
+            offsets=[
+                confluent_kafka.TopicPartition(topic, partition, offset)
+                for (topic, partition), offset in offsets.items()
+            ],
+            asynchronous=False,
+        )
+
+    def lag(self, timeout: float = 1.0) -> Dict[Partition, int]:
+        """Return the number of messages between the committed offset and the end of each assigned partition
+
+        Partitions without a committed offset yet are counted from their first available message.
+        """
+        assignment = self._consumer.assignment()
+        if not assignment:
+            return {}
+        lag = {}
+        for tp in self._consumer.committed(assignment, timeout=timeout):
+            low, high = self._consumer.get_watermark_offsets(tp, timeout=timeout, cached=False)
+            committed = tp.offset if tp.offset >= 0 else low
+            lag[(tp.topic, tp.partition)] = max(high - committed, 0)
+        return lag
+
+
+class OffsetTracker:
+    """Track the messages being processed, to only commit offsets that are safe to commit
+
+    Messages of a partition may finish out of order (e.g. with several
+    writer threads). The committable offset of a partition only moves past
+    a message once it, and all the messages before it, are done, so that
+    nothing is skipped if the process dies.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pending: Dict[Partition, collections.deque] = {}
+        self._done: Dict[Partition, set] = {}
+        self._committable: Dict[Partition, int] = {}
+
+    def add(self, topic: str, partition: int, offset: int) -> None:
+        """Record a message that was received. Offsets must increase within a partition."""
+        with self._lock:
+            self._pending.setdefault((topic, partition), collections.deque()).append(offset)
+
+    def done(self, topic: str, partition: int, offset: int) -> None:
+        """Record that a message has been processed"""
+        key = (topic, partition)
+        with self._lock:
+            done = self._done.setdefault(key, set())
+            done.add(offset)
+            pending = self._pending.get(key)
+            while pending and pending[0] in done:
+                last = pending.popleft()
+                done.discard(last)
+                self._committable[key] = last + 1
+
+    def pop_committable(self) -> Dict[Partition, int]:
+        """Return the offsets that can be committed since the last call, keyed by (topic, partition)"""
+        with self._lock:
+            committable, self._committable = self._committable, {}
+        return committable
+
+    def num_pending(self) -> int:
+        """Number of messages received but not processed yet"""
+        with self._lock:
+            return sum(len(offsets) for offsets in self._pending.values())
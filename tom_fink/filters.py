@@ -0,0 +1,137 @@
+# Copyright (c) 2025 Julien Peloton
+#
+# This file is part of TOM Toolkit
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""Cuts on the fields of stream alerts, to drop alerts before they reach the handlers"""
+import math
+import threading
+from typing import Any, Callable, Dict, List
+
+from django.core.exceptions import ImproperlyConfigured
+
+# operators of the cuts: numerical bounds (inclusive) and sets of allowed or rejected values
+NUMERICAL_OPERATORS = ("min", "max")
+SET_OPERATORS = ("in", "not_in")
+
+
+def get_field(alert: Dict[str, Any], field: str) -> Any:
+    """Return `field` from the `candidate` of an alert, or else from the alert itself
+    (e.g. the Fink classification scores), or None if there is none."""
+    candidate = alert.get("candidate") or {}
+    if field in candidate:
+        return candidate[field]
+    return alert.get(field)
+
+
+def compile_cut(cut: Dict[str, Any]) -> Callable[[Any], bool]:
+    """Return a function telling whether a value passes `cut` (see `AlertFilter`)"""
+    numerical = any(operator in cut for operator in NUMERICAL_OPERATORS)
+    low = cut.get("min", -math.inf)
+    high = cut.get("max", math.inf)
+    allowed = {str(value) for value in cut["in"]} if "in" in cut else None
+    rejected = {str(value) for value in cut.get("not_in", ())}
+
+    def passes(value: Any) -> bool:
+        if value is None:
+            return False
+        if numerical:
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                return False
+            # comparisons with NaN are False: alerts without a value fail the cut
+            if not low <= number <= high:
+                return False
+        if allowed is not None or rejected:
+            label = str(value)
+            if allowed is not None and label not in allowed:
+                return False
+            if label in rejected:
+                return False
+        return True
+
+    return passes
+
+
+class AlertFilter:
+    """Filter alerts with cuts on their fields
+
+    The cuts are compiled once into plain Python tests, applied one after
+    the other, each to the alerts that passed the previous ones. Stream
+    alerts are decoded one by one into dicts (see
+    `tom_fink.consumer.FinkConsumer`), so there are no columns to evaluate
+    the cuts on: gathering the values into arrays first would only add a
+    copy per alert. An alert passes if it passes all cuts. Alerts without
+    a value for a field (None or NaN) fail the cuts on it.
+
+    Parameters
+    ----------
+    cuts: dict
+        Cuts keyed by field name, e.g.
+        {
+            'magpsf': {'max': 19.5},
+            'drb': {'min': 0.5},
+            'ndethist': {'min': 2},
+            'rf_snia_vs_nonia': {'min': 0.5},
+            'cdsxmatch': {'in': ['Unknown', 'Candidate_SN*']},
+        }
+        Numerical bounds ('min', 'max') are inclusive. Fields are looked up
+        in the `candidate` of the alert, then in the alert itself.
+
+    Raises
+    ------
+    ImproperlyConfigured
+        If a cut has an unknown operator.
+    """
+
+    def __init__(self, cuts: Dict[str, Dict[str, Any]]) -> None:
+        for field, cut in cuts.items():
+            unknown = set(cut) - set(NUMERICAL_OPERATORS + SET_OPERATORS)
+            if unknown or not cut:
+                raise ImproperlyConfigured(
+                    f"Invalid cut on {field}: {cut}. "
+                    f"Use the operators {NUMERICAL_OPERATORS + SET_OPERATORS}."
+                )
+        self.cuts = cuts
+        self._tests = [(field, compile_cut(cut)) for field, cut in cuts.items()]
+
+        self._lock = threading.Lock()
+        self._seen = 0
+        self._passed = 0
+
+    def select(self, alerts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Return the alerts that pass all cuts, in their original order, without counting them"""
+        for field, passes in self._tests:
+            alerts = [alert for alert in alerts if passes(get_field(alert, field))]
+        return alerts
+
+    def apply(self, alerts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Return the alerts that pass all cuts, in their original order"""
+        if not alerts:
+            return []
+        passed = self.select(alerts)
+        with self._lock:
+            self._seen += len(alerts)
+            self._passed += len(passed)
+        return passed
+
+    def stats(self) -> Dict[str, float]:
+        """Return the number of alerts seen and passed, and the rejection rate"""
+        with self._lock:
+            return {
+                "seen": self._seen,
+                "passed": self._passed,
+                "rejection_rate": 1 - self._passed / self._seen if self._seen else 0.0,
+            }
@@ -15,22 +15,37 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import datetime
+import functools
 import logging
-from typing import Any, Dict, List
+import threading
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
 
+from asgiref.sync import sync_to_async
 from django import forms
+from django.db import IntegrityError, transaction
+from django.db.models import Max
+from django.utils.functional import lazy
 
 from tom_dataproducts.models import PhotometryReducedDatum
-from tom_dataservices.dataservices import DataService, QueryServiceError
+from tom_dataservices.dataservices import DataService, NotConfiguredError, QueryServiceError
 from tom_dataservices.forms import BaseQueryForm
 from tom_fink import __version__ as fink_version
+from tom_fink.cache import (
+    DEFAULT_CACHE_ALIAS, DEFAULT_REFRESH_HOUR_UTC, DEFAULT_RESULT_TIMEOUT, MAX_RESULT_ENTRY_SIZE, MAX_RESULT_QUERY_SIZE,
+    FinkQueryCache, QueryResultStore
+)
+from tom_fink.instrumentation import Instrumentation, instrumentation, instrumented
 from tom_targets.models import Target
+from tom_targets.sharing import continuous_share_data
 
-from astropy.time import Time, TimezoneInfo
 from crispy_forms.layout import HTML, Layout
-import markdown as md
-import numpy as np
-import requests
+
+# numpy, astropy, requests (through tom_fink.client and tom_fink.columnar) and markdown
+# are imported on first use, so that importing this module stays cheap
+if TYPE_CHECKING:
+    from tom_fink.client import FinkClient
 
 logger = logging.getLogger(__name__)
 # logger.setLevel(logging.DEBUG)
@@ -38,8 +53,77 @@ logger = logging.getLogger(__name__)
 FINK_URL = "https://fink-broker.org/"
 FINK_API_URL = "https://api.ztf.fink-portal.org"
 FINK_REPO_URL = "https://github.com/TOMToolkit/tom_fink"
+# columns of the alerts of an object, kept in the value of its photometry
+OBJECT_COLUMNS = "i:candid,d:rf_snia_vs_nonia,i:ra,i:dec,i:jd,i:fid,i:magpsf,i:objectId,d:cdsxmatch"
 SSO_COLUMNS = "i:ssnamenr,i:candid,i:ra,i:dec,i:jd,i:magpsf,i:objectId,d:roid"
 
+# ZTF filter ID to bandpass
+FILTER_NAMES = {1: 'g', 2: 'R', 3: 'i'}
+
+# Rows per INSERT in bulk_create_photometry
+BULK_CREATE_BATCH_SIZE = 500
+# Alerts of each object whose positions and magnitudes are kept for the medians of a streamed
+# query_targets (see summarize_alert_stream)
+MAX_MEDIAN_SAMPLES = 100
+# Targets whose photometry watermark is kept in memory (see get_photometry_watermark)
+MAX_PHOTOMETRY_WATERMARKS = 100_000
+
+# DATA_SERVICES['Fink'] keys passed on to the FinkClient
+CLIENT_OPTIONS = [
+    "pool_size",
+    "timeouts",
+    "read_timeout",
+    "connect_timeout",
+    "max_retries",
+    "backoff_factor",
+    "backoff_jitter",
+    "gzip",
+    "max_requests_per_second",
+]
+
+
+@functools.lru_cache(maxsize=None)
+def render_markdown(text: str) -> str:
+    """Render a Markdown text to HTML, once per text"""
+    import markdown
+
+    return markdown.markdown(text)
+
+
+# help texts are rendered when a form is first displayed, instead of when this module is imported
+lazy_markdown = lazy(render_markdown, str)
+
+
+def jd_to_datetimes(jds) -> List[datetime.datetime]:
+    """Convert a sequence of Julian dates (UTC) to timezone-aware datetimes.
+
+    This gives the same values as `Time(jd, format='jd', scale='utc').to_datetime(TimezoneInfo())`
+    for each date, but the calendar conversion is done once for the whole array.
+    """
+    if len(jds) == 0:
+        return []
+    from astropy.time import Time, TimezoneInfo
+    import erfa
+    import numpy as np
+
+    times = Time(np.asarray(jds, dtype=float), format='jd', scale='utc')
+    # 6 for microseconds, as in astropy's TimeDatetime
+    years, months, days, hmsf = erfa.d2dtf(b'UTC', 6, times.jd1, times.jd2)
+    utc = TimezoneInfo()
+    datetimes = []
+    for year, month, day, hour, minute, second, microsecond in zip(
+        years.tolist(), months.tolist(), days.tolist(),
+        hmsf['h'].tolist(), hmsf['m'].tolist(), hmsf['s'].tolist(), hmsf['f'].tolist()
+    ):
+        if second >= 60:
+            # datetime cannot represent a leap second: move to the next second
+            timestamp = datetime.datetime(year, month, day, hour, minute, 59, microsecond, tzinfo=utc)
+            timestamp += datetime.timedelta(seconds=1)
+        else:
+            timestamp = datetime.datetime(year, month, day, hour, minute, second, microsecond, tzinfo=utc)
+        datetimes.append(timestamp)
+    return datetimes
+
 
 class FinkServiceForm(BaseQueryForm):
     """Class to organise the Query Form for Fink.
@@ -58,7 +142,7 @@ class FinkServiceForm(BaseQueryForm):
         required=False,
         label="ZTF Object ID",
         widget=forms.TextInput(attrs={"placeholder": "enter a valid ZTF object ID"}),
-        help_text=md.markdown(help_objectid),
+        help_text=lazy_markdown(help_objectid),
     )
 
     help_conesearch = """
@@ -75,20 +159,20 @@ class FinkServiceForm(BaseQueryForm):
     conesearch = forms.CharField(
         required=False,
         label="Cone Search",
-        help_text=md.markdown(help_conesearch),
+        help_text=lazy_markdown(help_conesearch),
         widget=forms.TextInput(attrs={"placeholder": "RA, Dec, radius"}),
     )
 
     # ra = forms.CharField(
     #     required=False,
     #     label="RA",
-    #     help_text=md.markdown(help_conesearch),
+    #     help_text=lazy_markdown(help_conesearch),
     # )
 
     # dec = forms.CharField(
     #     required=False,
     #     label="Dec",
-    #     help_text=md.markdown(help_conesearch),
+    #     help_text=lazy_markdown(help_conesearch),
     # )
 
     # radius = forms.FloatField(
@@ -111,7 +195,7 @@ class FinkServiceForm(BaseQueryForm):
     classsearch = forms.CharField(
         required=False,
         label="Class Search by number",
-        help_text=md.markdown(help_classsearch),
+        help_text=lazy_markdown(help_classsearch),
         widget=forms.TextInput(attrs={"placeholder": "class, n_alert"}),
     )
 
@@ -125,7 +209,7 @@ class FinkServiceForm(BaseQueryForm):
     classsearchdate = forms.CharField(
         required=False,
         label="Class Search by date",
-        help_text=md.markdown(help_classsearchdate),
+        help_text=lazy_markdown(help_classsearchdate),
         widget=forms.TextInput(attrs={"placeholder": "class, n_days_in_past"}),
     )
 
@@ -154,7 +238,7 @@ class FinkServiceForm(BaseQueryForm):
     # ssosearch = forms.CharField(
     #     required=False,
     #     label="Solar System Objects Search",
-    #     help_text=md.markdown(help_ssosearch),
+    #     help_text=lazy_markdown(help_ssosearch),
     #     widget=forms.TextInput(attrs={"placeholder": "sso_name"}),
     # )
 
@@ -179,6 +263,43 @@ class FinkDataService(DataService):
     """
     Fink Dataservice:
     Pulls in fink alerts for targets, creating a combined target with data based on each alert.
+
+    No configuration is required, but the HTTP client can be tuned in settings.py:
+
+        DATA_SERVICES = {
+            'Fink': {
+                'pool_size': 10,  # connections kept alive to the Fink API
+                'timeouts': {'objects': 60, 'conesearch': 60, 'latests': 120},  # read timeouts (s)
+                'read_timeout': 60,  # read timeout of the other endpoints (s)
+                'connect_timeout': 10,
+                'max_retries': 3,  # retries on 429/5xx, with jittered exponential backoff
+                'backoff_factor': 0.5,
+                'backoff_jitter': 0.5,
+                'gzip': True,
+                'max_requests_per_second': None,  # global limit on the request rate of all threads
+                'batch_size': 50,  # objectIds per request in query_photometry_batch
+                'cache_enabled': True,  # cache responses until the next Fink database update
+                'cache_alias': 'fink',  # cache in settings.CACHES to use (a private local-memory one if missing)
+                'cache_refresh_hour': 14,  # hour (UTC) of the daily Fink database update
+                'cache_timeout': None,  # fixed lifetime of the entries in seconds, instead
+                'store_query_results': True,  # keep the alerts of query_targets server-side (see get_result_store)
+                'result_timeout': 3600,  # lifetime of the stored query results in seconds
+                'result_max_entry_size': 1000000,  # larger results of an object stay in the rows (bytes)
+                'result_max_query_size': 50000000,  # results of a query past this total stay in the rows (bytes)
+                'stream_responses': False,  # decode large responses incrementally
+                'columnar': False,  # transfer query_targets results as Parquet (requires pyarrow)
+                'bulk_ingest': False,  # insert new photometry with bulk_create (see bulk_create_photometry)
+                'incremental_sync': False,  # only ingest alerts more recent than the latest Fink photometry
+                'metrics_token': None,  # bearer token of the /fink/metrics/ endpoint (staff users only if unset)
+                'instrumentation': {  # timing spans of the query and ingestion stages (see get_instrumentation)
+                    'enabled': False,
+                    'log_spans': False,  # log each span as a JSON line
+                    'profile_threshold': None,  # dump the cProfile stats of top-level calls slower than this (s)
+                    'profile_sample_rate': 0.1,  # fraction of the top-level calls that are profiled
+                    'profile_dir': None,  # default: MEDIA_ROOT/fink_profiles
+                },
+            },
+        }
     """
     name = 'Fink'
     app_version = fink_version
@@ -186,6 +307,22 @@ class FinkDataService(DataService):
     info_url = FINK_URL
     base_url = FINK_API_URL + '/api/v1/'
 
+    # HTTP client, response cache and query result store shared by all instances
+    # (see get_client, get_cache and get_result_store)
+    _client = None
+    _cache = None
+    _result_store = None
+    _instrumentation_configured = False
+    _shared_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.get_instrumentation()
+        # latest timestamp of the Fink photometry of each target, keyed by Target pk, least recently used first
+        # (see get_photometry_watermark)
+        self.photometry_watermarks: Dict[int, Optional[datetime.datetime]] = collections.OrderedDict()
+        self._watermarks_lock = threading.Lock()
+
     @classmethod
     def get_form_class(cls):
         """
@@ -193,6 +330,103 @@ class FinkDataService(DataService):
         """
         return FinkServiceForm
 
+    @classmethod
+    def get_configuration(cls, config_type=None, value=None, **kwargs):
+        """
+        Fink does not require a DATA_SERVICES entry, so fall back on the default `value`
+        instead of raising NotConfiguredError when there is none.
+        """
+        try:
+            return super().get_configuration(config_type, value, **kwargs)
+        except NotConfiguredError:
+            return value
+
+    @classmethod
+    def get_client(cls) -> "FinkClient":
+        """
+        Return the connection-pooled FinkClient shared by every query path.
+        It is created on first use from the DATA_SERVICES['Fink'] configuration.
+        """
+        with cls._shared_lock:
+            if cls._client is None:
+                from tom_fink.client import FinkClient
+
+                options = {}
+                for option in CLIENT_OPTIONS:
+                    value = cls.get_configuration(option)
+                    if value is not None:
+                        options[option] = value
+                cls._client = FinkClient(cls.base_url, **options)
+            return cls._client
+
+    @classmethod
+    def get_client_stats(cls) -> Dict[str, float]:
+        """
+        Return the request and connection reuse counters of the shared client.
+        """
+        return cls.get_client().stats()
+
+    @classmethod
+    def get_cache(cls) -> Optional[FinkQueryCache]:
+        """
+        Return the FinkQueryCache shared by every query path, or None if the
+        DATA_SERVICES['Fink']['cache_enabled'] setting is False.
+        """
+        if not cls.get_configuration('cache_enabled', True):
+            return None
+        with cls._shared_lock:
+            if cls._cache is None:
+                cls._cache = FinkQueryCache(
+                    alias=cls.get_configuration('cache_alias', DEFAULT_CACHE_ALIAS),
+                    timeout=cls.get_configuration('cache_timeout'),
+                    refresh_hour=cls.get_configuration('cache_refresh_hour', DEFAULT_REFRESH_HOUR_UTC),
+                )
+            return cls._cache
+
+    @classmethod
+    def get_result_store(cls) -> Optional[QueryResultStore]:
+        """
+        Return the QueryResultStore in which `query_targets` keeps the alerts of its results,
+        in the cache of the 'cache_alias' setting, or None if the
+        DATA_SERVICES['Fink']['store_query_results'] setting is False.
+        """
+        if not cls.get_configuration('store_query_results', True):
+            return None
+        with cls._shared_lock:
+            if cls._result_store is None:
+                cls._result_store = QueryResultStore(
+                    alias=cls.get_configuration('cache_alias', DEFAULT_CACHE_ALIAS),
+                    timeout=cls.get_configuration('result_timeout', DEFAULT_RESULT_TIMEOUT),
+                    max_entry_size=cls.get_configuration('result_max_entry_size', MAX_RESULT_ENTRY_SIZE),
+                    max_query_size=cls.get_configuration('result_max_query_size', MAX_RESULT_QUERY_SIZE),
+                )
+            return cls._result_store
+
+    @classmethod
+    def get_instrumentation(cls) -> Instrumentation:
+        """
+        Return the Instrumentation shared by FinkDataService and FinkAlertStream, configured
+        on first use from the DATA_SERVICES['Fink']['instrumentation'] setting (a dict of
+        `Instrumentation` options, or True to only enable the timing spans).
+        """
+        with cls._shared_lock:
+            if not cls._instrumentation_configured:
+                options = cls.get_configuration('instrumentation')
+                if options is True:
+                    options = {'enabled': True}
+                if options:
+                    instrumentation.configure(**options)
+                cls._instrumentation_configured = True
+        return instrumentation
+
+    @classmethod
+    def get_cache_stats(cls) -> Dict[str, int]:
+        """
+        Return the hit and miss counters of the response cache.
+        """
+        cache = cls.get_cache()
+        return cache.stats() if cache is not None else {'hits': 0, 'misses': 0}
+
     def build_query_parameters(self, form_output, **kwargs):
         """
         Use this function to convert the form results into the query parameters understood
@@ -209,7 +443,7 @@ class FinkDataService(DataService):
         ]
 
         # first, check that one and only one search field is filled out
-        nquery = np.sum([len(form_output[i].strip()) > 0 for i in allowed_search])
+        nquery = sum(len(form_output[i].strip()) > 0 for i in allowed_search)
         if nquery > 1:
             msg = """
             You must fill only one query form at a time! Edit your query to choose
@@ -232,6 +466,8 @@ class FinkDataService(DataService):
                 parameters['class'], parameters['n'] = form_output["classsearch"].split(",")
             if form_output["classsearchdate"].strip():
                 parameters['class'], n_days_in_past = form_output["classsearchdate"].split(",")
+                from astropy.time import Time
+
                 now = Time.now()
                 parameters['start'] = Time(now.jd - float(n_days_in_past), format="jd").iso
                 parameters['end'] = now.iso
@@ -245,6 +481,7 @@ class FinkDataService(DataService):
         self.query_parameters = parameters
         return self.query_parameters
 
+    @instrumented('query_service')
     def query_service(self, parameters, **kwargs):  # type:ignore
         """Call the Fink API based on parameters from the Query Form.
 
@@ -253,6 +490,17 @@ class FinkDataService(DataService):
         parameters: dict
             Dictionary that contains query parameters defined in the Form
             Possible key/combinations: [objectId], [ra, dec, radius], [class, n, (start, end)]
+        use_cache: bool, optional
+            If False, ignore the cached response (if any) and query Fink.
+            Default is True.
+        stream: bool, optional
+            If True, return an iterator that decodes the alerts while the response
+            is downloaded, instead of a list. Streamed responses are not cached and
+            `query_results` is left untouched. Defaults to the
+            DATA_SERVICES['Fink']['stream_responses'] setting (False if unset).
+        columnar: bool, optional
+            If True, ask Fink for a Parquet response and return it as a `pyarrow.Table`
+            (requires pyarrow). Default is False.
 
         Returns
         -------
@@ -260,38 +508,28 @@ class FinkDataService(DataService):
             Iterable on alert data (list of dictionary). Alert data is in
             the form {column name: value}.
         """
-        COLUMNS = "i:candid,d:rf_snia_vs_nonia,i:ra,i:dec,i:jd,i:fid,i:magpsf,i:objectId,d:cdsxmatch"
-
         if parameters.get("objectId"):
             # object search
-            response = requests.post(
-                self.base_url + "objects",
-                json={"objectId": parameters["objectId"], "columns": COLUMNS}, timeout=60
-            )
+            endpoint = "objects"
+            payload = {"objectId": parameters["objectId"], "columns": OBJECT_COLUMNS}
         elif parameters.get("ra") and parameters.get("dec") and parameters.get("radius"):
             # cone search
-            response = requests.post(
-                self.base_url + "conesearch",
-                json={"ra": parameters['ra'], "dec": parameters['dec'], "radius": parameters['radius']},
-            )
+            endpoint = "conesearch"
+            payload = {"ra": parameters['ra'], "dec": parameters['dec'], "radius": parameters['radius']}
         elif parameters.get("class"):
             # class search (at present, not in Form layout above)
-            json_dict = {"class": parameters['class'],
-                         "n": parameters.get('n', 1000),
-                         }
+            endpoint = "latests"
+            payload = {"class": parameters['class'],
+                       "n": parameters.get('n', 1000),
+                       }
             if parameters.get('start') and parameters.get('end'):
-                json_dict["startdate"] = parameters['start']
-                json_dict["stopdate"] = parameters['end']
-            response = requests.post(
-                self.base_url + "latests", json=json_dict
-            )
+                payload["startdate"] = parameters['start']
+                payload["stopdate"] = parameters['end']
         # Remove SSO process until proper features added.
         # elif len(parameters["ssosearch"].strip()) > 0:
         #     # SSO search
-        #     response = requests.post(
-        #         FINK_API_URL + "/api/v1/sso",
-        #         json={"n_or_d": parameters["ssosearch"].strip(), "columns": SSO_COLUMNS},
-        #     )
+        #     endpoint = "sso"
+        #     payload = {"n_or_d": parameters["ssosearch"].strip(), "columns": SSO_COLUMNS}
         else:
             msg = """
             You need to enter one of the query field! Choose among:
@@ -300,16 +538,157 @@ class FinkDataService(DataService):
             """
             raise QueryServiceError(msg)
 
-        response.raise_for_status()
-        data = response.json()
+        if kwargs.get('columnar'):
+            from tom_fink import columnar
+
+            payload["output-format"] = columnar.OUTPUT_FORMAT
+            stream = False
+        else:
+            stream = kwargs.get('stream', self.get_configuration('stream_responses', False))
+        data = self.fetch(endpoint, payload, use_cache=kwargs.get('use_cache', True), stream=stream)
+        if stream:
+            return data
 
         self.query_results = data
         return data
 
+    def fetch(self, endpoint: str, payload: Dict[str, Any], use_cache: bool = True, stream: bool = False):
+        """POST `payload` to the Fink API `endpoint` and return the decoded JSON response.
+
+        Responses are cached until the next Fink database update (see `get_cache`), except
+        those of queries relative to the current time (see `FinkQueryCache.cacheable`).
+        With `use_cache=False` the cached response is ignored and replaced by a fresh one.
+        With `stream=True` an iterator on the items of the JSON array is returned; they are
+        decoded chunk by chunk as the response is downloaded, and not cached.
+        """
+        cache = self.get_cache()
+        if cache is not None and not cache.cacheable(payload):
+            cache = None
+        if cache is not None and use_cache:
+            hit, data = cache.get(endpoint, payload)
+            if hit:
+                logger.debug(f'fetch -- cache hit for {endpoint}: {payload}')
+                return iter(data) if stream else data
+
+        with instrumentation.span('fetch.request', endpoint=endpoint):
+            response = self.get_client().post(endpoint, json=payload, stream=stream)
+            response.raise_for_status()
+        if stream:
+            return self._iter_stream(response)
+        with instrumentation.span('fetch.decode', endpoint=endpoint) as span:
+            # only columnar queries set an output format
+            if "output-format" in payload:
+                from tom_fink import columnar
+
+                try:
+                    data = columnar.read_parquet(response.content)
+                except ImportError as e:
+                    raise QueryServiceError(str(e))
+            else:
+                data = response.json()
+            if instrumentation.enabled:
+                span.set(rows=len(data), bytes=len(response.content))
+
+        if cache is not None:
+            cache.set(endpoint, payload, data)
+        return data
+
+    def _iter_stream(self, response):
+        """Yield the alerts of a streamed response, reporting malformed bodies as QueryServiceError."""
+        from tom_fink.client import iter_response_items
+
+        try:
+            yield from iter_response_items(response)
+        except ValueError as e:
+            raise QueryServiceError(f'Unexpected response from {self.name}: {e}')
+
+    @staticmethod
+    def group_alerts_by_target(alerts) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Reorganize an iterable of alerts into a target_name-keyed Dict of target-specific List[alert]
+        (i.e. convert query_results: List[Alert] to alerts_for_target: Dict[target_name, List[alert]]).
+        The alerts are consumed one at a time, so `alerts` can be a streamed response.
+        """
+        alerts_for_target: Dict[str, List[Dict[str, Any]]] = {}  # Dict[target_name, List[alert]]
+        for alert in alerts:
+            target_name = alert['i:objectId']  # will become dict key; value will be List[alert]
+            # get (or create) the list of alerts for this target_name
+            alerts_for_target.setdefault(target_name, []).append(alert)
+        return alerts_for_target
+
+    @staticmethod
+    def summarize_alert_stream(alerts) -> List[Dict[str, Any]]:
+        """
+        Return the rows of the target selection table of `query_targets` for an iterable of alerts
+        (e.g. a streamed response), reducing the alerts of each object as they arrive, so that
+        memory is bounded by the number of objects rather than the number of alerts. The medians
+        of each object are those of its first MAX_MEDIAN_SAMPLES alerts (the most recent ones,
+        in the order of the Fink responses). The alerts are not kept, so the rows have no
+        'reduced_datums': the photometry of the targets created from them is queried again
+        (see `DataService.query_reduced_data`).
+        """
+        import numpy as np
+
+        # [num_alerts, jd_min, jd_max, ra samples, dec samples, mag samples] of each object
+        summaries: Dict[str, List[Any]] = {}
+        for alert in alerts:
+            summary = summaries.get(alert['i:objectId'])
+            if summary is None:
+                summary = summaries[alert['i:objectId']] = [0, alert['i:jd'], alert['i:jd'], [], [], []]
+            summary[0] += 1
+            summary[1] = min(summary[1], alert['i:jd'])
+            summary[2] = max(summary[2], alert['i:jd'])
+            if summary[0] <= MAX_MEDIAN_SAMPLES:
+                summary[3].append(alert['i:ra'])
+                summary[4].append(alert['i:dec'])
+                summary[5].append(alert['i:magpsf'])
+        return [
+            {
+                'name': target_name,
+                'ra': float(np.median(ras)),
+                'dec': float(np.median(decs)),
+                'mag': float(np.median(mags)),
+                'jd_min': float(jd_min),
+                'jd_max': float(jd_max),
+                'num_alerts': num_alerts,
+            }
+            for target_name, (num_alerts, jd_min, jd_max, ras, decs, mags) in summaries.items()
+        ]
+
+    #
+    # Async API
+    #
+
+    async def aquery_service(self, parameters, **kwargs):
+        """Async counterpart of `query_service`, for ASGI views and asyncio jobs.
+
+        This is not native async I/O: `query_service` runs with the blocking requests client
+        on a thread of the event loop's default executor (`sync_to_async(thread_sensitive=False)`),
+        which it occupies until the response has been received and decoded. The event loop itself
+        is free meanwhile, but the number of queries in flight is bounded by the size of that
+        executor (and of the connection pool of the client). Streamed responses are decoded on
+        that thread too, and returned as a list. Queries awaited concurrently should use separate
+        FinkDataService instances, since each one keeps its own `query_results`.
+        """
+        def query_service():
+            data = self.query_service(parameters, **kwargs)
+            return data if isinstance(data, list) or kwargs.get('columnar') else list(data)
+
+        return await sync_to_async(query_service, thread_sensitive=False)()
+
+    async def aquery_targets(self, query_parameters, **kwargs) -> List[Dict[str, Any]]:
+        """Async counterpart of `query_targets`. See `aquery_service`."""
+        return await sync_to_async(self.query_targets, thread_sensitive=False)(query_parameters, **kwargs)
+
+    async def aquery_photometry(self, query_parameters, **kwargs) -> List[Dict[str, Any]]:
+        """Async counterpart of `query_photometry`. See `aquery_service`."""
+        return await sync_to_async(self.query_photometry, thread_sensitive=False)(query_parameters, **kwargs)
+
     #
     # Targets
     #
 
+    @instrumented('query_targets')
     def query_targets(self, query_parameters, **kwargs) -> List[Dict[str, Any]]:
         """Return a List[Dict] of Target data. Each List element becomes a row in the
         selectable target create table. Each Dict item becomes a column in the table.
@@ -329,22 +708,37 @@ class FinkDataService(DataService):
            'i:candid': 3297294755815010006,
         }
 
+        With `columnar=True` (or the DATA_SERVICES['Fink']['columnar'] setting), the alerts are
+        transferred as Parquet and the rows are computed on whole columns (see `tom_fink.columnar`).
+
+        The alerts of each object are kept server-side, and the 'reduced_datums' of its row only
+        refer to them (see `store_query_results`). Streamed responses (see `query_service`) are
+        summarized as they are read instead, without keeping the alerts (see `summarize_alert_stream`).
         """
         logger.debug(f'query_targets -- query_parameters: {query_parameters}')
 
+        if kwargs.pop('columnar', self.get_configuration('columnar', False)):
+            from tom_fink import columnar
+
+            query_results = self.query_service(query_parameters, columnar=True, **kwargs)
+            return self.store_query_results(columnar.summarize_alerts(query_results))
+
         # query Fink via query_service,
         query_results = self.query_service(query_parameters, **kwargs)
         logger.debug(f'query_targets -- query_results: {query_results}')
+        if not isinstance(query_results, list):
+            # a streamed response (unless it came from the cache)
+            with instrumentation.span('query_targets.group') as span:
+                rows = self.summarize_alert_stream(query_results)
+                span.set(rows=len(rows))
+            return rows
 
         # Reorganize the List[alert] into a target_name-keyed Dict of target-specific List[alert]
-        # (i.e. convert query_results: List[Alert] to alerts_for_target: Dict[target_name, List[alert]])
-        alerts_for_target: Dict[str, List[Dict[str, Any]]] = {}  # Dict[target_name, List[alert]]
-        for alert in query_results:
-            target_name = alert['i:objectId']  # will become dict key; value will be List[alert]
+        with instrumentation.span('query_targets.group') as span:
+            alerts_for_target = self.group_alerts_by_target(query_results)
+            span.set(rows=len(alerts_for_target))
 
-            alerts = alerts_for_target.get(target_name, [])  # get (or create) the list of alerts for this target_name
-            alerts.append(alert)
-            alerts_for_target[target_name] = alerts
+        import numpy as np
 
         # Create the List of targets to be offered to the User for actual Target creation.
         targets_for_selection_table = []
@@ -369,7 +763,47 @@ class FinkDataService(DataService):
             }
             targets_for_selection_table.append(target_table_row)
 
-        return targets_for_selection_table
+        return self.store_query_results(targets_for_selection_table)
+
+    def store_query_results(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Move the alerts of the rows of the target selection table to the result store
+        (see `get_result_store`), under a new query id, and replace them with a reference
+        ({'query_id': ..., 'objectId': ...}), so that the rows cached by the views stay small.
+        `create_reduced_datums_from_query` loads the alerts of the selected targets back.
+        The alerts that the store did not keep (see `QueryResultStore.save`) stay in their row.
+
+        :param rows: The rows built by `query_targets`, with the alerts of each object
+        in `row['reduced_datums']['photometry']`
+        :return: The same rows, modified in place
+        """
+        store = self.get_result_store()
+        if store is None or not rows:
+            return rows
+        query_id, stored = store.save({row['name']: row['reduced_datums']['photometry'] for row in rows})
+        for row in rows:
+            # the alerts that could not be stored stay in the row
+            if row['name'] in stored:
+                row['reduced_datums'] = {'photometry': store.reference(query_id, row['name'])}
+        logger.debug(f'store_query_results -- {len(stored)}/{len(rows)} objects stored as query {query_id}')
+        return rows
+
+    def load_query_result(self, reference: Dict[str, str]) -> List[Dict[str, Any]]:
+        """
+        Return the alerts of an object of a `query_targets` result (see `store_query_results`).
+
+        If they have expired, the alerts of the object are queried again from Fink.
+
+        :param reference: {'query_id': ..., 'objectId': ...}
+        :return: List[alert]
+        """
+        query_id, objectId = reference['query_id'], reference['objectId']
+        store = self.get_result_store()
+        alerts = store.load(query_id, objectId) if store is not None else None
+        if alerts is None:
+            logger.info(f'load_query_result -- results of query {query_id} expired, querying {objectId} again')
+            return self.query_photometry({'objectId': objectId})
+        return alerts
 
     def create_target_from_query(self, target_result: Dict[str, Any], **kwargs) -> Target:
         """
@@ -432,6 +866,7 @@ class FinkDataService(DataService):
     # Photometry
     #
 
+    @instrumented('query_photometry')
     def query_photometry(self, query_parameters, **kwargs):
         """
         Query data service for photometry data
@@ -445,49 +880,191 @@ class FinkDataService(DataService):
         query_results = self.query_service(query_parameters, **kwargs)
         logger.debug(f'query_photometry -- query_results: {query_results}')
 
-        alerts_for_target: Dict[str, List[Dict[str, Any]]] = {}  # Dict[target_name, List[alert]]
-        for alert in query_results:
-            target_name = alert['i:objectId']  # will become dict key; value will be List[alert]
-
-            alerts = alerts_for_target.get(target_name, [])  # get (or create) the list of alerts for this target_name
-            alerts.append(alert)
-            alerts_for_target[target_name] = alerts
+        alerts_for_target = self.group_alerts_by_target(query_results)
 
         # There should only one key,value pair in alert_for_target (i.e. only one target with it's alerts)
         if len(alerts_for_target.items()) != 1:
             raise QueryServiceError(f'Too many targets returned from {self.name}')
 
-        return query_results
+        # return the List[alert] of that target (query_results may have been a streamed iterator)
+        return next(iter(alerts_for_target.values()))
+
+    def query_photometry_batch(self, targets, batch_size=None, **kwargs) -> Dict[Target, List[Dict[str, Any]]]:
+        """
+        Query photometry for many targets at once.
+
+        The ZTF objectIds of the targets are packed into comma-separated multi-object
+        requests of at most `batch_size` objects, and the alerts of each response are
+        split back by `i:objectId`. Targets without a ZTF name or alias are skipped
+        with a warning.
+
+        :param targets: Iterable of Target objects
+        :param batch_size: Maximum number of objectIds per request. Defaults to the
+            DATA_SERVICES['Fink']['batch_size'] setting (50 if unset).
+        :return: Dict of target-specific List[alert], keyed by Target
+        """
+        if batch_size is None:
+            batch_size = self.get_configuration('batch_size', 50)
 
+        targets_for_objectid = self.resolve_objectids(targets)
+        alerts_for_target: Dict[Target, List[Dict[str, Any]]] = {
+            target: [] for target in targets_for_objectid.values()
+        }
+        objectIds = list(targets_for_objectid)
+        for start in range(0, len(objectIds), batch_size):
+            chunk = objectIds[start:start + batch_size]
+            query_results = self.query_service({'objectId': ','.join(chunk)}, **kwargs)
+            num_alerts = 0
+            for alert in query_results:
+                num_alerts += 1
+                target = targets_for_objectid.get(alert['i:objectId'])
+                if target is not None:
+                    alerts_for_target[target].append(alert)
+            logger.debug(f'query_photometry_batch -- {len(chunk)} objects, {num_alerts} alerts')
+
+        return alerts_for_target
+
+    def resolve_objectids(self, targets) -> Dict[str, Target]:
+        """
+        Return the targets keyed by their ZTF objectId (see `build_query_parameters_from_target`).
+        Targets without a ZTF name or alias are skipped with a warning.
+        """
+        targets_for_objectid: Dict[str, Target] = {}
+        for target in targets:
+            try:
+                objectId = self.build_query_parameters_from_target(target)['objectId']
+            except QueryServiceError as e:
+                logger.warning(f'resolve_objectids -- skipping target: {e}')
+                continue
+            targets_for_objectid[objectId] = target
+        return targets_for_objectid
+
+    def to_reduced_datums_batch(self, targets, batch_size=None, **kwargs) -> Dict[Target, List]:
+        """
+        Refresh the Fink photometry of many targets with a few multi-object requests.
+        See `query_photometry_batch`.
+
+        :param targets: Iterable of Target objects
+        :param batch_size: Maximum number of objectIds per request
+        :return: Dict of the reduced datums created (or retrieved) for each Target
+        """
+        alerts_for_target = self.query_photometry_batch(targets, batch_size=batch_size, **kwargs)
+        incremental = kwargs.get('incremental', self.get_configuration('incremental_sync', False))
+        if incremental and not kwargs.get('full_resync', False):
+            self.load_photometry_watermarks(alerts_for_target.keys())
+        return {
+            target: self.create_reduced_datums_from_query(target, alerts, 'photometry', **kwargs)
+            for target, alerts in alerts_for_target.items()
+        }
+
+    def get_photometry_watermark(self, target) -> Optional[datetime.datetime]:
+        """
+        Return the timestamp of the latest Fink photometry of `target` (None if there is none).
+        It is read from the database once, then kept up to date by `create_reduced_datums_from_query`.
+        The watermarks of the MAX_PHOTOMETRY_WATERMARKS most recently used targets are kept.
+        """
+        with self._watermarks_lock:
+            if target.pk in self.photometry_watermarks:
+                self.photometry_watermarks.move_to_end(target.pk)
+                return self.photometry_watermarks[target.pk]
+        watermark = PhotometryReducedDatum.objects.filter(
+            target=target, source_name=self.name
+        ).aggregate(latest=Max('timestamp'))['latest']
+        self._set_photometry_watermarks({target.pk: watermark})
+        return watermark
+
+    def load_photometry_watermarks(self, targets) -> None:
+        """
+        Read the photometry watermarks of many targets with a single query.
+        See `get_photometry_watermark`.
+        """
+        pks = [target.pk for target in targets if target.pk is not None]
+        watermarks = dict.fromkeys(pks)
+        watermarks.update(
+            PhotometryReducedDatum.objects.filter(target__in=pks, source_name=self.name)
+            .values('target').annotate(latest=Max('timestamp')).values_list('target', 'latest')
+        )
+        self._set_photometry_watermarks(watermarks)
+
+    def _set_photometry_watermarks(self, watermarks: Dict[int, Optional[datetime.datetime]]) -> None:
+        """Record the watermarks of targets, and forget those of the least recently used targets."""
+        with self._watermarks_lock:
+            for pk, watermark in watermarks.items():
+                self.photometry_watermarks[pk] = watermark
+                self.photometry_watermarks.move_to_end(pk)
+            while len(self.photometry_watermarks) > MAX_PHOTOMETRY_WATERMARKS:
+                self.photometry_watermarks.popitem(last=False)
+
+    def _advance_photometry_watermark(self, pk: int, latest: datetime.datetime) -> None:
+        """Move the watermark of a target up to `latest`, once its photometry is committed."""
+        with self._watermarks_lock:
+            watermark = self.photometry_watermarks.get(pk)
+        if watermark is None or latest > watermark:
+            self._set_photometry_watermarks({pk: latest})
+
+    @instrumented('create_reduced_datums')
     def create_reduced_datums_from_query(self, target, data=None, data_type='photometry', **kwargs):
         """Create Photometry reduced_data instances from `data`. `data` is a List[alert]
         (the alerts returned by Fink).
 
         :param target: The Target these data pertain to.
         :type target: tom_targets.models.Target
-        :param data: This is a list of alert dictionaries for the target. This is the
-        reduced_datums['photometry'] List[alert] constructed in query_targets.
-        :type data: List[Dict[str, Any]]
-
+        :param data: This is a list of alert dictionaries for the target, or the reference
+        to the alerts of the target stored by `query_targets` (see `load_query_result`).
+        :type data: List[Dict[str, Any]] or Dict[str, str]
+        :param bulk: If True, insert the new photometry with a few bulk queries instead of one
+        `get_or_create` per alert (see `bulk_create_photometry`). Defaults to the
+        DATA_SERVICES['Fink']['bulk_ingest'] setting (False if unset).
+        :type bulk: bool
+        :param incremental: If True, alerts that are not more recent than the latest Fink photometry
+        of the target (see `get_photometry_watermark`) are discarded before touching the database,
+        and only the datums of the other alerts are returned. Defaults to the
+        DATA_SERVICES['Fink']['incremental_sync'] setting (False if unset), so that all the
+        datums of `data` are retrieved or created.
+        :type incremental: bool
+        :param full_resync: If True, process all alerts, even if `incremental` is set.
+        :type full_resync: bool
+
+        The watermark of the target is only advanced once the new photometry is committed, so that
+        alerts whose write failed or was rolled back are processed again by the next call.
         """
         logger.debug(f'create_reduced_datums_from_query -- data:{type(data)} => {data}')
         if data is None:
             data = []
+        elif QueryResultStore.is_reference(data):
+            data = self.load_query_result(data)
+
+        # convert 'i:jd' (Julian date) to timestamps, all at once
+        with instrumentation.span('photometry.convert', rows=len(data)):
+            timestamps = jd_to_datetimes([alert['i:jd'] for alert in data])
+
+        incremental = kwargs.get('incremental', self.get_configuration('incremental_sync', False))
+        incremental = incremental and not kwargs.get('full_resync', False)
+        if incremental and target.pk is not None:
+            watermark = self.get_photometry_watermark(target)
+            if watermark is not None:
+                new_alerts = [(alert, timestamp) for alert, timestamp in zip(data, timestamps) if timestamp > watermark]
+                logger.debug(f'create_reduced_datums_from_query -- {len(new_alerts)} of {len(data)} alerts '
+                             f'more recent than {watermark}')
+                data = [alert for alert, _ in new_alerts]
+                timestamps = [timestamp for _, timestamp in new_alerts]
+
+        bulk = kwargs.get('bulk', self.get_configuration('bulk_ingest', False))
+        with instrumentation.span('photometry.write', rows=len(data), bulk=bulk):
+            if bulk:
+                reduced_datums = self.bulk_create_photometry(target, data, timestamps)
+            else:
+                reduced_datums = self._get_or_create_photometry(target, data, timestamps)
+        if timestamps and target.pk is not None:
+            # right away, unless this runs in a transaction (e.g. ATOMIC_REQUESTS)
+            transaction.on_commit(functools.partial(self._advance_photometry_watermark, target.pk, max(timestamps)))
+        return reduced_datums
 
+    def _get_or_create_photometry(self, target, data, timestamps) -> List[PhotometryReducedDatum]:
+        """Save the PhotometryReducedDatums of `data` with one `get_or_create` per alert."""
         reduced_datums = []
-        for alert in data:
-            datum_value = alert  # include the raw alert items in the value dict
-            datum_value['magnitude'] = alert['i:magpsf']  # and add the expected item(s)
-            datum_value['error'] = 0.0
-
-            # convert filter ID to filter (1=g; 2=R; 3=i)
-            filter_index = alert['i:fid'] - 1
-            filter_names = ['g', 'R', 'i']
-            datum_value['filter'] = filter_names[filter_index]
-
-            # convert 'i:jd' (Julian date) to timestamp
-            timestamp = Time(alert['i:jd'], format='jd', scale='utc').to_datetime(TimezoneInfo())
-
+        for alert, timestamp in zip(data, timestamps):
+            datum_value = self._photometry_value(alert)
             reduced_datum, _ = PhotometryReducedDatum.objects.get_or_create(
                 target=target,
                 timestamp=timestamp,
@@ -499,3 +1076,99 @@ class FinkDataService(DataService):
             )
             reduced_datums.append(reduced_datum)
         return reduced_datums
+
+    @staticmethod
+    def _photometry_value(alert: Dict[str, Any]) -> Dict[str, Any]:
+        """Return the `value` dict of the PhotometryReducedDatum of an alert."""
+        datum_value = alert  # include the raw alert items in the value dict
+        datum_value['magnitude'] = alert['i:magpsf']  # and add the expected item(s)
+        datum_value['error'] = 0.0
+
+        # convert filter ID to filter (1=g; 2=R; 3=i)
+        datum_value['filter'] = FILTER_NAMES[alert['i:fid']]
+        return datum_value
+
+    def bulk_create_photometry(self, target, data, timestamps) -> List[PhotometryReducedDatum]:
+        """Create the PhotometryReducedDatums of `data` that are not in the database yet.
+
+        The Fink photometry of the target is loaded with a single query and the alerts are
+        deduplicated in memory, on `i:candid` or on (timestamp, bandpass) -- the unique
+        constraint of PhotometryReducedDatum. Only the new datums are inserted, with
+        `bulk_create` in a single transaction. Alerts whose (timestamp, bandpass) is already
+        taken by another source are skipped. If another process inserted some of them in the
+        meantime (e.g. the writers of FinkAlertStream), they are saved one by one with
+        `get_or_create` instead, which retrieves those of the other process.
+
+        :param target: The Target these data pertain to.
+        :param data: List[alert] returned by Fink
+        :param timestamps: The datetime of each alert (see `jd_to_datetimes`)
+        :return: The new and already existing reduced datums, in the order of `data`
+        """
+        if not data:
+            return []
+        existing_for_key: Dict[Any, PhotometryReducedDatum] = {}
+        existing_for_candid: Dict[int, PhotometryReducedDatum] = {}
+        for datum in PhotometryReducedDatum.objects.filter(target=target, source_name=self.name):
+            existing_for_key[(datum.timestamp, datum.bandpass)] = datum
+            if datum.value.get('i:candid') is not None:
+                existing_for_candid[datum.value['i:candid']] = datum
+        taken_by_other_sources = set(
+            PhotometryReducedDatum.objects.filter(target=target).exclude(source_name=self.name)
+            .values_list('timestamp', 'bandpass')
+        )
+
+        reduced_datums = []
+        new_datums = []
+        for alert, timestamp in zip(data, timestamps):
+            datum_value = self._photometry_value(alert)
+            key = (timestamp, datum_value['filter'])
+            candid = alert.get('i:candid')
+            datum = existing_for_candid.get(candid) or existing_for_key.get(key)
+            if datum is None:
+                if key in taken_by_other_sources:
+                    continue
+                datum = PhotometryReducedDatum(
+                    target=target,
+                    timestamp=timestamp,
+                    source_name=self.name,
+                    value=datum_value,
+                    brightness=datum_value['magnitude'],
+                    brightness_error=datum_value['error'],
+                    bandpass=datum_value['filter'],
+                )
+                new_datums.append(datum)
+                # also deduplicate the alerts of `data` among themselves
+                existing_for_key[key] = datum
+                if candid is not None:
+                    existing_for_candid[candid] = datum
+            reduced_datums.append(datum)
+
+        if new_datums:
+            try:
+                with transaction.atomic():
+                    PhotometryReducedDatum.objects.bulk_create(new_datums, batch_size=BULK_CREATE_BATCH_SIZE)
+            except IntegrityError:
+                logger.info(f'bulk_create_photometry -- {target}: concurrent insert, saving the alerts one by one')
+                saved = {}
+                created_datums = []
+                for datum in new_datums:
+                    saved[id(datum)], created = PhotometryReducedDatum.objects.get_or_create(
+                        target=target,
+                        timestamp=datum.timestamp,
+                        bandpass=datum.bandpass,
+                        defaults={
+                            'source_name': datum.source_name,
+                            'value': datum.value,
+                            'brightness': datum.brightness,
+                            'brightness_error': datum.brightness_error,
+                        },
+                    )
+                    if created:
+                        created_datums.append(saved[id(datum)])
+                reduced_datums = [saved.get(id(datum), datum) for datum in reduced_datums]
+                new_datums = created_datums
+        if new_datums:
+            # bulk_create does not send post_save, which shares new data with other TOMs
+            continuous_share_data(target, reduced_datums=new_datums)
+        logger.debug(f'bulk_create_photometry -- {target}: {len(new_datums)} new of {len(data)} alerts')
+        return reduced_datums
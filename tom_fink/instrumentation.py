@@ -0,0 +1,360 @@
+# Copyright (c) 2025 Julien Peloton
+#
+# This file is part of TOM Toolkit
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""Timing spans around the stages of the Fink query and stream pipelines
+
+Each span records its duration in a histogram named after the stage, and
+the number of rows and bytes it processed. Spans can be logged as JSON
+lines, and the histograms exported in the Prometheus text format. When
+instrumentation is disabled, `span` returns a shared no-op object.
+
+Calls that are slower than a threshold can also be profiled: a sample of
+the top-level spans runs under cProfile, and the profile is dumped to disk
+if the call turns out to be slow.
+"""
+import bisect
+import cProfile
+import functools
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import types
+from typing import Any, Dict, Iterator, List, Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+# upper bounds (seconds) of the histogram buckets, as the Prometheus client defaults
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_PREFIX = "tom_fink"
+
+
+class NullSpan:
+    """Span returned when instrumentation is disabled: does nothing"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **fields) -> None:
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """Timing of one stage. Use `set` to record `rows`, `bytes` and any other field."""
+
+    __slots__ = ("instrumentation", "name", "profile", "fields", "parent", "seconds", "_start", "_profiler",
+                 "_deferred")
+
+    def __init__(self, instrumentation: "Instrumentation", name: str, profile: bool, fields: Dict[str, Any]) -> None:
+        self.instrumentation = instrumentation
+        self.name = name
+        self.profile = profile
+        self.fields = fields
+        self.parent = None
+        self.seconds = 0.0
+        self._start = 0.0
+        self._profiler = None
+        self._deferred = False
+
+    def set(self, **fields) -> None:
+        self.fields.update(fields)
+
+    def defer(self, iterator: Iterator) -> Iterator:
+        """Return an iterator on the items of `iterator` (e.g. a streamed response), which records
+        the span once they are consumed, adding the time spent producing them to the duration
+        of the span, and counting them as its rows"""
+        self._deferred = True
+        return self.instrumentation._iter_deferred(self, iterator)
+
+    def __enter__(self):
+        stack = self.instrumentation._stack()
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        if self.profile:
+            self._profiler = self.instrumentation._start_profiler()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self._start
+        self.instrumentation._stack().pop()
+        if self._profiler is not None:
+            self.instrumentation._stop_profiler(self._profiler, self.name, self.seconds)
+        if self._deferred and exc_type is None:
+            return False
+        self.instrumentation.record(self.name, self.seconds, parent=self.parent, error=exc_type is not None,
+                                    **self.fields)
+        return False
+
+
+class Histogram:
+    """Counts of durations per bucket, with their sum, and the rows and bytes of a stage"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def observe(self, seconds: float, rows: int = 0, num_bytes: int = 0, error: bool = False) -> None:
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.rows += rows
+        self.bytes += num_bytes
+        self.errors += error
+
+
+class Instrumentation:
+    """Registry of the timing spans of tom_fink
+
+    Parameters
+    ----------
+    enabled: bool, optional
+        If False (default), `span` is a no-op.
+    log_spans: bool, optional
+        If True, log each span as a JSON line (at INFO level).
+    profile_threshold: float, optional
+        If set, the calls of top-level spans (`span(..., profile=True)`) that
+        take longer than this many seconds have their cProfile stats dumped
+        in `profile_dir`.
+    profile_sample_rate: float, optional
+        Fraction of the top-level calls that run under cProfile, since the
+        profiler slows the calls down.
+    profile_dir: str, optional
+        Directory of the profile dumps (`<span>-<time>-<pid>.prof`,
+        to be read with `pstats` or snakeviz). Default is `fink_profiles`
+        under MEDIA_ROOT (see `default_profile_dir`).
+    buckets: tuple of float, optional
+        Upper bounds of the histogram buckets, in seconds.
+    """
+
+    def __init__(self, enabled: bool = False, log_spans: bool = False, profile_threshold: Optional[float] = None,
+                 profile_sample_rate: float = 0.1, profile_dir: Optional[str] = None,
+                 buckets=DEFAULT_BUCKETS) -> None:
+        self.enabled = enabled
+        self.log_spans = log_spans
+        self.profile_threshold = profile_threshold
+        self.profile_sample_rate = profile_sample_rate
+        self.profile_dir = profile_dir
+        self.buckets = tuple(buckets)
+        self._histograms: Dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.profiles_dumped = 0
+
+    def configure(self, **options) -> None:
+        """Change the options given to `__init__`, e.g. configure(enabled=True)"""
+        for option, value in options.items():
+            if not hasattr(self, option) or option.startswith("_"):
+                raise ImproperlyConfigured(f"Unknown instrumentation option: {option}")
+            setattr(self, option, tuple(value) if option == "buckets" else value)
+
+    def span(self, name: str, profile: bool = False, **fields):
+        """Return a context manager timing the stage `name`
+
+        Parameters
+        ----------
+        name: str
+            Name of the stage, e.g. 'fetch.request'
+        profile: bool, optional
+            If True, the span may be profiled (see `profile_threshold`).
+            Use it for the top-level calls. Nested spans are never profiled.
+        fields:
+            Initial fields of the span, e.g. endpoint='objects'
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, profile, fields)
+
+    def _stack(self) -> List[Span]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _start_profiler(self) -> Optional[cProfile.Profile]:
+        # only one profiler can run per thread, so nested calls are not profiled
+        if self.profile_threshold is None or getattr(self._local, "profiling", False):
+            return None
+        if random.random() >= self.profile_sample_rate:
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is active in this thread
+            return None
+        self._local.profiling = True
+        return profiler
+
+    def _stop_profiler(self, profiler: cProfile.Profile, name: str, seconds: float) -> None:
+        profiler.disable()
+        self._local.profiling = False
+        if seconds < self.profile_threshold:
+            return
+        profile_dir = self.profile_dir or default_profile_dir()
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(profile_dir, f"{name}-{time.time_ns()}-{os.getpid()}.prof")
+        profiler.dump_stats(path)
+        with self._lock:
+            self.profiles_dumped += 1
+        logger.info(f"Instrumentation -- {name} took {seconds:.3f}s, profile saved in {path}")
+
+    def _iter_deferred(self, span: Span, iterator: Iterator):
+        """Yield the items of `iterator`, then record `span` (see `Span.defer`)"""
+        seconds = 0.0
+        rows = 0
+        error = False
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - start
+                rows += 1
+                yield item
+        except GeneratorExit:
+            raise
+        except Exception:
+            error = True
+            raise
+        finally:
+            fields = {**span.fields, "rows": rows}
+            self.record(span.name, span.seconds + seconds, parent=span.parent, error=error, **fields)
+
+    def record(self, name: str, seconds: float, rows: int = 0, bytes: int = 0, error: bool = False,
+               **fields) -> None:
+        """Record a duration of the stage `name` (see `span`)"""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(self.buckets)
+            histogram.observe(seconds, rows=rows or 0, num_bytes=bytes or 0, error=error)
+        if self.log_spans:
+            logger.info(json.dumps(
+                {"span": name, "seconds": round(seconds, 6), "rows": rows, "bytes": bytes, "error": error, **fields},
+                default=str,
+            ))
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+            self.profiles_dumped = 0
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Return the number of calls, the total and mean duration (s), and the rows and bytes of each stage"""
+        with self._lock:
+            return {
+                name: {
+                    "count": histogram.count,
+                    "seconds": histogram.sum,
+                    "mean_seconds": histogram.sum / histogram.count if histogram.count else 0.0,
+                    "rows": histogram.rows,
+                    "bytes": histogram.bytes,
+                    "errors": histogram.errors,
+                }
+                for name, histogram in self._histograms.items()
+            }
+
+    def prometheus(self) -> str:
+        """Return the histograms and counters in the Prometheus text exposition format"""
+        with self._lock:
+            histograms = {
+                name: (histogram.buckets, list(histogram.counts), histogram.count, histogram.sum,
+                       histogram.rows, histogram.bytes, histogram.errors)
+                for name, histogram in self._histograms.items()
+            }
+        stage = f"{METRIC_PREFIX}_stage"
+        lines = [
+            f"# HELP {stage}_seconds Duration of the stages of tom_fink.",
+            f"# TYPE {stage}_seconds histogram",
+        ]
+        for name, (buckets, counts, count, total, _, _, _) in sorted(histograms.items()):
+            label = _label(name)
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f'{stage}_seconds_bucket{{stage="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'{stage}_seconds_sum{{stage="{label}"}} {total}')
+            lines.append(f'{stage}_seconds_count{{stage="{label}"}} {count}')
+        for index, (metric, description) in enumerate(
+            [("rows", "Rows processed"), ("bytes", "Bytes processed"), ("errors", "Failed calls")], start=4
+        ):
+            lines.append(f"# HELP {stage}_{metric}_total {description} by the stages of tom_fink.")
+            lines.append(f"# TYPE {stage}_{metric}_total counter")
+            for name, values in sorted(histograms.items()):
+                lines.append(f'{stage}_{metric}_total{{stage="{_label(name)}"}} {values[index]}')
+        return "\n".join(lines) + "\n"
+
+
+def instrumented(name: str):
+    """Decorator timing the calls of a function in a top-level span `name` (see `Instrumentation.span`)
+
+    The number of rows is set from the length of the result, if it is a list or a dict.
+    If the result is a generator (e.g. a streamed response), the span is recorded once
+    it is consumed, and also times its items (see `Span.defer`).
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not instrumentation.enabled:
+                return function(*args, **kwargs)
+            with instrumentation.span(name, profile=True) as span:
+                result = function(*args, **kwargs)
+                if isinstance(result, (list, dict)):
+                    span.set(rows=len(result))
+                elif isinstance(result, types.GeneratorType):
+                    return span.defer(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def default_profile_dir() -> str:
+    """Return the `fink_profiles` directory under MEDIA_ROOT, or under the temporary directory
+    if MEDIA_ROOT is not set, rather than under the working directory of the process"""
+    return os.path.join(getattr(settings, "MEDIA_ROOT", None) or tempfile.gettempdir(), "fink_profiles")
+
+
+def _label(value: str) -> str:
+    """Escape a Prometheus label value"""
+    return re.sub(r'(["\\])', r"\\\1", value).replace("\n", "\\n")
+
+
+# Shared by FinkDataService and FinkAlertStream, and configured by FinkDataService.get_instrumentation
+instrumentation = Instrumentation()
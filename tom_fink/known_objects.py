@@ -0,0 +1,113 @@
+# Copyright (c) 2025 Julien Peloton
+#
+# This file is part of TOM Toolkit
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""Memory-bounded set of the object names that are already targets, to skip redundant inserts"""
+import collections
+import logging
+import threading
+from typing import Dict, Iterable
+
+from tom_targets.models import Target, TargetName
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 50_000
+
+
+class KnownObjects:
+    """Least-recently-used set of target names and aliases
+
+    A name in the set is known to be in the database, so alerts of that
+    object do not need a new target. A name that is not in the set may
+    still be in the database (e.g. if it was evicted), so a miss must be
+    confirmed against the database.
+
+    Parameters
+    ----------
+    max_size: int, optional
+        Maximum number of names kept in memory. 0 disables the set.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        self.max_size = max_size
+        self._names: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def preload(self) -> int:
+        """Fill the set with the names and aliases of the most recently created targets
+
+        Returns
+        -------
+        out: int
+            Number of names loaded
+        """
+        self.clear()
+        if self.max_size <= 0:
+            return 0
+        names = list(Target.objects.order_by("-created").values_list("name", flat=True)[:self.max_size])
+        names += TargetName.objects.order_by("-created").values_list("name", flat=True)[:self.max_size - len(names)]
+        # the most recent names are added last, so that they are evicted last
+        self.add(reversed(names))
+        logger.info(f"KnownObjects.preload -- {len(self)} target names and aliases")
+        return len(self)
+
+    def check(self, name: str) -> bool:
+        """Return True if `name` is known to be a target name or alias, and count hits and misses"""
+        with self._lock:
+            known = name in self._names
+            if known:
+                self._names.move_to_end(name)
+                self._hits += 1
+            else:
+                self._misses += 1
+        return known
+
+    def add(self, names: Iterable[str]) -> None:
+        """Record target names that are in the database"""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            for name in names:
+                self._names[name] = None
+                self._names.move_to_end(name)
+            while len(self._names) > self.max_size:
+                self._names.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._names.clear()
+            self._hits = 0
+            self._misses = 0
+
+    def stats(self) -> Dict[str, float]:
+        """Return the number of names, of hits (skipped inserts) and misses, and the skip rate"""
+        with self._lock:
+            checks = self._hits + self._misses
+            return {
+                "size": len(self._names),
+                "hits": self._hits,
+                "misses": self._misses,
+                "skip_rate": self._hits / checks if checks else 0.0,
+            }
+
+
+# Shared by the handlers of tom_fink.alertstream, and preloaded by FinkAlertStream
+known_objects = KnownObjects()
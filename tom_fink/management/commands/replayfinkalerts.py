@@ -0,0 +1,91 @@
+# Copyright (c) 2025 Julien Peloton
+#
+# This file is part of TOM Toolkit
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from tom_fink.alertstream import FinkAlertStream
+
+logger = logging.getLogger(__name__)
+
+
+def get_fink_alert_stream_options():
+    """Return the OPTIONS of the first FinkAlertStream of the ALERT_STREAMS setting"""
+    for alert_stream_config in getattr(settings, 'ALERT_STREAMS', []):
+        try:
+            klass = import_string(alert_stream_config['NAME'])
+        except ImportError:
+            continue
+        if issubclass(klass, FinkAlertStream):
+            return klass, dict(alert_stream_config.get('OPTIONS', {}))
+    raise CommandError('There is no FinkAlertStream in the ALERT_STREAMS setting')
+
+
+class Command(BaseCommand):
+    """
+    Replay archived Fink alerts from local Avro or Parquet files through the FinkAlertStream
+    configured in ALERT_STREAMS (same handlers, FILTERS, BATCH_SIZE, ...), to backfill past
+    nights or to measure the throughput of the handlers.
+
+    Example:
+        ./manage.py replayfinkalerts /data/fink/20250101 --topic fink_early_sn_candidates_ztf --rate 500
+    """
+
+    help = 'Pass archived Fink alerts (Avro or Parquet files) to the handlers of the FinkAlertStream, ' \
+        'and report the throughput and the handler latency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths',
+            nargs='+',
+            help='Avro or Parquet files, or directories searched recursively for them.'
+        )
+        parser.add_argument(
+            '--topic',
+            help='Topic of the alerts, which selects their handler and target list. '
+                 'Defaults to the first topic of the stream.'
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            help='Maximum number of alerts per second. Leave blank to replay as fast as possible.'
+        )
+        parser.add_argument(
+            '--batch_size',
+            type=int,
+            help='Number of alerts per handler call. Defaults to the BATCH_SIZE option of the stream.'
+        )
+
+    def handle(self, *args, **options):
+        klass, stream_options = get_fink_alert_stream_options()
+        if options['batch_size']:
+            stream_options['BATCH_SIZE'] = options['batch_size']
+        stream = klass(**stream_options)
+        try:
+            stats = stream.replay(options['paths'], topic=options['topic'], rate=options['rate'])
+        except (OSError, ValueError, ImportError) as e:
+            raise CommandError(f'Could not read the alerts: {e}')
+        finally:
+            if stream.spill is not None:
+                stream.spill.close()
+        latency = stats['latency_ms']
+        return (f"Replayed {stats['alerts']} alerts in {stats['seconds']:.1f}s "
+                f"({stats['alerts_per_second']:.1f} alerts/s); handler latency (ms): "
+                f"p50 {latency['p50']:.2f}, p95 {latency['p95']:.2f}, p99 {latency['p99']:.2f}, "
+                f"max {latency['max']:.2f}")
@@ -0,0 +1,199 @@
+# Copyright (c) 2025 Julien Peloton
+#
+# This file is part of TOM Toolkit
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand, CommandError
+from requests.exceptions import RequestException
+
+from tom_dataproducts.models import PhotometryReducedDatum
+from tom_dataservices.dataservices import QueryServiceError
+from tom_fink.fink import FinkDataService
+from tom_targets.models import Target, TargetList
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_REQUESTS_PER_SECOND = 5
+
+
+def fetch_alerts(objectIds, use_cache=True):
+    """Query Fink for the alerts of a chunk of objectIds. Runs in the worker threads, without database access.
+
+    With `use_cache=False`, the cached responses (see FinkQueryCache) are ignored.
+    """
+    # one FinkDataService per request, since query_service stores its results on the instance
+    return list(FinkDataService().query_service({'objectId': ','.join(objectIds)}, use_cache=use_cache))
+
+
+class Command(BaseCommand):
+    """
+    Refresh the Fink photometry of many targets.
+
+    The ZTF objectIds of the targets are packed into multi-object requests which are sent by
+    a pool of worker threads, under a requests-per-second limit shared by all of them. The
+    responses are written to the database by the main thread, as they arrive.
+
+    Example:
+        ./manage.py updatefinkphotometry --target_list "Nightly follow-up" --workers 8 --rate 10
+    """
+
+    help = 'Refresh the Fink photometry of the targets of a TargetList (or of all targets with Fink photometry) ' \
+        'with parallel, rate-limited requests.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--target_list',
+            nargs='+',
+            default=[],
+            help='Name of the TargetList(s) to refresh. Leave blank to refresh all targets with Fink photometry.'
+        )
+        parser.add_argument(
+            '--target_id',
+            nargs='+',
+            type=int,
+            default=[],
+            help='ID of the target(s) to refresh, in addition to the target lists.'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=DEFAULT_WORKERS,
+            help=f'Number of requests sent in parallel. Default is {DEFAULT_WORKERS}.'
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            help='Maximum number of requests per second to the Fink API. Defaults to the '
+                 f"DATA_SERVICES['Fink']['max_requests_per_second'] setting, or {DEFAULT_MAX_REQUESTS_PER_SECOND}."
+        )
+        parser.add_argument(
+            '--batch_size',
+            type=int,
+            help="Number of objectIds per request. Defaults to the DATA_SERVICES['Fink']['batch_size'] setting."
+        )
+        parser.add_argument(
+            '--full_resync',
+            action='store_true',
+            help='Process all the alerts of each target, not only those more recent than its latest Fink photometry, '
+                 'and query Fink again instead of reading cached responses.'
+        )
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            help='Insert the new photometry with bulk_create (see FinkDataService.bulk_create_photometry).'
+        )
+
+    def get_targets(self, target_list_names, target_ids):
+        """Return the targets to refresh, without duplicates."""
+        if not target_list_names and not target_ids:
+            target_pks = PhotometryReducedDatum.objects.filter(
+                source_name=FinkDataService.name
+            ).values_list('target', flat=True).distinct()
+            return list(Target.objects.filter(pk__in=target_pks).order_by('pk'))
+
+        targets = {}
+        for name in target_list_names:
+            try:
+                target_list = TargetList.objects.get(name=name)
+            except TargetList.DoesNotExist:
+                raise CommandError(f'TargetList "{name}" does not exist')
+            targets.update((target.pk, target) for target in target_list.targets.all())
+        targets.update((target.pk, target) for target in Target.objects.filter(pk__in=target_ids))
+        return list(targets.values())
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+        service = FinkDataService()
+        batch_size = options['batch_size'] or service.get_configuration('batch_size', 50)
+        rate = options['rate'] or service.get_configuration('max_requests_per_second',
+                                                            DEFAULT_MAX_REQUESTS_PER_SECOND)
+        ingest_options = {'incremental': True, 'full_resync': options['full_resync']}
+        if options['bulk']:
+            ingest_options['bulk'] = True
+
+        targets = self.get_targets(options['target_list'], options['target_id'])
+        targets_for_objectid = service.resolve_objectids(targets)
+        if not options['full_resync']:
+            service.load_photometry_watermarks(targets_for_objectid.values())
+        objectIds = list(targets_for_objectid)
+        chunks = [objectIds[start:start + batch_size] for start in range(0, len(objectIds), batch_size)]
+        logger.info(f'Refreshing the Fink photometry of {len(objectIds)} targets '
+                    f'({len(targets) - len(objectIds)} without a ZTF objectId) with {len(chunks)} requests, '
+                    f"{options['workers']} workers, at most {rate} requests/s")
+
+        client = service.get_client()
+        previous_rate_limiter = client.rate_limiter
+        client.set_rate_limit(rate)
+        failed = {}
+        num_done = 0
+        num_alerts = 0
+        num_datums = 0
+        start_time = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                # a full resync must not ingest the responses cached before it
+                futures = {
+                    executor.submit(fetch_alerts, chunk, use_cache=not options['full_resync']): chunk
+                    for chunk in chunks
+                }
+                # the database is only written from this thread
+                for future in as_completed(futures):
+                    chunk = futures[future]
+                    try:
+                        alerts_for_objectid = service.group_alerts_by_target(future.result())
+                    except (QueryServiceError, RequestException) as e:
+                        logger.error(f'Fink request failed for {len(chunk)} targets ({", ".join(chunk)}): {e}')
+                        failed.update(dict.fromkeys(chunk, str(e)))
+                        num_done += len(chunk)
+                        continue
+                    except Exception as e:
+                        # e.g. a malformed response: only the targets of this chunk fail
+                        logger.exception(f'Could not process the Fink response for {len(chunk)} targets '
+                                         f'({", ".join(chunk)}): {e}')
+                        failed.update(dict.fromkeys(chunk, str(e)))
+                        num_done += len(chunk)
+                        continue
+                    for objectId in chunk:
+                        alerts = alerts_for_objectid.get(objectId, [])
+                        num_alerts += len(alerts)
+                        try:
+                            reduced_datums = service.create_reduced_datums_from_query(
+                                targets_for_objectid[objectId], alerts, 'photometry', **ingest_options
+                            )
+                        except Exception as e:
+                            logger.exception(f'Could not store the Fink photometry of {objectId}: {e}')
+                            failed[objectId] = str(e)
+                            continue
+                        num_datums += len(reduced_datums)
+                    num_done += len(chunk)
+                    elapsed = max(time.monotonic() - start_time, 1e-6)
+                    logger.info(f'{num_done}/{len(objectIds)} targets refreshed, {num_alerts} alerts in {elapsed:.1f}s '
+                                f'({num_done / elapsed:.1f} targets/s, {num_alerts / elapsed:.1f} alerts/s)')
+        finally:
+            client.rate_limiter = previous_rate_limiter
+
+        elapsed = time.monotonic() - start_time
+        logger.info(f'Refreshed {len(objectIds) - len(failed)} targets, {num_alerts} alerts, '
+                    f'{num_datums} photometry points in {elapsed:.1f}s; client stats: {client.stats()}')
+        if failed:
+            for objectId, error in failed.items():
+                logger.warning(f'Failed to refresh {objectId}: {error}')
+            return f'Update completed with errors for {len(failed)} targets: {", ".join(failed)}'
+        return 'Update completed successfully'
@@ -0,0 +1,225 @@
+# Copyright (c) 2025 Julien Peloton
+#
+# This file is part of TOM Toolkit
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""Throughput, latency and consumer lag of FinkAlertStream, and an HTTP endpoint to read them"""
+import collections
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Tuple
+
+import numpy as np
+
+from tom_fink.instrumentation import _label
+
+logger = logging.getLogger(__name__)
+
+# number of recent handler calls used for the latency percentiles and the throughput
+DEFAULT_WINDOW = 10000
+# seconds over which the recent throughput is computed
+RATE_PERIOD = 60.0
+QUANTILES = (0.5, 0.99)
+
+
+class StreamMetrics:
+    """Counters of a FinkAlertStream consumer
+
+    Counts polls, alerts and bytes, and keeps the latency of the recent handler calls,
+    split into the time spent in database queries (see `time_query`) and the rest.
+    The lag of each partition (end offset minus committed offset) is updated by
+    the consumer loop (see `FinkConsumer.lag`).
+
+    Parameters
+    ----------
+    window: int, optional
+        Number of recent handler calls kept for the percentiles and the throughput.
+    """
+
+    def __init__(self, window: int = DEFAULT_WINDOW) -> None:
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.started = time.time()
+        self.polls = 0
+        self.empty_polls = 0
+        self.alerts = 0
+        self.bytes = 0
+        self.handler_calls = 0
+        # (monotonic time, number of alerts, handler seconds, database seconds) of the recent handler calls
+        self._calls: collections.deque = collections.deque(maxlen=window)
+        self.lag: Dict[Tuple[str, int], int] = {}
+        self.lag_updated = None
+
+    def record_poll(self, num_alerts: int) -> None:
+        """Record a poll (or a batch consume) that returned `num_alerts` alerts"""
+        with self._lock:
+            self.polls += 1
+            self.empty_polls += num_alerts == 0
+
+    def record_bytes(self, num_bytes: int) -> None:
+        """Record the size of a message received from Kafka"""
+        with self._lock:
+            self.bytes += num_bytes
+
+    def time_query(self, execute: Callable, sql, params, many, context):
+        """Database execute wrapper (see `django.db.connection.execute_wrapper`) that adds the duration
+        of the queries to the database time of the handler call running in this thread"""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self._local.db_seconds = getattr(self._local, "db_seconds", 0.0) + time.perf_counter() - start
+
+    def start_handler(self) -> None:
+        """Reset the database time of the handler call about to run in this thread"""
+        self._local.db_seconds = 0.0
+
+    def record_handler(self, num_alerts: int, seconds: float) -> None:
+        """Record a handler call of this thread that took `seconds` for `num_alerts` alerts"""
+        db_seconds = getattr(self._local, "db_seconds", 0.0)
+        with self._lock:
+            self.alerts += num_alerts
+            self.handler_calls += 1
+            self._calls.append((time.monotonic(), num_alerts, seconds, db_seconds))
+
+    def update_lag(self, lag: Dict[Tuple[str, int], int]) -> None:
+        """Replace the lag of the partitions assigned to the consumer"""
+        with self._lock:
+            self.lag = dict(lag)
+            self.lag_updated = time.time()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the counters, the recent throughput (alerts/s), the percentiles of the
+        handler and database latencies (s) of the recent calls, and the lag of each partition"""
+        now = time.monotonic()
+        with self._lock:
+            calls = list(self._calls)
+            stats = {
+                "polls": self.polls,
+                "empty_polls": self.empty_polls,
+                "alerts": self.alerts,
+                "bytes": self.bytes,
+                "handler_calls": self.handler_calls,
+                "uptime_seconds": time.time() - self.started,
+                "lag": _nest(self.lag),
+                "total_lag": sum(self.lag.values()),
+                "lag_updated": self.lag_updated,
+            }
+        recent = [call for call in calls if now - call[0] <= RATE_PERIOD]
+        period = min(RATE_PERIOD, stats["uptime_seconds"]) or 1.0
+        stats["alerts_per_second"] = sum(call[1] for call in recent) / period
+        handler_seconds = np.array([call[2] for call in calls])
+        db_seconds = np.array([call[3] for call in calls])
+        for name, values in [("handler_seconds", handler_seconds), ("db_seconds", db_seconds)]:
+            for quantile in QUANTILES:
+                key = f"{name}_p{int(quantile * 100)}"
+                stats[key] = float(np.quantile(values, quantile)) if len(values) else 0.0
+        return stats
+
+
+def prometheus_stream_metrics(stats: Dict[str, Any], prefix: str = "tom_fink_stream") -> str:
+    """Return the `stats` of FinkAlertStream in the Prometheus text exposition format"""
+    metrics = stats["metrics"]
+    lines = []
+
+    def metric(name, kind, description, samples):
+        lines.append(f"# HELP {prefix}_{name} {description}")
+        lines.append(f"# TYPE {prefix}_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{prefix}_{name}{labels} {value}")
+
+    metric("polls_total", "counter", "Polls of the Kafka consumer.", [("", metrics["polls"])])
+    metric("empty_polls_total", "counter", "Polls that returned no alert.", [("", metrics["empty_polls"])])
+    metric("alerts_total", "counter", "Alerts passed to the handlers.", [("", metrics["alerts"])])
+    metric("bytes_total", "counter", "Bytes of the messages received.", [("", metrics["bytes"])])
+    metric("alerts_per_second", "gauge", f"Alerts handled per second over the last {RATE_PERIOD:.0f}s.",
+           [("", metrics["alerts_per_second"])])
+    for name, description in [("handler_seconds", "Duration of the handler calls."),
+                              ("db_seconds", "Database time of the handler calls.")]:
+        metric(name, "summary", description, [
+            (f'{{quantile="{quantile}"}}', metrics[f"{name}_p{int(quantile * 100)}"]) for quantile in QUANTILES
+        ])
+    known = stats["known_objects"]
+    metric("duplicate_ratio", "gauge", "Fraction of the alerts of objects that are already targets.",
+           [("", known["skip_rate"])])
+    metric("consumer_lag", "gauge", "Messages between the committed and the end offset of each partition.", [
+        (f'{{topic="{_label(topic)}",partition="{partition}"}}', lag)
+        for topic, partitions in metrics["lag"].items()
+        for partition, lag in partitions.items()
+    ])
+    return "\n".join(lines) + "\n"
+
+
+def _nest(lag: Dict[Tuple[str, int], int]) -> Dict[str, Dict[str, int]]:
+    """Return the lag of each (topic, partition) as {topic: {partition: lag}}, which can be serialized to JSON"""
+    nested: Dict[str, Dict[str, int]] = {}
+    for (topic, partition), value in sorted(lag.items()):
+        nested.setdefault(topic, {})[str(partition)] = value
+    return nested
+
+
+class MetricsServer:
+    """Lightweight HTTP endpoint serving the metrics of a stream, in a background thread
+
+    GET /metrics returns the Prometheus text format, and GET /stats (or /) the JSON stats.
+
+    Parameters
+    ----------
+    stats: callable
+        Returns the JSON-serializable stats
+    prometheus: callable
+        Returns the Prometheus text
+    port: int
+        Port to listen on (0 for any free port, see `port`)
+    host: str, optional
+        Address to listen on. Default is localhost only.
+    """
+
+    def __init__(self, stats: Callable[[], Dict[str, Any]], prometheus: Callable[[], str], port: int,
+                 host: str = "127.0.0.1") -> None:
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0].rstrip("/")
+                if path == "/metrics":
+                    body, content_type = prometheus().encode(), "text/plain; version=0.0.4"
+                elif path in ("", "/stats"):
+                    body, content_type = json.dumps(stats(), default=str).encode(), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_port
+        self._thread = threading.Thread(target=self.server.serve_forever, name="FinkMetricsServer", daemon=True)
+
+    def start(self) -> "MetricsServer":
+        self._thread.start()
+        logger.info(f"MetricsServer -- serving /metrics and /stats on port {self.port}")
+        return self
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
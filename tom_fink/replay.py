@@ -0,0 +1,140 @@
+# Copyright (c) 2025 Julien Peloton
+#
+# This file is part of TOM Toolkit
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""Archived Fink alerts read from local files, to replay them through FinkAlertStream
+
+Avro files (one or several alerts per file, as written by `fink_consumer
+--save` or `AlertConsumer.poll_and_write`) and Parquet files (one alert
+per row, with nested `candidate` and `prv_candidates` columns, as in the
+Fink data transfer service) are read through a memory map. Reading
+Parquet files requires the optional `pyarrow` package (`pip install pyarrow`).
+"""
+import mmap
+import os
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import fastavro
+import numpy as np
+
+AVRO_SUFFIXES = (".avro",)
+PARQUET_SUFFIXES = (".parquet", ".parq")
+
+
+def _import_pyarrow():
+    """Import pyarrow, which is an optional dependency of tom_fink."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError(
+            "Replaying Parquet files requires pyarrow: pip install pyarrow"
+        ) from e
+    return pyarrow
+
+
+def find_alert_files(paths: Iterable[str]) -> List[str]:
+    """Return the Avro and Parquet files among `paths`, and in the directories among them, in name order"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in sorted(os.walk(path)):
+                files.extend(
+                    os.path.join(directory, name) for name in sorted(names)
+                    if name.endswith(AVRO_SUFFIXES + PARQUET_SUFFIXES)
+                )
+        else:
+            files.append(path)
+    return files
+
+
+def iter_avro_alerts(path: str) -> Iterator[Dict[str, Any]]:
+    """Yield the alerts of an Avro container file, read through a memory map"""
+    with open(path, "rb") as avro_file:
+        if os.fstat(avro_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(avro_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield from fastavro.reader(data)
+
+
+def iter_parquet_batches(path: str, batch_size: int) -> Iterator[List[Dict[str, Any]]]:
+    """Yield the alerts of a Parquet file in lists of at most `batch_size`, read through a memory map"""
+    pyarrow = _import_pyarrow()
+    parquet_file = pyarrow.parquet.ParquetFile(path, memory_map=True)
+    for record_batch in parquet_file.iter_batches(batch_size=batch_size):
+        yield record_batch.to_pylist()
+
+
+def iter_alert_batches(paths: Iterable[str], batch_size: int = 1) -> Iterator[List[Dict[str, Any]]]:
+    """Yield the alerts of the Avro and Parquet files of `paths` in lists of at most `batch_size`
+
+    Parameters
+    ----------
+    paths: list of str
+        Files, or directories searched recursively (see `find_alert_files`)
+    batch_size: int, optional
+        Maximum number of alerts per list. Lists may span several files.
+
+    Raises
+    ------
+    ValueError
+        If a file is neither Avro nor Parquet.
+    """
+    batch: List[Dict[str, Any]] = []
+    for path in find_alert_files(paths):
+        if path.endswith(AVRO_SUFFIXES):
+            batches = ([alert] for alert in iter_avro_alerts(path))
+        elif path.endswith(PARQUET_SUFFIXES):
+            batches = iter_parquet_batches(path, batch_size)
+        else:
+            raise ValueError(f"{path} is neither an Avro nor a Parquet file")
+        for alerts in batches:
+            batch.extend(alerts)
+            while len(batch) >= batch_size:
+                yield batch[:batch_size]
+                batch = batch[batch_size:]
+    if batch:
+        yield batch
+
+
+class Pacer:
+    """Space out alerts to replay them at most at `rate` alerts per second (as fast as possible if None)"""
+
+    def __init__(self, rate: Optional[float] = None) -> None:
+        self.rate = rate
+        self._start = None
+        self._num_alerts = 0
+
+    def wait(self, num_alerts: int) -> None:
+        """Wait until `num_alerts` more alerts can be sent"""
+        if not self.rate:
+            return
+        now = time.monotonic()
+        if self._start is None:
+            self._start = now
+        # send on schedule from the start, so that the rate does not drift
+        delay = self._start + self._num_alerts / self.rate - now
+        if delay > 0:
+            time.sleep(delay)
+        self._num_alerts += num_alerts
+
+
+def latency_percentiles(latencies: List[float]) -> Dict[str, float]:
+    """Return the 50th, 95th and 99th percentiles and the maximum of `latencies` (seconds), in milliseconds"""
+    if not latencies:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    p50, p95, p99, p100 = 1e3 * np.percentile(np.asarray(latencies), [50, 95, 99, 100])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "max": float(p100)}
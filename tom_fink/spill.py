@@ -0,0 +1,204 @@
+# Copyright (c) 2025 Julien Peloton
+#
+# This file is part of TOM Toolkit
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""Append-only on-disk log of decoded alerts, replayed once they can be handled
+
+The log is a directory of segment files. Each process appends to its own
+`<sequence>-<pid>.active` segment, which is sealed (renamed to `.log`) once it
+reaches the segment size or when the log is drained. A drainer claims a sealed
+segment by renaming it to `.draining`, reads it through a memory map and
+deletes it once all its alerts are handled.
+
+Records are pickled (topic, alert) tuples, framed by their length and CRC32,
+so that a record torn by a crash is detected and ignored. Only point the log
+at a directory that you trust, as pickles can execute code when loaded.
+"""
+import glob
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+from typing import Any, Callable, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_DRAIN_BATCH_SIZE = 500
+
+# length and CRC32 of the payload of each record
+RECORD_HEADER = struct.Struct(">II")
+
+ACTIVE_SUFFIX = ".active"
+SEALED_SUFFIX = ".log"
+DRAINING_SUFFIX = ".draining"
+
+
+def _pid_is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def iter_segment(path: str) -> Iterator[Tuple[str, Any]]:
+    """Yield the (topic, alert) records of a segment file, read through a memory map
+
+    Reading stops at the first truncated or corrupted record.
+    """
+    with open(path, "rb") as segment:
+        if os.fstat(segment.fileno()).st_size == 0:
+            return
+        with mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            position = 0
+            while position + RECORD_HEADER.size <= len(data):
+                length, crc = RECORD_HEADER.unpack_from(data, position)
+                start = position + RECORD_HEADER.size
+                payload = data[start:start + length]
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    logger.warning(f"iter_segment -- {path}: corrupted record at byte {position}, skipping the rest")
+                    return
+                yield pickle.loads(payload)
+                position = start + length
+
+
+class SpillLog:
+    """Durable buffer of decoded alerts, shared by the processes using the same directory
+
+    Parameters
+    ----------
+    directory: str
+        Directory of the segment files. It is created if needed.
+    segment_size: int, optional
+        Size in bytes after which the active segment is sealed.
+    fsync: bool, optional
+        If True, fsync the segment after each append, so that alerts
+        survive a power loss, not only a crash of the process.
+    """
+
+    def __init__(self, directory: str, segment_size: int = DEFAULT_SEGMENT_SIZE, fsync: bool = False) -> None:
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._path = None
+        self._pid = None
+        self.recover()
+
+    def _segments(self, suffix: str) -> List[str]:
+        # sequence numbers have a fixed width, so the names sort in creation order
+        return sorted(glob.glob(os.path.join(self.directory, f"*{suffix}")))
+
+    def recover(self) -> None:
+        """Seal the active segments, and release the claimed ones, of processes that are not running anymore"""
+        for suffix in (ACTIVE_SUFFIX, DRAINING_SUFFIX):
+            for path in self._segments(suffix):
+                pid = int(os.path.basename(path)[:-len(suffix)].split("-")[1])
+                if pid != os.getpid() and not _pid_is_running(pid):
+                    logger.info(f"SpillLog.recover -- releasing {path} of process {pid}")
+                    os.replace(path, path[:-len(suffix)] + SEALED_SUFFIX)
+
+    def append(self, topic: str, alerts: List[Any]) -> None:
+        """Append alerts of `topic` to the log"""
+        records = []
+        for alert in alerts:
+            payload = pickle.dumps((topic, alert), protocol=pickle.HIGHEST_PROTOCOL)
+            records.append(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+            records.append(payload)
+        with self._lock:
+            if self._file is None or self._pid != os.getpid():
+                # new segment, also after a fork: segments are never shared between processes
+                self._pid = os.getpid()
+                self._path = os.path.join(self.directory, f"{time.time_ns():020d}-{self._pid}{ACTIVE_SUFFIX}")
+                self._file = open(self._path, "ab")
+            self._file.write(b"".join(records))
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            if self._file.tell() >= self.segment_size:
+                self._seal()
+
+    def _seal(self) -> None:
+        if self._file is None or self._pid != os.getpid():
+            return
+        self._file.close()
+        os.replace(self._path, self._path[:-len(ACTIVE_SUFFIX)] + SEALED_SUFFIX)
+        self._file = None
+        self._path = None
+
+    def seal(self) -> None:
+        """Seal the active segment of this process, so that it can be drained"""
+        with self._lock:
+            self._seal()
+
+    def has_pending(self) -> bool:
+        """True if there are alerts to drain"""
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid() and self._file.tell() > 0:
+                return True
+        return bool(self._segments(SEALED_SUFFIX))
+
+    def drain(self, handle: Callable[[List[Tuple[str, Any]]], None],
+              batch_size: int = DEFAULT_DRAIN_BATCH_SIZE) -> int:
+        """Pass the logged alerts to `handle`, as lists of at most `batch_size` (topic, alert) tuples
+
+        Segments are deleted once all their alerts are handled. If `handle`
+        raises, the segment being drained is released (and drained again
+        from its start next time), and the exception is propagated.
+
+        Returns
+        -------
+        out: int
+            Number of alerts handled
+        """
+        self.seal()
+        num_alerts = 0
+        for path in self._segments(SEALED_SUFFIX):
+            sequence = os.path.basename(path)[:-len(SEALED_SUFFIX)].split("-")[0]
+            claimed = os.path.join(self.directory, f"{sequence}-{os.getpid()}{DRAINING_SUFFIX}")
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue  # claimed by another process
+            try:
+                batch = []
+                for record in iter_segment(claimed):
+                    batch.append(record)
+                    if len(batch) >= batch_size:
+                        handle(batch)
+                        num_alerts += len(batch)
+                        batch = []
+                if batch:
+                    handle(batch)
+                    num_alerts += len(batch)
+            except BaseException:
+                os.replace(claimed, path)
+                raise
+            os.remove(claimed)
+        return num_alerts
+
+    def close(self) -> None:
+        """Seal the active segment"""
+        self.seal()
@@ -0,0 +1,355 @@
+"""Micro-benchmarks for tom_fink.
+
+The REST paths query a local stand-in of the Fink API (see `FinkAPIStub`)
+serving synthetic alerts, and the database paths run on a throw-away test
+database, so the benchmarks run offline and can be compared between runs.
+
+NOTE: To run these benchmarks in your venv: python ./tom_fink/tests/run_benchmarks.py
+Save the results with `--output results.json`, and compare them with a
+previous run with `--compare baseline.json`.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import threading
+import timeit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from astropy.time import Time, TimezoneInfo
+from django.db import connection
+
+from tom_dataproducts.models import PhotometryReducedDatum
+from tom_fink import __version__ as fink_version
+from tom_fink.alertstream import alert_logger
+from tom_fink.client import FinkClient
+from tom_fink.fink import FILTER_NAMES, FinkDataService, jd_to_datetimes
+from tom_fink.known_objects import known_objects
+from tom_targets.models import Target
+
+# results slower than the baseline by more than this factor are reported as regressions
+REGRESSION_THRESHOLD = 1.2
+
+# modules that tom_fink.fink should only import on first use
+HEAVY_MODULES = ('numpy', 'astropy.time', 'erfa', 'requests', 'markdown', 'pandas', 'pyarrow')
+
+# run in a fresh interpreter by benchmark_import
+IMPORT_SCRIPT = '''
+import json, sys, time
+from boot_django import boot_django
+boot_django()
+before = set(sys.modules)
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'modules': sorted(set(sys.modules) - before)}}))
+'''
+
+
+def make_alerts(num_alerts, objectId='ZTF18abzktuy'):
+    """Return `num_alerts` synthetic Fink REST API alerts of a single object"""
+    return [
+        {
+            'i:objectId': objectId,
+            'i:candid': 3297294755815010006 + i,
+            'i:ra': 92.5117956,
+            'i:dec': 36.1095938,
+            'i:jd': 2459000.5 + 0.37 * i,
+            'i:fid': 1 + i % 2,
+            'i:magpsf': 18.0 + 0.001 * i,
+            'd:cdsxmatch': 'EclBin',
+            'd:rf_snia_vs_nonia': 0.0,
+        }
+        for i in range(num_alerts)
+    ]
+
+
+def convert_per_alert(alerts):
+    """Time and filter conversion as done by create_reduced_datums_from_query up to tom_fink 0.x:
+    one Time object and one filter list per alert."""
+    converted = []
+    for alert in alerts:
+        filter_names = ['g', 'R', 'i']
+        bandpass = filter_names[alert['i:fid'] - 1]
+        timestamp = Time(alert['i:jd'], format='jd', scale='utc').to_datetime(TimezoneInfo())
+        converted.append((timestamp, bandpass))
+    return converted
+
+
+def convert_vectorized(alerts):
+    """Time and filter conversion as done by create_reduced_datums_from_query now."""
+    timestamps = jd_to_datetimes([alert['i:jd'] for alert in alerts])
+    return [(timestamp, FILTER_NAMES[alert['i:fid']]) for alert, timestamp in zip(alerts, timestamps)]
+
+
+def best_time(function, *args, repeat=3):
+    """Return the best wall time (s) of `repeat` calls of function(*args)"""
+    return min(timeit.repeat(lambda: function(*args), number=1, repeat=repeat))
+
+
+def benchmark_time_conversion(sizes=(10, 100, 1000, 5000), repeat=3):
+    """Compare the per-alert cost of the jd/fid conversions before and after vectorization.
+
+    :return: one dict per size with the per-alert cost in microseconds
+    """
+    results = []
+    for size in sizes:
+        alerts = make_alerts(size)
+        before = best_time(convert_per_alert, alerts, repeat=repeat)
+        after = best_time(convert_vectorized, alerts, repeat=repeat)
+        results.append({
+            'name': 'time_conversion',
+            'num_alerts': size,
+            'per_alert_before_us': 1e6 * before / size,
+            'per_alert_after_us': 1e6 * after / size,
+            'speedup': before / after,
+            'seconds': after,
+        })
+    return results
+
+
+def make_object_alerts(num_objects, alerts_per_object):
+    """Return synthetic Fink REST API alerts of `num_objects` objects, sorted by date as in Fink responses"""
+    alerts = [
+        dict(alert, **{'i:ra': alert['i:ra'] + 0.01 * index, 'i:candid': alert['i:candid'] + 1000 * index})
+        for index in range(num_objects)
+        for alert in make_alerts(alerts_per_object, objectId=f'ZTF18abzk{index:04d}')
+    ]
+    return sorted(alerts, key=lambda alert: alert['i:jd'])
+
+
+def make_stream_alerts(num_alerts):
+    """Return `num_alerts` synthetic Fink livestream alerts of distinct objects"""
+    return [
+        {
+            'objectId': f'ZTF24aak{index:05d}',
+            'candidate': {'jd': 2461051.5 + 0.001 * index, 'ra': 92.5 + 0.001 * index, 'dec': 36.1,
+                          'magpsf': 18.0, 'fid': 1 + index % 2},
+        }
+        for index in range(num_alerts)
+    ]
+
+
+class FinkAPIStub:
+    """Local stand-in of the Fink API, answering the `objects`, `conesearch` and `latests`
+    endpoints with the same JSON body (see `set_alerts`).
+
+    As a context manager, it runs in a background thread and FinkDataService
+    uses it instead of the Fink API.
+    """
+
+    endpoints = ('objects', 'conesearch', 'latests')
+
+    def __init__(self):
+        self.body = b'[]'
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, as the Fink API
+            disable_nagle_algorithm = True  # headers and body are sent separately
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path.rsplit('/', 1)[-1] not in stub.endpoints:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(stub.body)))
+                self.end_headers()
+                self.wfile.write(stub.body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}/api/v1/'
+
+    def set_alerts(self, alerts):
+        """Answer the next requests with `alerts`"""
+        self.body = json.dumps(alerts).encode()
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self._previous_client = FinkDataService._client
+        FinkDataService._client = FinkClient(self.base_url)
+        return self
+
+    def __exit__(self, *exc_info):
+        FinkDataService._client = self._previous_client
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@contextlib.contextmanager
+def benchmark_database():
+    """Create an empty test database, as the test runner does, and destroy it afterwards"""
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def timing_result(name, num_alerts, seconds):
+    return {'name': name, 'num_alerts': num_alerts, 'seconds': seconds, 'per_alert_us': 1e6 * seconds / num_alerts}
+
+
+def benchmark_rest(stub, sizes=(100, 1000, 10000), repeat=3):
+    """Time query_service, query_targets and query_photometry on responses of `sizes` alerts.
+
+    The response cache is bypassed, so each call sends a request to `stub`.
+    """
+    service = FinkDataService()
+    results = []
+    for size in sizes:
+        stub.set_alerts(make_alerts(size))
+        results.append(timing_result('query_service', size, best_time(
+            lambda: service.query_service({'objectId': 'ZTF18abzktuy'}, use_cache=False), repeat=repeat)))
+        results.append(timing_result('query_photometry', size, best_time(
+            lambda: service.query_photometry({'objectId': 'ZTF18abzktuy'}, use_cache=False), repeat=repeat)))
+        # 10 alerts per object, as in a cone search
+        stub.set_alerts(make_object_alerts(max(size // 10, 1), 10))
+        results.append(timing_result('query_targets', size, best_time(
+            lambda: service.query_targets({'ra': 92.5, 'dec': 36.1, 'radius': 5}, use_cache=False), repeat=repeat)))
+        # size of the rows cached by the tom_dataservices views, the alerts being kept in the result store
+        rows = service.query_targets({'ra': 92.5, 'dec': 36.1, 'radius': 5}, use_cache=False)
+        results[-1]['rows_bytes'] = len(pickle.dumps(rows))
+    return results
+
+
+def benchmark_ingest(sizes=(100, 1000), repeat=3):
+    """Time create_reduced_datums_from_query (one get_or_create per alert, and bulk) into an empty
+    light curve, and alert_logger, for `sizes` alerts. Requires a database (see `benchmark_database`)."""
+    results = []
+    for size in sizes:
+        alerts = make_alerts(size)
+        target = Target.objects.create(name='ZTF18abzktuy', type='SIDEREAL', ra=92.5117956, dec=36.1095938)
+        for name, bulk in [('create_reduced_datums', False), ('create_reduced_datums_bulk', True)]:
+            def ingest():
+                PhotometryReducedDatum.objects.filter(target=target).delete()
+                FinkDataService().create_reduced_datums_from_query(
+                    target, [dict(alert) for alert in alerts], 'photometry', bulk=bulk, full_resync=True
+                )
+            results.append(timing_result(name, size, best_time(ingest, repeat=repeat)))
+        target.delete()
+
+        stream_alerts = make_stream_alerts(size)
+
+        def log_alerts():
+            Target.objects.filter(name__in=[alert['objectId'] for alert in stream_alerts]).delete()
+            known_objects.clear()
+            for alert in stream_alerts:
+                alert_logger(alert, 'benchmark')
+        results.append(timing_result('alert_logger', size, best_time(log_alerts, repeat=repeat)))
+    return results
+
+
+def benchmark_import(modules=('tom_fink.fink', 'tom_fink.alertstream'), repeat=3):
+    """Time the import of `modules` in fresh interpreters, once Django is set up,
+    and list the heavy modules (see HEAVY_MODULES) that each import pulls in.
+
+    Heavy modules already imported by the other installed apps are not counted.
+    """
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [tests_dir, os.path.dirname(os.path.dirname(tests_dir)), os.environ.get('PYTHONPATH', '')]
+    ))
+    results = []
+    for module in modules:
+        runs = [
+            json.loads(subprocess.run(
+                [sys.executable, '-c', IMPORT_SCRIPT.format(module=module)],
+                cwd=tests_dir, env=env, check=True, capture_output=True, text=True,
+            ).stdout.splitlines()[-1])
+            for _ in range(repeat)
+        ]
+        result = timing_result(f'import {module}', 1, min(run['seconds'] for run in runs))
+        result['heavy_modules'] = [name for name in HEAVY_MODULES if name in runs[0]['modules']]
+        results.append(result)
+    return results
+
+
+def run_benchmarks(quick=False):
+    """Run all the benchmarks, and return their results with the versions they ran on"""
+    rest_sizes, ingest_sizes, conversion_sizes = (100, 1000, 10000), (100, 1000), (10, 100, 1000, 5000)
+    if quick:
+        rest_sizes, ingest_sizes, conversion_sizes = (100,), (100,), (100,)
+    results = benchmark_time_conversion(sizes=conversion_sizes)
+    results += benchmark_import()
+    with FinkAPIStub() as stub:
+        results += benchmark_rest(stub, sizes=rest_sizes)
+    with benchmark_database():
+        results += benchmark_ingest(sizes=ingest_sizes)
+    return {
+        'tom_fink': fink_version,
+        'python': platform.python_version(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Return the ratio of the time of each result to the same benchmark (name and size) in `baseline`,
+    keyed by (name, num_alerts), and whether it is a regression (ratio above `threshold`)"""
+    baseline_seconds = {
+        (result['name'], result['num_alerts']): result['seconds'] for result in baseline['results']
+    }
+    ratios = {}
+    for result in results['results']:
+        key = (result['name'], result['num_alerts'])
+        if baseline_seconds.get(key):
+            ratio = result['seconds'] / baseline_seconds[key]
+            ratios[key] = (ratio, ratio > threshold)
+    return ratios
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of tom_fink')
+    parser.add_argument('--output', help='Save the results in this JSON file')
+    parser.add_argument('--compare', help='Compare the results with those of this JSON file')
+    parser.add_argument('--quick', action='store_true', help='Only run the smallest sizes')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(quick=args.quick)
+
+    print(f"{'benchmark':<20} {'alerts':>8} {'before (us/alert)':>18} {'after (us/alert)':>17} {'speedup':>8}")
+    for result in results['results']:
+        if result['name'] == 'time_conversion':
+            print(f"{result['name']:<20} {result['num_alerts']:>8} {result['per_alert_before_us']:>18.1f} "
+                  f"{result['per_alert_after_us']:>17.1f} {result['speedup']:>8.1f}")
+    print()
+    print(f"{'benchmark':<28} {'alerts':>8} {'time (ms)':>10} {'us/alert':>9}")
+    for result in results['results']:
+        if result['name'] != 'time_conversion' and 'heavy_modules' not in result:
+            rows_size = f"  rows: {result['rows_bytes'] / 1024:.1f} kB" if 'rows_bytes' in result else ''
+            print(f"{result['name']:<28} {result['num_alerts']:>8} {1e3 * result['seconds']:>10.2f} "
+                  f"{result['per_alert_us']:>9.1f}{rows_size}")
+
+    print()
+    print(f"{'import':<28} {'time (ms)':>10}  heavy modules imported")
+    for result in results['results']:
+        if 'heavy_modules' in result:
+            print(f"{result['name'][len('import '):]:<28} {1e3 * result['seconds']:>10.2f}  "
+                  f"{', '.join(result['heavy_modules']) or '-'}")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+        print(f'\nresults saved in {args.output}')
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"\ncompared with {args.compare} (tom_fink {baseline.get('tom_fink')}, {baseline.get('date')}):")
+        regressions = 0
+        for (name, num_alerts), (ratio, regression) in compare(results, baseline).items():
+            regressions += regression
+            print(f"{name:<28} {num_alerts:>8} {ratio:>8.2f}x{'  REGRESSION' if regression else ''}")
+        if regressions:
+            print(f'{regressions} benchmarks are more than {REGRESSION_THRESHOLD}x slower than the baseline')
@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+
+from boot_django import boot_django, APP_NAME  # noqa
+
+
+boot_django()
+print(f'running benchmarks for {APP_NAME}')
+
+from benchmarks import main  # noqa: E402 (tom_fink modules need a configured Django)
+
+main()
@@ -1,8 +1,72 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import tempfile
+import time
+import unittest
+import urllib.request
+from unittest import mock
 
+from astropy.time import Time, TimezoneInfo
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.db.utils import OperationalError
+from django.test import RequestFactory, TestCase, override_settings
+import fastavro
+import numpy as np
+
+from tom_dataproducts.models import PhotometryReducedDatum
 from tom_dataservices.dataservices import QueryServiceError
+from tom_targets.models import Target, TargetExtra, TargetList
+
+from tom_fink.alertstream import (
+    FinkAlertStream, alert_batch_logger, alert_logger, alert_photometry, ingest_alert_photometry
+)
+from tom_fink.cache import FinkQueryCache, QueryResultStore, get_cache_backend, seconds_until_refresh
+from tom_fink.client import FinkClient, RateLimiter
+from tom_fink.columnar import group_indices, grouped_median
+from tom_fink.consumer import FinkConsumer, OffsetTracker
+from tom_fink.filters import AlertFilter
+from tom_fink.fink import FinkDataService, FinkServiceForm, jd_to_datetimes, render_markdown
+from tom_fink.instrumentation import NULL_SPAN, Instrumentation, default_profile_dir, instrumentation
+from tom_fink.known_objects import KnownObjects, known_objects
+from tom_fink.metrics import MetricsServer, StreamMetrics
+from tom_fink.replay import Pacer, iter_alert_batches
+from tom_fink.spill import SpillLog
+from tom_fink.views import metrics
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 
-from tom_fink.fink import FinkDataService
+def clear_caches():
+    """Clear the default cache and the response cache of FinkDataService"""
+    cache.clear()
+    get_cache_backend().clear()
+
+
+def make_alert(objectId, jd, fid=1, magpsf=18.0, candid=None):
+    """Return a Fink REST API alert with the columns requested by FinkDataService.query_service"""
+    return {
+        'i:objectId': objectId,
+        'i:candid': candid if candid is not None else int(jd * 1e6),
+        'i:ra': 92.5117956,
+        'i:dec': 36.1095938,
+        'i:jd': jd,
+        'i:fid': fid,
+        'i:magpsf': magpsf,
+        'd:cdsxmatch': 'EclBin',
+        'd:rf_snia_vs_nonia': 0.0,
+    }
 
 
 class TestFinkDataservice(TestCase):
@@ -94,3 +158,1252 @@ class TestFinkDataservice(TestCase):
         expected_query_parameters = {'objectId': '', 'class': 'AGN'}
         query_parameters = self.fink_query.build_query_parameters(form_output)
         self.assertEqual(query_parameters['class'], expected_query_parameters['class'])
+
+    def test_form_help_text_is_rendered_lazily(self):
+        render_markdown.cache_clear()
+        help_text = FinkServiceForm.base_fields['objectId'].help_text
+        self.assertEqual(render_markdown.cache_info().currsize, 0)
+        self.assertIn('ZTF19acmdpyr', str(help_text))
+        str(FinkServiceForm().fields['objectId'].help_text)
+        self.assertEqual((render_markdown.cache_info().hits, render_markdown.cache_info().misses), (1, 1))
+
+
+class TestFinkClient(TestCase):
+    def setUp(self):
+        self.client = FinkClient('https://fink.example.org/api/v1/', timeouts={'latests': 300}, read_timeout=30)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_get_timeout_per_endpoint(self):
+        self.assertEqual(self.client.get_timeout('latests'), (10, 300))
+        self.assertEqual(self.client.get_timeout('objects'), (10, 60))
+        self.assertEqual(self.client.get_timeout('sso'), (10, 30))
+
+    def test_stats_before_any_request(self):
+        self.assertEqual(self.client.stats(),
+                         {'requests': 0, 'errors': 0, 'connections_opened': 0, 'connections_reused': 0,
+                          'throttled_seconds': 0.0})
+
+    def test_retry_without_jitter_support(self):
+        # urllib3 1.26: Retry has no backoff_jitter
+        with mock.patch('tom_fink.client.RETRY_SUPPORTS_JITTER', False), \
+                mock.patch('tom_fink.client.Retry') as retry:
+            FinkClient('https://fink.example.org/api/v1/', backoff_jitter=0.5).close()
+        self.assertNotIn('backoff_jitter', retry.call_args.kwargs)
+
+    def test_rate_limiter_spaces_requests(self):
+        rate_limiter = RateLimiter(100)
+        start = time.monotonic()
+        for _ in range(6):
+            rate_limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+    def test_shared_client(self):
+        self.assertIs(FinkDataService.get_client(), FinkDataService().get_client())
+
+    def test_query_service_uses_shared_client(self):
+        fake_client = mock.Mock()
+        fake_client.post.return_value.json.return_value = []
+        with mock.patch.object(FinkDataService, 'get_client', return_value=fake_client):
+            FinkDataService().query_service({'ra': '12', 'dec': '12', 'radius': '5'}, use_cache=False)
+        endpoint = fake_client.post.call_args.args[0]
+        self.assertEqual(endpoint, 'conesearch')
+
+
+class TestFinkInstrumentation(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.alerts = [make_alert('ZTF18abzktuy', 2461051.79), make_alert('ZTF18abzktuy', 2461052.79, fid=2)]
+        self.client = mock.Mock()
+        self.client.post.return_value.json.return_value = self.alerts
+        self.client.post.return_value.content = json.dumps(self.alerts).encode()
+        # read the instrumentation setting again
+        FinkDataService._instrumentation_configured = False
+
+    def tearDown(self):
+        instrumentation.configure(enabled=False, log_spans=False, profile_threshold=None, profile_sample_rate=0.1)
+        instrumentation.reset()
+        FinkDataService._instrumentation_configured = False
+        self.directory.cleanup()
+
+    def test_disabled_span_is_a_noop(self):
+        self.assertIs(Instrumentation().span('stage'), NULL_SPAN)
+
+    def test_query_targets_spans(self):
+        instrumentation.configure(enabled=True)
+        with mock.patch.object(FinkDataService, 'get_client', return_value=self.client):
+            FinkDataService().query_targets({'objectId': 'ZTF18abzktuy'}, use_cache=False)
+        stats = instrumentation.stats()
+        self.assertEqual(sorted(stats), ['fetch.decode', 'fetch.request', 'query_service', 'query_targets',
+                                         'query_targets.group'])
+        self.assertEqual(stats['fetch.decode']['rows'], 2)
+        self.assertEqual(stats['fetch.decode']['bytes'], len(self.client.post.return_value.content))
+        self.assertEqual(stats['query_targets']['rows'], 1)
+        metrics = instrumentation.prometheus()
+        self.assertIn('tom_fink_stage_seconds_count{stage="query_targets"} 1', metrics)
+        self.assertIn('tom_fink_stage_seconds_bucket{stage="query_targets",le="+Inf"} 1', metrics)
+        self.assertIn('tom_fink_stage_rows_total{stage="fetch.decode"} 2', metrics)
+
+    def test_slow_calls_are_profiled(self):
+        instrumentation.configure(enabled=True, profile_threshold=0.0, profile_sample_rate=1.0,
+                                  profile_dir=self.directory.name)
+        with mock.patch.object(FinkDataService, 'get_client', return_value=self.client):
+            FinkDataService().query_targets({'objectId': 'ZTF18abzktuy'}, use_cache=False)
+        # only the outermost call is profiled
+        self.assertEqual([name.split('-')[0] for name in os.listdir(self.directory.name)], ['query_targets'])
+
+    def test_default_profile_dir(self):
+        with override_settings(MEDIA_ROOT=self.directory.name):
+            self.assertEqual(default_profile_dir(), os.path.join(self.directory.name, 'fink_profiles'))
+
+    def test_metrics_view(self):
+        request = RequestFactory().get('/fink/metrics/')
+        request.user = AnonymousUser()
+        with override_settings(DATA_SERVICES={'Fink': {'instrumentation': {'enabled': True}}}):
+            FinkDataService.get_instrumentation().record('query_service', 0.1)
+            self.assertEqual(metrics(request).status_code, 403)
+            request.user = User(username='admin', is_staff=True)
+            response = metrics(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'tom_fink_stage_seconds_count{stage="query_service"} 1', response.content)
+
+        # scrapers use a token
+        request = RequestFactory().get('/fink/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        request.user = AnonymousUser()
+        with override_settings(DATA_SERVICES={'Fink': {'metrics_token': 'secret'}}):
+            self.assertEqual(metrics(request).status_code, 200)
+            request.headers = {'Authorization': 'Bearer wrong'}
+            self.assertEqual(metrics(request).status_code, 403)
+
+    def test_configuration_from_settings(self):
+        with override_settings(DATA_SERVICES={'Fink': {'instrumentation': {'enabled': True, 'log_spans': True}}}):
+            with self.assertLogs('tom_fink.instrumentation', level='INFO') as logs:
+                with FinkDataService.get_instrumentation().span('stage', rows=3):
+                    pass
+        self.assertEqual(json.loads(logs.records[0].getMessage())['rows'], 3)
+
+
+class TestFinkAsync(TestCase):
+    def setUp(self):
+        self.alerts = [make_alert('ZTF18abzktuy', 2461051.79), make_alert('ZTF18abzktuy', 2461052.79)]
+        self.fake_client = mock.Mock()
+        self.fake_client.post.return_value.json.return_value = self.alerts
+
+    async def test_aquery_targets(self):
+        with mock.patch.object(FinkDataService, 'get_client', return_value=self.fake_client):
+            rows = await FinkDataService().aquery_targets({'objectId': 'ZTF18abzktuy'}, use_cache=False)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['num_alerts'], 2)
+        self.assertEqual(FinkDataService().load_query_result(rows[0]['reduced_datums']['photometry']), self.alerts)
+
+    async def test_aquery_photometry_stream(self):
+        self.fake_client.post.return_value.encoding = 'utf-8'
+        self.fake_client.post.return_value.iter_content.return_value = [json.dumps(self.alerts).encode()]
+        with mock.patch.object(FinkDataService, 'get_client', return_value=self.fake_client):
+            alerts = await FinkDataService().aquery_photometry({'objectId': 'ZTF18abzktuy'}, stream=True)
+        self.assertEqual(alerts, self.alerts)
+
+
+class TestFinkBatchPhotometry(TestCase):
+    def setUp(self):
+        self.fink_query = FinkDataService()
+        self.targets = [
+            Target.objects.create(name=name, type='SIDEREAL', ra=92.5, dec=36.1)
+            for name in ['ZTF18abzktuy', 'ZTF19acmdpyr', 'ZTF20abqehqf']
+        ]
+        self.alerts = [
+            make_alert('ZTF18abzktuy', 2461051.79),
+            make_alert('ZTF18abzktuy', 2461052.79, fid=2),
+            make_alert('ZTF19acmdpyr', 2461051.80),
+        ]
+
+    def fake_query_service(self, parameters, **kwargs):
+        objectIds = parameters['objectId'].split(',')
+        return [dict(alert) for alert in self.alerts if alert['i:objectId'] in objectIds]
+
+    def test_query_photometry_batch_chunks_objectids(self):
+        with mock.patch.object(FinkDataService, 'query_service', side_effect=self.fake_query_service) as query:
+            alerts_for_target = self.fink_query.query_photometry_batch(self.targets, batch_size=2)
+        self.assertEqual([call.args[0]['objectId'] for call in query.call_args_list],
+                         ['ZTF18abzktuy,ZTF19acmdpyr', 'ZTF20abqehqf'])
+        self.assertEqual([len(alerts_for_target[target]) for target in self.targets], [2, 1, 0])
+
+    def test_query_photometry_batch_skips_targets_without_ztf_name(self):
+        other = Target.objects.create(name='AT2020abc', type='SIDEREAL', ra=1.0, dec=2.0)
+        with mock.patch.object(FinkDataService, 'query_service', side_effect=self.fake_query_service):
+            alerts_for_target = self.fink_query.query_photometry_batch(self.targets + [other])
+        self.assertNotIn(other, alerts_for_target)
+
+    def test_to_reduced_datums_batch(self):
+        with mock.patch.object(FinkDataService, 'query_service', side_effect=self.fake_query_service):
+            datums_for_target = self.fink_query.to_reduced_datums_batch(self.targets)
+        self.assertEqual([len(datums_for_target[target]) for target in self.targets], [2, 1, 0])
+        self.assertEqual(datums_for_target[self.targets[0]][1].bandpass, 'R')
+
+
+class TestFinkRefreshCommand(TestCase):
+    def setUp(self):
+        self.targets = [
+            Target.objects.create(name=name, type='SIDEREAL', ra=92.5, dec=36.1)
+            for name in ['ZTF18abzktuy', 'ZTF19acmdpyr', 'ZTF20abqehqf', 'AT2020abc']
+        ]
+        self.target_list = TargetList.objects.create(name='nightly')
+        self.target_list.targets.add(*self.targets)
+        self.alerts = [
+            make_alert('ZTF18abzktuy', 2461051.79),
+            make_alert('ZTF18abzktuy', 2461052.79, fid=2),
+            make_alert('ZTF19acmdpyr', 2461051.80),
+            make_alert('ZTF20abqehqf', 2461051.81),
+        ]
+
+    def fake_query_service(self, parameters, **kwargs):
+        objectIds = parameters['objectId'].split(',')
+        if 'ZTF20abqehqf' in objectIds:
+            raise QueryServiceError('Fink is down')
+        return [dict(alert) for alert in self.alerts if alert['i:objectId'] in objectIds]
+
+    def test_refresh_target_list(self):
+        with mock.patch.object(FinkDataService, 'query_service', side_effect=self.fake_query_service) as query:
+            result = call_command('updatefinkphotometry', target_list=['nightly'], workers=2, batch_size=1, rate=100)
+        self.assertEqual(query.call_count, 3)
+        self.assertEqual(result, 'Update completed with errors for 1 targets: ZTF20abqehqf')
+        self.assertEqual([PhotometryReducedDatum.objects.filter(target=target).count() for target in self.targets],
+                         [2, 1, 0, 0])
+        # the rate limit only applies during the refresh
+        self.assertIsNone(FinkDataService.get_client().rate_limiter)
+        self.assertTrue(all(call.kwargs['use_cache'] for call in query.call_args_list))
+
+    def test_malformed_response_only_fails_its_chunk(self):
+        def fake_query_service(parameters, **kwargs):
+            if parameters['objectId'] == 'ZTF19acmdpyr':
+                return [{'i:jd': 2461051.80}]  # no objectId
+            return self.fake_query_service(parameters, **kwargs)
+
+        with mock.patch.object(FinkDataService, 'query_service', side_effect=fake_query_service), \
+                self.assertLogs('tom_fink.management.commands.updatefinkphotometry', level='ERROR'):
+            result = call_command('updatefinkphotometry', target_list=['nightly'], workers=2, batch_size=1, rate=100)
+        self.assertEqual(sorted(result.split(': ')[1].split(', ')), ['ZTF19acmdpyr', 'ZTF20abqehqf'])
+        self.assertEqual(PhotometryReducedDatum.objects.filter(target=self.targets[0]).count(), 2)
+
+    def test_full_resync_ignores_the_cache(self):
+        with mock.patch.object(FinkDataService, 'query_service', side_effect=self.fake_query_service) as query:
+            call_command('updatefinkphotometry', target_list=['nightly'], batch_size=1, rate=100, full_resync=True)
+        self.assertFalse(any(call.kwargs['use_cache'] for call in query.call_args_list))
+
+
+class TestFinkQueryCache(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.fake_client = mock.Mock()
+        self.fake_client.post.return_value.json.return_value = [make_alert('ZTF18abzktuy', 2461051.79)]
+
+    def test_make_key_normalizes_payload(self):
+        query_cache = FinkQueryCache()
+        self.assertEqual(query_cache.make_key('latests', {'class': 'AGN', 'n': ' 15'}),
+                         query_cache.make_key('latests', {'n': '15', 'class': 'AGN '}))
+        self.assertNotEqual(query_cache.make_key('latests', {'class': 'AGN', 'n': '15'}),
+                            query_cache.make_key('objects', {'class': 'AGN', 'n': '15'}))
+
+    def test_seconds_until_refresh(self):
+        before = datetime.datetime(2025, 1, 1, 13, 0, tzinfo=datetime.timezone.utc)
+        after = datetime.datetime(2025, 1, 1, 15, 0, tzinfo=datetime.timezone.utc)
+        self.assertEqual(seconds_until_refresh(14, now=before), 3600)
+        self.assertEqual(seconds_until_refresh(14, now=after), 23 * 3600)
+
+    def test_query_service_cache_hit(self):
+        stats_before = FinkDataService.get_cache_stats()
+        with mock.patch.object(FinkDataService, 'get_client', return_value=self.fake_client):
+            first = FinkDataService().query_service({'class': 'AGN', 'n': '15'})
+            second = FinkDataService().query_service({'class': 'AGN', 'n': ' 15'})
+        self.assertEqual(first, second)
+        self.assertEqual(self.fake_client.post.call_count, 1)
+        stats = FinkDataService.get_cache_stats()
+        self.assertEqual(stats['hits'] - stats_before['hits'], 1)
+        self.assertEqual(stats['misses'] - stats_before['misses'], 1)
+
+    def test_cache_survives_the_dataservices_views(self):
+        with mock.patch.object(FinkDataService, 'get_client', return_value=self.fake_client):
+            FinkDataService().query_service({'class': 'AGN', 'n': '15'})
+            # the views clear the default cache when a new query is run
+            cache.clear()
+            FinkDataService().query_service({'class': 'AGN', 'n': '15'})
+        self.assertEqual(self.fake_client.post.call_count, 1)
+
+    def test_queries_relative_to_now_are_not_cached(self):
+        with mock.patch.object(FinkDataService, 'get_client', return_value=self.fake_client):
+            for _ in range(2):
+                FinkDataService().query_service(
+                    {'class': 'AGN', 'start': '2025-01-01 00:00:00', 'end': '2025-01-02 00:00:00'}
+                )
+        self.assertEqual(self.fake_client.post.call_count, 2)
+        self.assertFalse(FinkQueryCache.cacheable({'class': 'AGN', 'startdate': '2025-01-01'}))
+
+    def test_query_service_cache_bypass(self):
+        with mock.patch.object(FinkDataService, 'get_client', return_value=self.fake_client):
+            FinkDataService().query_service({'class': 'AGN', 'n': '15'})
+            FinkDataService().query_service({'class': 'AGN', 'n': '15'}, use_cache=False)
+        self.assertEqual(self.fake_client.post.call_count, 2)
+
+
+class TestFinkStreaming(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.alerts = [make_alert('ZTF18abzktuy', 2461051.79 + i, magpsf=18.0 + i) for i in range(5)]
+        self.alerts += [make_alert('ZTF19acmdpyr', 2461051.80)]
+
+    def fake_client(self, body):
+        """Return a FinkClient stand-in whose response body comes in chunks of 7 bytes"""
+        client = mock.Mock()
+        response = client.post.return_value
+        response.encoding = None
+        response.json.return_value = json.loads(body)
+        response.iter_content.side_effect = lambda chunk_size=1: (
+            body[i:i + 7].encode() for i in range(0, len(body), 7)
+        )
+        return client
+
+    def test_query_targets_stream(self):
+        client = self.fake_client(json.dumps(self.alerts))
+        with mock.patch.object(FinkDataService, 'get_client', return_value=client):
+            streamed = FinkDataService().query_targets({'class': 'EB*', 'n': '6'}, stream=True)
+            loaded = FinkDataService().query_targets({'class': 'EB*', 'n': '6'}, stream=False)
+        self.assertEqual(client.post.call_args_list[0].kwargs['stream'], True)
+        # the alerts of streamed responses are not kept: the photometry is queried when targets are created
+        self.assertEqual(streamed, [{key: value for key, value in row.items() if key != 'reduced_datums'}
+                                    for row in loaded])
+        self.assertEqual([row['num_alerts'] for row in streamed], [5, 1])
+        self.assertEqual(streamed[0]['mag'], 20.0)
+
+    def test_stream_medians_are_bounded(self):
+        client = self.fake_client(json.dumps(self.alerts))
+        with mock.patch.object(FinkDataService, 'get_client', return_value=client), \
+                mock.patch('tom_fink.fink.MAX_MEDIAN_SAMPLES', 2):
+            streamed = FinkDataService().query_targets({'class': 'EB*', 'n': '6'}, stream=True)
+        self.assertEqual(streamed[0]['num_alerts'], 5)
+        self.assertEqual(streamed[0]['mag'], 18.5)  # of the first 2 alerts
+        self.assertEqual(streamed[0]['jd_max'], self.alerts[4]['i:jd'])
+
+    def test_stream_is_timed_as_consumed(self):
+        client = self.fake_client(json.dumps(self.alerts))
+        instrumentation.reset()
+        with mock.patch.object(instrumentation, 'enabled', True), \
+                mock.patch.object(FinkDataService, 'get_client', return_value=client):
+            alerts = FinkDataService().query_service({'class': 'EB*', 'n': '6'}, stream=True)
+            self.assertNotIn('query_service', instrumentation.stats())
+            self.assertEqual(len(list(alerts)), 6)
+        self.assertEqual(instrumentation.stats()['query_service']['rows'], 6)
+
+    def test_query_service_stream_malformed(self):
+        client = self.fake_client('{"status": "error"}')
+        with mock.patch.object(FinkDataService, 'get_client', return_value=client):
+            alerts = FinkDataService().query_service({'class': 'EB*', 'n': '6'}, stream=True)
+            with self.assertRaises(QueryServiceError):
+                list(alerts)
+
+
+class TestFinkColumnar(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.alerts = [
+            make_alert('ZTF19acmdpyr', 2461053.5, magpsf=17.0),
+            make_alert('ZTF18abzktuy', 2461051.5, magpsf=19.0),
+            make_alert('ZTF19acmdpyr', 2461052.5, magpsf=18.0),
+            make_alert('ZTF18abzktuy', 2461050.5, magpsf=18.5),
+            make_alert('ZTF19acmdpyr', 2461051.5, magpsf=16.0),
+        ]
+
+    def test_grouped_median(self):
+        codes = np.array([1, 0, 1, 0, 1, 2])
+        values = np.array([3.0, 10.0, 1.0, 20.0, 2.0, 5.0])
+        order, starts, counts = group_indices(codes)
+        self.assertEqual(counts.tolist(), [2, 3, 1])
+        self.assertEqual(grouped_median(values, order, starts, counts).tolist(), [15.0, 2.0, 5.0])
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_query_targets_columnar(self):
+        sink = io.BytesIO()
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(self.alerts), sink)
+        client = mock.Mock()
+        client.post.return_value.content = sink.getvalue()
+        client.post.return_value.json.return_value = self.alerts
+        with mock.patch.object(FinkDataService, 'get_client', return_value=client):
+            columnar_rows = FinkDataService().query_targets({'class': 'EB*', 'n': '5'}, columnar=True)
+            json_rows = FinkDataService().query_targets({'class': 'EB*', 'n': '5'}, columnar=False)
+        self.assertEqual(client.post.call_args_list[0].kwargs['json']['output-format'], 'parquet')
+        self.assertEqual([row['name'] for row in columnar_rows], ['ZTF19acmdpyr', 'ZTF18abzktuy'])
+        for columnar_row, json_row in zip(load_rows(columnar_rows), load_rows(json_rows)):
+            self.assertEqual(columnar_row, json_row)
+
+
+class TestFinkQueryResultStore(TestCase):
+    def setUp(self):
+        clear_caches()
+        FinkDataService._result_store = None
+        self.alerts = [
+            make_alert('ZTF18abzktuy', 2461051.79, candid=1),
+            make_alert('ZTF18abzktuy', 2461052.79, candid=2),
+            make_alert('ZTF19acmdpyr', 2461052.79, candid=3),
+        ]
+        self.client = mock.Mock()
+        self.client.post.return_value.json.return_value = self.alerts
+
+    def tearDown(self):
+        FinkDataService._result_store = None
+
+    def test_rows_refer_to_stored_alerts(self):
+        with mock.patch.object(FinkDataService, 'get_client', return_value=self.client):
+            rows = FinkDataService().query_targets({'ra': 92.5, 'dec': 36.1, 'radius': 5}, use_cache=False)
+        references = [row['reduced_datums']['photometry'] for row in rows]
+        self.assertEqual([reference['objectId'] for reference in references], ['ZTF18abzktuy', 'ZTF19acmdpyr'])
+        self.assertEqual(references[0]['query_id'], references[1]['query_id'])
+        self.assertEqual(rows[0]['num_alerts'], 2)
+
+        target = Target.objects.create(name='ZTF18abzktuy', type='SIDEREAL', ra=92.5, dec=36.1)
+        service = FinkDataService()
+        datums = service.to_reduced_datums(target, rows[0]['reduced_datums'])
+        self.assertEqual(sorted(datum.value['i:candid'] for datum in datums), [1, 2])
+        self.assertEqual(service.load_query_result(references[1]), self.alerts[2:])
+        # stored as the bytes pickled to check their size
+        self.assertEqual(pickle.loads(get_cache_backend().get(FinkDataService.get_result_store().make_key(
+            references[1]['query_id'], 'ZTF19acmdpyr'))), self.alerts[2:])
+        self.assertIsNone(cache.get(FinkDataService.get_result_store().make_key(
+            references[1]['query_id'], 'ZTF19acmdpyr')))
+
+    def test_large_results_stay_in_the_rows(self):
+        store = QueryResultStore(max_entry_size=len(pickle.dumps(self.alerts[2:], pickle.HIGHEST_PROTOCOL)))
+        with mock.patch.object(FinkDataService, 'get_result_store', return_value=store), \
+                mock.patch.object(FinkDataService, 'get_client', return_value=self.client):
+            with self.assertLogs('tom_fink.cache', level='WARNING') as logs:
+                rows = FinkDataService().query_targets({'ra': 92.5, 'dec': 36.1, 'radius': 5}, use_cache=False)
+        self.assertIn('ZTF18abzktuy not stored', logs.output[0])
+        self.assertEqual(rows[0]['reduced_datums']['photometry'], self.alerts[:2])
+        self.assertTrue(QueryResultStore.is_reference(rows[1]['reduced_datums']['photometry']))
+
+    def test_query_size_is_bounded(self):
+        size = len(pickle.dumps(self.alerts[:2], pickle.HIGHEST_PROTOCOL))
+        store = QueryResultStore(max_query_size=size)
+        with self.assertLogs('tom_fink.cache', level='WARNING') as logs:
+            query_id, stored = store.save({'ZTF18abzktuy': self.alerts[:2], 'ZTF19acmdpyr': self.alerts[2:]})
+        self.assertIn('alerts of ZTF19acmdpyr not stored', logs.output[0])
+        self.assertEqual(stored, {'ZTF18abzktuy'})
+        self.assertEqual(store.load(query_id, 'ZTF18abzktuy'), self.alerts[:2])
+
+    def test_failed_store_is_logged(self):
+        store = QueryResultStore()
+        with mock.patch.object(store.backend, 'set_many', return_value=[store.make_key('id', 'ZTF18abzktuy')]), \
+                mock.patch('tom_fink.cache.uuid.uuid4', return_value=mock.Mock(hex='id')):
+            with self.assertLogs('tom_fink.cache', level='WARNING') as logs:
+                query_id, stored = store.save({'ZTF18abzktuy': self.alerts[:2], 'ZTF19acmdpyr': self.alerts[2:]})
+        self.assertIn('1 of 2 objects of query id not stored', logs.output[0])
+        self.assertEqual(stored, {'ZTF19acmdpyr'})
+
+    def test_expired_results_are_queried_again(self):
+        target = Target.objects.create(name='ZTF18abzktuy', type='SIDEREAL', ra=92.5, dec=36.1)
+        self.client.post.return_value.json.return_value = self.alerts[:2]
+        with mock.patch.object(FinkDataService, 'get_client', return_value=self.client):
+            datums = FinkDataService().create_reduced_datums_from_query(
+                target, QueryResultStore.reference('expired', 'ZTF18abzktuy'), 'photometry'
+            )
+        self.assertEqual(self.client.post.call_args.kwargs['json']['objectId'], 'ZTF18abzktuy')
+        self.assertEqual(len(datums), 2)
+
+    def test_store_disabled(self):
+        with override_settings(DATA_SERVICES={'Fink': {'store_query_results': False}}):
+            with mock.patch.object(FinkDataService, 'get_client', return_value=self.client):
+                rows = FinkDataService().query_targets({'ra': 92.5, 'dec': 36.1, 'radius': 5}, use_cache=False)
+        self.assertEqual(rows[0]['reduced_datums']['photometry'], self.alerts[:2])
+
+
+class TestFinkConversions(TestCase):
+    def test_jd_to_datetimes(self):
+        jds = [2461051.7947569, 2459000.5, 2460000.123456789, 2458849.99999999]
+        expected = [Time(jd, format='jd', scale='utc').to_datetime(TimezoneInfo()) for jd in jds]
+        self.assertEqual(jd_to_datetimes(jds), expected)
+        self.assertEqual(jd_to_datetimes([]), [])
+
+    def test_create_reduced_datums_from_query(self):
+        target = Target.objects.create(name='ZTF18abzktuy', type='SIDEREAL', ra=92.5, dec=36.1)
+        alerts = [make_alert('ZTF18abzktuy', 2461051.79, fid=fid) for fid in (1, 2, 3)]
+        reduced_datums = FinkDataService().create_reduced_datums_from_query(target, alerts)
+        self.assertEqual([datum.bandpass for datum in reduced_datums], ['g', 'R', 'i'])
+        self.assertEqual(reduced_datums[0].timestamp,
+                         Time(2461051.79, format='jd', scale='utc').to_datetime(TimezoneInfo()))
+
+
+class TestFinkBulkIngest(TestCase):
+    def setUp(self):
+        self.fink_query = FinkDataService()
+        self.target = Target.objects.create(name='ZTF18abzktuy', type='SIDEREAL', ra=92.5, dec=36.1)
+
+    def alerts(self, num_alerts=50):
+        return [make_alert('ZTF18abzktuy', 2461051.5 + 0.1 * i, fid=1 + i % 2) for i in range(num_alerts)]
+
+    def test_bulk_ingest_is_idempotent(self):
+        created = self.fink_query.create_reduced_datums_from_query(self.target, self.alerts(), bulk=True)
+        self.assertEqual(len(created), 50)
+        self.assertEqual(PhotometryReducedDatum.objects.filter(target=self.target).count(), 50)
+
+        # existing Fink photometry + photometry of other sources; nothing to insert
+        with self.assertNumQueries(2):
+            rerun = self.fink_query.create_reduced_datums_from_query(self.target, self.alerts(), bulk=True,
+                                                                     full_resync=True)
+        self.assertEqual([datum.pk for datum in rerun], [datum.pk for datum in created])
+
+    def test_bulk_ingest_matches_get_or_create(self):
+        self.fink_query.create_reduced_datums_from_query(self.target, self.alerts(10), bulk=False)
+        rerun = self.fink_query.create_reduced_datums_from_query(self.target, self.alerts(20), bulk=True,
+                                                                 full_resync=True)
+        self.assertEqual(len({datum.pk for datum in rerun}), 20)
+        self.assertEqual(PhotometryReducedDatum.objects.filter(target=self.target).count(), 20)
+
+    def test_bulk_ingest_deduplicates(self):
+        alerts = self.alerts(3)
+        alerts.append(dict(alerts[0]))  # same candid
+        PhotometryReducedDatum.objects.create(
+            target=self.target, timestamp=jd_to_datetimes([alerts[1]['i:jd']])[0], bandpass='R',
+            source_name='OtherBroker', brightness=18.0,
+        )
+        created = self.fink_query.create_reduced_datums_from_query(self.target, alerts, bulk=True)
+        self.assertEqual(len(created), 3)
+        self.assertEqual(PhotometryReducedDatum.objects.filter(target=self.target, source_name='Fink').count(), 2)
+
+    def test_bulk_ingest_concurrent_insert(self):
+        alerts = self.alerts(5)
+        bulk_create = PhotometryReducedDatum.objects.bulk_create
+
+        def concurrent_bulk_create(datums, **kwargs):
+            # another writer saves the first alert between the lookup and the insert
+            first = datums[0]
+            PhotometryReducedDatum.objects.create(
+                target=first.target, timestamp=first.timestamp, bandpass=first.bandpass,
+                source_name=first.source_name, value=first.value, brightness=first.brightness,
+            )
+            return bulk_create(datums, **kwargs)
+
+        with mock.patch.object(PhotometryReducedDatum.objects, 'bulk_create', side_effect=concurrent_bulk_create):
+            created = self.fink_query.create_reduced_datums_from_query(self.target, alerts, bulk=True)
+        self.assertEqual(len({datum.pk for datum in created}), 5)
+        self.assertTrue(all(datum.pk is not None for datum in created))
+        self.assertEqual(PhotometryReducedDatum.objects.filter(target=self.target).count(), 5)
+
+
+class TestFinkIncrementalSync(TestCase):
+    def setUp(self):
+        self.target = Target.objects.create(name='ZTF18abzktuy', type='SIDEREAL', ra=92.5, dec=36.1)
+
+    def alerts(self, num_alerts):
+        return [make_alert('ZTF18abzktuy', 2461051.5 + 0.1 * i, fid=1 + i % 2) for i in range(num_alerts)]
+
+    def test_only_new_alerts_are_ingested(self):
+        FinkDataService().create_reduced_datums_from_query(self.target, self.alerts(10))
+        fink_query = FinkDataService()
+        with self.captureOnCommitCallbacks(execute=True):
+            created = fink_query.create_reduced_datums_from_query(self.target, self.alerts(15), incremental=True)
+        self.assertEqual(len(created), 5)
+        self.assertEqual(fink_query.get_photometry_watermark(self.target), created[-1].timestamp)
+        # the watermark has moved on: nothing left to ingest, and no query to find that out
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                fink_query.create_reduced_datums_from_query(self.target, self.alerts(15), incremental=True), []
+            )
+
+    def test_all_datums_are_returned_by_default(self):
+        FinkDataService().create_reduced_datums_from_query(self.target, self.alerts(10))
+        datums = FinkDataService().create_reduced_datums_from_query(self.target, self.alerts(15))
+        self.assertEqual(len(datums), 15)
+
+    def test_watermark_waits_for_the_commit(self):
+        fink_query = FinkDataService()
+        self.assertIsNone(fink_query.get_photometry_watermark(self.target))
+        with mock.patch.object(PhotometryReducedDatum.objects, 'bulk_create', side_effect=OperationalError('down')):
+            with self.assertRaises(OperationalError):
+                fink_query.create_reduced_datums_from_query(self.target, self.alerts(5), incremental=True, bulk=True)
+        self.assertIsNone(fink_query.get_photometry_watermark(self.target))
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            created = fink_query.create_reduced_datums_from_query(self.target, self.alerts(5), incremental=True)
+        self.assertEqual(len(created), 5)
+        self.assertIsNone(fink_query.get_photometry_watermark(self.target))
+        callbacks[0]()
+        self.assertEqual(fink_query.get_photometry_watermark(self.target), created[-1].timestamp)
+
+    def test_watermarks_are_bounded(self):
+        fink_query = FinkDataService()
+        targets = [Target.objects.create(name=f'ZTF{i}', type='SIDEREAL', ra=1.0, dec=2.0) for i in range(3)]
+        with mock.patch('tom_fink.fink.MAX_PHOTOMETRY_WATERMARKS', 2):
+            fink_query.load_photometry_watermarks(targets)
+            fink_query.get_photometry_watermark(self.target)
+        self.assertEqual(list(fink_query.photometry_watermarks), [targets[2].pk, self.target.pk])
+
+    def test_full_resync(self):
+        FinkDataService().create_reduced_datums_from_query(self.target, self.alerts(10))
+        PhotometryReducedDatum.objects.filter(target=self.target).order_by('timestamp').first().delete()
+        resynced = FinkDataService().create_reduced_datums_from_query(self.target, self.alerts(10), full_resync=True)
+        self.assertEqual(len(resynced), 10)
+        self.assertEqual(PhotometryReducedDatum.objects.filter(target=self.target).count(), 10)
+
+    def test_load_photometry_watermarks(self):
+        other = Target.objects.create(name='ZTF19acmdpyr', type='SIDEREAL', ra=1.0, dec=2.0)
+        FinkDataService().create_reduced_datums_from_query(self.target, self.alerts(3))
+        fink_query = FinkDataService()
+        with self.assertNumQueries(1):
+            fink_query.load_photometry_watermarks([self.target, other])
+        self.assertIsNone(fink_query.get_photometry_watermark(other))
+        self.assertEqual(fink_query.get_photometry_watermark(self.target),
+                         jd_to_datetimes([self.alerts(3)[-1]['i:jd']])[0])
+
+
+def make_stream_alert(objectId, jd, ra=92.5117956, dec=36.1095938):
+    """Return a Fink livestream alert, as decoded by AlertConsumer"""
+    return {'objectId': objectId, 'candidate': {'jd': jd, 'ra': ra, 'dec': dec, 'magpsf': 18.0, 'fid': 1}}
+
+
+class TestFinkAlertStreamBatch(TestCase):
+    def setUp(self):
+        self.options = {
+            'URL': 'localhost:9093',
+            'USERNAME': 'tom',
+            'GROUP_ID': 'tom_group',
+            'TOPIC': 'fink_early_sn_candidates_ztf',
+            'TOPIC_HANDLERS': {'fink.stream': 'tom_fink.alertstream.alert_batch_logger'},
+            'MAX_POLL_NUMBER': 4,
+            'TIMEOUT': 1,
+            'BATCH_SIZE': 3,
+            'BATCH_TIMEOUT': 500,
+        }
+        known_objects.clear()
+
+    def test_alert_batch_logger(self):
+        existing = Target.objects.create(name='ZTF18abzktuy', type='SIDEREAL', ra=1.0, dec=2.0)
+        other = Target.objects.create(name='AT2020abc', type='SIDEREAL', ra=3.0, dec=4.0)
+        other.aliases.create(name='ZTF20abqehqf')
+        alerts = [
+            make_stream_alert('ZTF19acmdpyr', 2461051.5, ra=10.0),
+            make_stream_alert('ZTF18abzktuy', 2461051.6),
+            make_stream_alert('ZTF19acmdpyr', 2461052.5, ra=11.0),
+            make_stream_alert('ZTF20abqehqf', 2461051.7),
+        ]
+        created = alert_batch_logger(alerts, 'fink_early_sn_candidates_ztf')
+        self.assertEqual([target.name for target in created], ['ZTF19acmdpyr'])
+        target = Target.objects.get(name='ZTF19acmdpyr')
+        self.assertEqual(target.ra, 11.0)  # from the most recent alert
+        self.assertEqual(TargetExtra.objects.get(target=target, key='fink broker link').value,
+                         'https://fink-portal.org/ZTF19acmdpyr')
+        self.assertEqual(Target.objects.get(pk=existing.pk).ra, 1.0)
+        self.assertEqual(Target.objects.count(), 3)
+
+    def test_listen_batch_mode(self):
+        topic = self.options['TOPIC']
+        consumer = mock.Mock()
+        consumer.consume.side_effect = [
+            [(topic, make_stream_alert('ZTF19acmdpyr', 2461051.5), ''),
+             (topic, make_stream_alert('ZTF18abzktuy', 2461051.6), '')],
+            [],
+            [(topic, make_stream_alert('ZTF18abzktuy', 2461052.6), '')],
+        ]
+        with mock.patch('tom_fink.consumer.FinkConsumer', return_value=consumer):
+            FinkAlertStream(**self.options).listen()
+        # 2 alerts + 1 empty poll + 1 alert reach MAX_POLL_NUMBER
+        self.assertEqual(consumer.consume.call_args_list, [mock.call(3, timeout=0.5)] * 3)
+        self.assertEqual(sorted(Target.objects.values_list('name', flat=True)), ['ZTF18abzktuy', 'ZTF19acmdpyr'])
+        self.assertEqual(TargetList.objects.get(name='fink_early_sn_candidates_ztf').targets.count(), 2)
+        consumer.close.assert_called_once()
+
+    def test_per_alert_handler_in_batch_mode(self):
+        self.options['TOPIC_HANDLERS'] = {'fink.stream': 'tom_fink.alertstream.alert_logger'}
+        stream = FinkAlertStream(**self.options)
+        topic = self.options['TOPIC']
+        stream.handle_alerts([make_stream_alert('ZTF19acmdpyr', 2461051.5),
+                              make_stream_alert('ZTF18abzktuy', 2461051.6)], topic)
+        self.assertEqual(sorted(TargetList.objects.get(name=topic).targets.values_list('name', flat=True)),
+                         ['ZTF18abzktuy', 'ZTF19acmdpyr'])
+
+    def test_target_extras_are_typed_by_the_model(self):
+        with override_settings(EXTRA_FIELDS=[{'name': 'redshift', 'type': 'number', 'default': '0.5'}]):
+            alert_batch_logger([make_stream_alert('ZTF19acmdpyr', 2461051.5)], self.options['TOPIC'])
+        extra = TargetExtra.objects.get(target__name='ZTF19acmdpyr', key='redshift')
+        self.assertEqual((extra.float_value, extra.bool_value, extra.time_value), (0.5, True, None))
+        with override_settings(EXTRA_FIELDS=[{'name': 'discovered', 'type': 'datetime', 'default': '2026-01-02'}]):
+            alert_batch_logger([make_stream_alert('ZTF18abzktuy', 2461051.5)], self.options['TOPIC'])
+        extra = TargetExtra.objects.get(target__name='ZTF18abzktuy', key='discovered')
+        self.assertEqual((extra.float_value, extra.time_value.date()), (None, datetime.date(2026, 1, 2)))
+
+
+class TestFinkAlertStreamTopics(TestCase):
+    def setUp(self):
+        self.options = {
+            'URL': 'localhost:9093',
+            'USERNAME': 'tom',
+            'GROUP_ID': 'tom_group',
+            'TOPICS': ['fink_early_sn_candidates_ztf', 'fink_sso_ztf_candidates_ztf'],
+            'TOPIC_HANDLERS': {
+                'fink.stream': 'tom_fink.alertstream.alert_logger',
+                'fink_sso_ztf_candidates_ztf': 'tom_fink.tests.tests.ignore_alert',
+            },
+            'MAX_POLL_NUMBER': 3,
+            'TIMEOUT': 1,
+        }
+        known_objects.clear()
+
+    def test_topic_or_topics_required(self):
+        del self.options['TOPICS']
+        with self.assertRaises(ImproperlyConfigured):
+            FinkAlertStream(**self.options)
+
+    def test_listen_multiple_topics(self):
+        consumer = mock.Mock()
+        consumer.poll.side_effect = [
+            ('fink_early_sn_candidates_ztf', make_stream_alert('ZTF19acmdpyr', 2461051.5), ''),
+            ('fink_sso_ztf_candidates_ztf', make_stream_alert('ZTF18abzktuy', 2461051.6), ''),
+            ('fink_early_sn_candidates_ztf', make_stream_alert('ZTF20abqehqf', 2461051.7), ''),
+        ]
+        with mock.patch('tom_fink.consumer.FinkConsumer', return_value=consumer) as fink_consumer:
+            stream = FinkAlertStream(**self.options)
+            stream.listen()
+        self.assertEqual(fink_consumer.call_args.args[0], self.options['TOPICS'])
+        self.assertEqual(set(stream.target_lists), set(self.options['TOPICS']))
+        early_sn = TargetList.objects.get(name='fink_early_sn_candidates_ztf')
+        self.assertEqual(sorted(early_sn.targets.values_list('name', flat=True)), ['ZTF19acmdpyr', 'ZTF20abqehqf'])
+        # the SSO topic has its own handler, which does not create targets
+        self.assertFalse(Target.objects.filter(name='ZTF18abzktuy').exists())
+        self.assertFalse(TargetList.objects.get(name='fink_sso_ztf_candidates_ztf').targets.exists())
+
+    def test_supervise_restarts_crashed_workers(self):
+        # shared with the forked workers: the first worker to finish crashes
+        crashes = multiprocessing.get_context('fork').Value('i', 1)
+
+        def run_consumer(stream, stop_event=None, progress=None):
+            stream.alerts_handled += 10
+            progress()
+            with crashes.get_lock():
+                crashed = crashes.value > 0
+                crashes.value -= crashed
+            return crashed
+
+        stream = FinkAlertStream(**self.options)
+        stream.supervisor_interval = 0.05
+        stream.restart_delay = 0.1
+        with mock.patch.object(FinkAlertStream, 'run_consumer', run_consumer):
+            stats = stream.supervise(3)
+        self.assertEqual(stats, {'alerts': 40, 'restarts': 1, 'failed': False})
+
+    def test_supervise_stops_on_persistent_failure(self):
+        def run_consumer(stream, stop_event=None, progress=None):
+            return True  # e.g. bad credentials: every run fails
+
+        stream = FinkAlertStream(**self.options)
+        stream.supervisor_interval = 0.05
+        stream.restart_delay = 0.05
+        stream.max_restarts = 3
+        with mock.patch.object(FinkAlertStream, 'run_consumer', run_consumer), \
+                self.assertLogs('tom_fink.alertstream', level='WARNING') as logs:
+            stats = stream.supervise(2)
+        self.assertTrue(stats['failed'])
+        self.assertLessEqual(stats['restarts'], 3)
+        # the delay before restarting a worker doubles after each of its crashes
+        self.assertTrue(any('restarting it in 0.1s' in line for line in logs.output))
+        with mock.patch.object(FinkAlertStream, 'supervise', return_value=stats), \
+                self.assertRaises(SystemExit):
+            FinkAlertStream(**self.options, NUM_WORKERS=2).listen()
+
+
+class TestFinkAlertStreamPipeline(TestCase):
+    def setUp(self):
+        self.options = {
+            'URL': 'localhost:9093',
+            'USERNAME': 'tom',
+            'GROUP_ID': 'tom_group',
+            'TOPIC': 'fink_early_sn_candidates_ztf',
+            'TOPIC_HANDLERS': {'fink.stream': 'tom_fink.tests.tests.record_alert'},
+            'MAX_POLL_NUMBER': 5,
+            'TIMEOUT': 1,
+            'WRITER_THREADS': 3,
+            'QUEUE_SIZE': 2,
+        }
+        recorded_alerts.clear()
+
+    def make_consumer(self, num_messages):
+        consumer = mock.Mock()
+        messages = []
+        for offset in range(num_messages):
+            message = mock.Mock()
+            message.partition.return_value = offset % 2
+            message.offset.return_value = offset
+            message.alert = make_stream_alert(f'ZTF{offset}', 2461051.5)
+            messages.append(message)
+        consumer.poll_message.side_effect = messages + [None] * 10
+        consumer.process_message.side_effect = lambda message: (self.options['TOPIC'], message.alert, '')
+        return consumer
+
+    def test_offset_tracker(self):
+        tracker = OffsetTracker()
+        for offset in range(3):
+            tracker.add('topic', 0, offset)
+        tracker.done('topic', 0, 1)
+        self.assertEqual(tracker.pop_committable(), {})
+        tracker.done('topic', 0, 0)
+        self.assertEqual(tracker.pop_committable(), {('topic', 0): 2})
+        self.assertEqual(tracker.num_pending(), 1)
+
+    def test_consumer_decodes_with_cached_schema(self):
+        schema = {
+            'type': 'record', 'name': 'alert', 'namespace': 'ztf', 'fields': [
+                {'name': 'objectId', 'type': 'string'},
+                {'name': 'candidate', 'type': {'type': 'record', 'name': 'candidate', 'fields': [
+                    {'name': 'jd', 'type': 'double'}, {'name': 'magpsf', 'type': ['null', 'double']},
+                ]}},
+                {'name': 'prv_candidates', 'type': ['null', {'type': 'array', 'items': 'ztf.candidate'}]},
+                {'name': 'cutoutScience', 'type': ['null', 'bytes']},
+            ]
+        }
+        alert = {'objectId': 'ZTF0', 'candidate': {'jd': 2461051.5, 'magpsf': 18.0},
+                 'prv_candidates': [{'jd': 2461050.5, 'magpsf': None}], 'cutoutScience': b'stamp'}
+        value = io.BytesIO()
+        fastavro.schemaless_writer(value, fastavro.parse_schema(schema), alert)
+        message = mock.Mock()
+        message.error.return_value = None
+        message.topic.return_value = 'topic'
+        message.key.return_value = json.dumps(schema).encode()
+        message.value.return_value = value.getvalue()
+
+        with mock.patch('confluent_kafka.Consumer'):
+            consumer = FinkConsumer(['topic'], {'username': 'tom', 'bootstrap.servers': 'localhost:9093',
+                                                'group.id': 'tom_group'}, 'ztf')
+            fields_consumer = FinkConsumer(['topic'], {'username': 'tom', 'bootstrap.servers': 'localhost:9093',
+                                                       'group.id': 'tom_group'}, 'ztf',
+                                           fields=['objectId', 'candidate', 'prv_candidates'])
+        with mock.patch('fastavro.parse_schema', wraps=fastavro.parse_schema) as parse_schema:
+            for _ in range(3):
+                self.assertEqual(consumer.process_message(message), ('topic', alert, json.dumps(schema)))
+            self.assertEqual(parse_schema.call_count, 1)
+        topic, decoded, key = fields_consumer.process_message(message)
+        self.assertEqual(sorted(decoded), ['candidate', 'objectId', 'prv_candidates'])
+
+    def test_pipeline_commits_handled_alerts(self):
+        consumer = self.make_consumer(4)
+        with mock.patch('tom_fink.consumer.FinkConsumer', return_value=consumer) as fink_consumer:
+            failed = FinkAlertStream(**self.options).run_consumer()
+        self.assertFalse(failed)
+        self.assertEqual(fink_consumer.call_args.kwargs['kafka_config'], {'enable.auto.commit': False})
+        self.assertEqual(sorted(alert['objectId'] for alert in recorded_alerts), ['ZTF0', 'ZTF1', 'ZTF2', 'ZTF3'])
+        committed = {}
+        for call in consumer.commit_offsets.call_args_list:
+            committed.update(call.args[0])
+        self.assertEqual(committed, {('fink_early_sn_candidates_ztf', 0): 3, ('fink_early_sn_candidates_ztf', 1): 4})
+        consumer.close.assert_called_once()
+
+    def test_pipeline_does_not_commit_failed_alerts(self):
+        self.options['WRITER_THREADS'] = 1
+        consumer = self.make_consumer(4)
+        consumer.process_message.side_effect = lambda message: (
+            self.options['TOPIC'], None if message.offset() == 2 else message.alert, ''
+        )
+        with mock.patch('tom_fink.consumer.FinkConsumer', return_value=consumer):
+            failed = FinkAlertStream(**self.options).run_consumer()
+        self.assertTrue(failed)
+        committed = {}
+        for call in consumer.commit_offsets.call_args_list:
+            committed.update(call.args[0])
+        self.assertEqual(committed.get(('fink_early_sn_candidates_ztf', 0)), 1)
+
+
+class TestFinkStreamMetrics(TestCase):
+    def setUp(self):
+        self.options = {
+            'URL': 'localhost:9093',
+            'USERNAME': 'tom',
+            'GROUP_ID': 'tom_group',
+            'TOPIC': 'fink_early_sn_candidates_ztf',
+            'TOPIC_HANDLERS': {'fink.stream': 'tom_fink.tests.tests.record_alert'},
+            'MAX_POLL_NUMBER': 3,
+            'TIMEOUT': 1,
+        }
+        recorded_alerts.clear()
+
+    def test_consumer_lag(self):
+        with mock.patch('confluent_kafka.Consumer'):
+            consumer = FinkConsumer(['topic'], {'username': 'tom', 'bootstrap.servers': 'localhost:9093',
+                                                'group.id': 'tom_group'}, 'ztf')
+        partitions = [
+            mock.Mock(topic='topic', partition=0, offset=90), mock.Mock(topic='topic', partition=1, offset=-1001)
+        ]
+        consumer._consumer.assignment.return_value = partitions
+        consumer._consumer.committed.return_value = partitions
+        consumer._consumer.get_watermark_offsets.side_effect = [(0, 100), (20, 50)]
+        self.assertEqual(consumer.lag(), {('topic', 0): 10, ('topic', 1): 30})
+
+    def test_database_time(self):
+        metrics = StreamMetrics()
+        metrics.start_handler()
+        with connection.execute_wrapper(metrics.time_query):
+            Target.objects.count()
+        metrics.record_handler(2, 1.0)
+        stats = metrics.stats()
+        self.assertEqual((stats['alerts'], stats['handler_calls'], stats['handler_seconds_p50']), (2, 1, 1.0))
+        self.assertGreater(stats['db_seconds_p99'], 0)
+
+    def test_stream_metrics(self):
+        consumer = mock.Mock()
+        consumer.poll.side_effect = [
+            ('fink_early_sn_candidates_ztf', make_stream_alert('ZTF1', 2461051.5), ''), (None, None, None)
+        ] * 2
+        consumer.lag.return_value = {('fink_early_sn_candidates_ztf', 0): 7}
+        stream = FinkAlertStream(**self.options)
+        stream.lag_interval = 0
+        with mock.patch('tom_fink.consumer.FinkConsumer', return_value=consumer) as fink_consumer:
+            stream.run_consumer()
+        self.assertIs(fink_consumer.call_args.kwargs['metrics'], stream.metrics)
+        metrics = stream.stats()['metrics']
+        self.assertEqual((metrics['polls'], metrics['empty_polls'], metrics['alerts']), (3, 1, 2))
+        self.assertEqual(metrics['lag'], {'fink_early_sn_candidates_ztf': {'0': 7}})
+        self.assertEqual(metrics['total_lag'], 7)
+        text = stream.prometheus()
+        self.assertIn('tom_fink_stream_polls_total 3', text)
+        self.assertIn('tom_fink_stream_consumer_lag{topic="fink_early_sn_candidates_ztf",partition="0"} 7', text)
+
+    def test_metrics_server(self):
+        server = MetricsServer(lambda: {'alerts': 1}, lambda: 'tom_fink_stream_alerts_total 1\n', 0).start()
+        try:
+            url = f'http://127.0.0.1:{server.port}'
+            with urllib.request.urlopen(f'{url}/metrics') as response:
+                self.assertEqual(response.read(), b'tom_fink_stream_alerts_total 1\n')
+            with urllib.request.urlopen(f'{url}/stats') as response:
+                self.assertEqual(json.load(response), {'alerts': 1})
+        finally:
+            server.close()
+
+
+class TestFinkKnownObjects(TestCase):
+    def setUp(self):
+        known_objects.clear()
+
+    def test_lru_eviction(self):
+        names = KnownObjects(max_size=2)
+        names.add(['ZTF0', 'ZTF1'])
+        self.assertTrue(names.check('ZTF0'))  # ZTF1 is now the least recently used
+        names.add(['ZTF2'])
+        self.assertEqual([names.check(name) for name in ['ZTF0', 'ZTF1', 'ZTF2']], [True, False, True])
+        self.assertEqual(names.stats(), {'size': 2, 'hits': 3, 'misses': 1, 'skip_rate': 0.75})
+
+    def test_preload_names_and_aliases(self):
+        target = Target.objects.create(name='AT2020abc', type='SIDEREAL', ra=1.0, dec=2.0)
+        target.aliases.create(name='ZTF20abqehqf')
+        names = KnownObjects()
+        self.assertEqual(names.preload(), 2)
+        self.assertTrue(names.check('ZTF20abqehqf'))
+
+    def test_stream_preload_is_opt_in(self):
+        Target.objects.create(name='ZTF19acmdpyr', type='SIDEREAL', ra=1.0, dec=2.0)
+        options = {'URL': 'localhost:9093', 'USERNAME': 'tom', 'GROUP_ID': 'tom_group',
+                   'TOPIC': 'fink_early_sn_candidates_ztf', 'TOPIC_HANDLERS': {}, 'MAX_POLL_NUMBER': 1, 'TIMEOUT': 1}
+        FinkAlertStream(**options)
+        self.assertEqual(len(known_objects), 0)
+        FinkAlertStream(**options, PRELOAD_KNOWN_OBJECTS=True)
+        self.assertEqual(len(known_objects), 1)
+
+    def test_alert_logger_skips_known_objects(self):
+        alert = make_stream_alert('ZTF19acmdpyr', 2461051.5)
+        self.assertIsNotNone(alert_logger(alert, 'topic'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(alert_logger(alert, 'topic'))
+        self.assertEqual(known_objects.stats()['hits'], 1)
+
+    def test_alert_batch_logger_skips_known_objects(self):
+        alert_batch_logger([make_stream_alert('ZTF19acmdpyr', 2461051.5)], 'topic')
+        with self.assertNumQueries(0):
+            self.assertEqual(alert_batch_logger([make_stream_alert('ZTF19acmdpyr', 2461052.5)], 'topic'), [])
+
+
+class TestFinkAlertFilter(TestCase):
+    def setUp(self):
+        self.alerts = [make_stream_alert(f'ZTF{i}', 2461051.5) for i in range(4)]
+        for alert, magpsf, drb, cdsxmatch in zip(
+                self.alerts, [18.0, 20.0, 18.5, None], [0.9, 0.9, 0.1, 0.9], ['Unknown', 'Unknown', 'Star', None]):
+            alert['candidate'].update({'magpsf': magpsf, 'drb': drb})
+            alert['cdsxmatch'] = cdsxmatch
+        recorded_alerts.clear()
+
+    def test_cuts(self):
+        alert_filter = AlertFilter({'magpsf': {'max': 19.5}, 'drb': {'min': 0.5}})
+        # alerts without a value fail the cuts
+        self.assertEqual([alert['objectId'] for alert in alert_filter.apply(self.alerts)], ['ZTF0'])
+        alert_filter = AlertFilter({'cdsxmatch': {'not_in': ['Star']}})
+        self.assertEqual([alert['objectId'] for alert in alert_filter.apply(self.alerts)], ['ZTF0', 'ZTF1'])
+
+    def test_apply_and_stats(self):
+        alert_filter = AlertFilter({'cdsxmatch': {'in': ['Unknown']}})
+        self.assertEqual([alert['objectId'] for alert in alert_filter.apply(self.alerts)], ['ZTF0', 'ZTF1'])
+        self.assertEqual(alert_filter.stats(), {'seen': 4, 'passed': 2, 'rejection_rate': 0.5})
+
+    def test_invalid_cut(self):
+        with self.assertRaises(ImproperlyConfigured):
+            AlertFilter({'magpsf': {'below': 19.5}})
+
+    def test_stream_filters_alerts(self):
+        stream = FinkAlertStream(
+            URL='localhost:9093',
+            USERNAME='tom',
+            GROUP_ID='tom_group',
+            TOPIC='fink_early_sn_candidates_ztf',
+            TOPIC_HANDLERS={'fink.stream': 'tom_fink.tests.tests.record_alert'},
+            MAX_POLL_NUMBER=5,
+            TIMEOUT=1,
+            FILTERS={'magpsf': {'max': 19.5}},
+        )
+        topic = stream.topics[0]
+        for alert in self.alerts:
+            self.assertTrue(stream.dispatch_alerts(alert, topic))
+        self.assertEqual(recorded_alerts, [{'objectId': 'ZTF0'}, {'objectId': 'ZTF2'}])
+        self.assertEqual(stream.stats()['filters']['passed'], 2)
+
+
+class TestFinkAlertPhotometry(TestCase):
+    def setUp(self):
+        known_objects.clear()
+        self.alert = make_stream_alert('ZTF19acmdpyr', 2461051.5)
+        self.alert['candidate']['candid'] = 3
+        self.alert['prv_candidates'] = [
+            {'jd': 2461049.5, 'magpsf': 18.5, 'fid': 2, 'candid': 1},
+            {'jd': 2461050.5, 'magpsf': None, 'fid': 1, 'candid': None},  # upper limit
+        ]
+
+    def test_alert_photometry(self):
+        rows = alert_photometry(self.alert)
+        self.assertEqual([row['i:candid'] for row in rows], [3, 1])
+        self.assertEqual(rows[1], {'i:objectId': 'ZTF19acmdpyr', 'i:jd': 2461049.5, 'i:magpsf': 18.5,
+                                   'i:fid': 2, 'i:candid': 1})
+
+        # only the columns of the REST API, and the Fink scores of the candidate
+        self.alert['candidate']['programid'] = 1
+        self.alert['cdsxmatch'] = 'Unknown'
+        rows = alert_photometry(self.alert)
+        self.assertNotIn('i:programid', rows[0])
+        self.assertEqual(rows[0]['d:cdsxmatch'], 'Unknown')
+        self.assertNotIn('d:cdsxmatch', rows[1])
+
+    def test_ingest_alert_photometry(self):
+        # alerts of objects that are not targets are skipped
+        self.assertEqual(ingest_alert_photometry([self.alert]), {})
+        target = alert_logger(self.alert, 'topic')
+        ingest_alert_photometry([self.alert])
+        datums = PhotometryReducedDatum.objects.filter(target=target).order_by('timestamp')
+        self.assertEqual([(datum.bandpass, datum.brightness) for datum in datums], [('R', 18.5), ('g', 18.0)])
+
+        # the next alert carries the previous detections in its history
+        alert = make_stream_alert('ZTF19acmdpyr', 2461052.5)
+        alert['candidate']['candid'] = 4
+        alert['prv_candidates'] = [self.alert['candidate'], *self.alert['prv_candidates']]
+        ingest_alert_photometry([alert])
+        self.assertEqual(PhotometryReducedDatum.objects.filter(target=target).count(), 3)
+
+    def test_stream_ingests_photometry(self):
+        stream = FinkAlertStream(
+            URL='localhost:9093',
+            USERNAME='tom',
+            GROUP_ID='tom_group',
+            TOPIC='fink_early_sn_candidates_ztf',
+            TOPIC_HANDLERS={'fink.stream': 'tom_fink.alertstream.alert_logger'},
+            MAX_POLL_NUMBER=5,
+            TIMEOUT=1,
+            INGEST_PHOTOMETRY=True,
+        )
+        stream.handle_alerts(self.alert, stream.topics[0])
+        # the alert of a known object is not saved as a target, but its photometry is
+        stream.handle_alerts(self.alert, stream.topics[0])
+        self.assertEqual(PhotometryReducedDatum.objects.filter(target__name='ZTF19acmdpyr').count(), 2)
+
+
+class TestFinkReplay(TestCase):
+    def setUp(self):
+        known_objects.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.alerts = [make_stream_alert(f'ZTF{i}', 2461051.5 + i) for i in range(5)]
+        schema = fastavro.parse_schema({
+            'type': 'record', 'name': 'alert', 'fields': [
+                {'name': 'objectId', 'type': 'string'},
+                {'name': 'candidate', 'type': {'type': 'record', 'name': 'candidate', 'fields': [
+                    {'name': name, 'type': 'double'} for name in ['jd', 'ra', 'dec', 'magpsf']
+                ] + [{'name': 'fid', 'type': 'int'}]}},
+            ]
+        })
+        # 2 alerts in a file, 3 in another
+        for name, alerts in [('a.avro', self.alerts[:2]), ('b.avro', self.alerts[2:])]:
+            with open(os.path.join(self.directory.name, name), 'wb') as avro_file:
+                fastavro.writer(avro_file, schema, alerts)
+        self.options = {
+            'URL': 'localhost:9093',
+            'USERNAME': 'tom',
+            'GROUP_ID': 'tom_group',
+            'TOPIC': 'fink_early_sn_candidates_ztf',
+            'TOPIC_HANDLERS': {'fink.stream': 'tom_fink.tests.tests.record_alert'},
+            'MAX_POLL_NUMBER': 5,
+            'TIMEOUT': 1,
+        }
+        recorded_alerts.clear()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_iter_alert_batches(self):
+        batches = list(iter_alert_batches([self.directory.name], batch_size=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual([alert for batch in batches for alert in batch], self.alerts)
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_iter_alert_batches_parquet(self):
+        path = os.path.join(self.directory.name, 'alerts.parquet')
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(self.alerts), path)
+        batches = list(iter_alert_batches([path], batch_size=3))
+        self.assertEqual([alert for batch in batches for alert in batch], self.alerts)
+
+    def test_pacer(self):
+        pacer = Pacer(rate=100)
+        start = time.monotonic()
+        for _ in range(4):
+            pacer.wait(2)
+        # the 4th call waits for the 6 alerts before it
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+    def test_replay(self):
+        stats = FinkAlertStream(**self.options).replay([self.directory.name])
+        self.assertEqual([alert['objectId'] for alert in recorded_alerts], [f'ZTF{i}' for i in range(5)])
+        self.assertEqual(stats['alerts'], 5)
+        self.assertEqual(sorted(stats['latency_ms']), ['max', 'p50', 'p95', 'p99'])
+
+    def test_replay_command(self):
+        self.options['TOPIC_HANDLERS'] = {'fink.stream': 'tom_fink.alertstream.alert_batch_logger'}
+        alert_streams = [{'NAME': 'tom_fink.alertstream.FinkAlertStream', 'OPTIONS': self.options}]
+        with override_settings(ALERT_STREAMS=alert_streams):
+            result = call_command('replayfinkalerts', self.directory.name, batch_size=3)
+        self.assertTrue(result.startswith('Replayed 5 alerts'))
+        self.assertEqual(TargetList.objects.get(name='fink_early_sn_candidates_ztf').targets.count(), 5)
+
+
+class TestFinkSpillLog(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.spill = SpillLog(self.directory.name, segment_size=200)
+        self.options = {
+            'URL': 'localhost:9093',
+            'USERNAME': 'tom',
+            'GROUP_ID': 'tom_group',
+            'TOPIC': 'fink_early_sn_candidates_ztf',
+            'TOPIC_HANDLERS': {'fink.stream': 'tom_fink.tests.tests.record_alert'},
+            'MAX_POLL_NUMBER': 5,
+            'TIMEOUT': 1,
+            'SPILL_DIR': self.directory.name,
+        }
+        recorded_alerts.clear()
+
+    def tearDown(self):
+        self.spill.close()
+        self.directory.cleanup()
+
+    def test_drain_in_order(self):
+        alerts = [make_stream_alert(f'ZTF{i}', 2461051.5) for i in range(10)]
+        for alert in alerts:
+            self.spill.append('topic', [alert])
+        self.assertTrue(self.spill.has_pending())
+        self.assertGreater(len(os.listdir(self.directory.name)), 1)  # several segments
+        batches = []
+        self.assertEqual(self.spill.drain(batches.append, batch_size=3), 10)
+        self.assertEqual([alert for batch in batches for _, alert in batch], alerts)
+        self.assertFalse(self.spill.has_pending())
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_drain_in_directory_with_hyphen(self):
+        directory = os.path.join(self.directory.name, 'spill-dir')
+        spill = SpillLog(directory)
+        spill.append('topic', [make_stream_alert('ZTF0', 2461051.5)])
+        claimed = []
+        self.assertEqual(spill.drain(lambda batch: claimed.extend(os.listdir(directory))), 1)
+        self.assertEqual(claimed, [name for name in claimed if name.endswith(f'-{os.getpid()}.draining')])
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(os.listdir(self.directory.name), ['spill-dir'])
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_drain_failure_keeps_segment(self):
+        self.spill.append('topic', [make_stream_alert('ZTF0', 2461051.5)])
+        with self.assertRaises(OperationalError):
+            self.spill.drain(mock.Mock(side_effect=OperationalError('database is down')))
+        self.assertTrue(self.spill.has_pending())
+        self.assertEqual(self.spill.drain(mock.Mock()), 1)
+
+    def test_torn_record_is_ignored(self):
+        self.spill.append('topic', [make_stream_alert('ZTF0', 2461051.5), make_stream_alert('ZTF1', 2461051.5)])
+        self.spill.seal()
+        segment = os.path.join(self.directory.name, os.listdir(self.directory.name)[0])
+        os.truncate(segment, os.path.getsize(segment) - 5)
+        batches = []
+        self.assertEqual(self.spill.drain(batches.append), 1)
+
+    def test_stream_spills_while_database_is_down(self):
+        self.options['TOPIC_HANDLERS'] = {'fink.stream': 'tom_fink.tests.tests.record_alert_or_fail'}
+        stream = FinkAlertStream(**self.options)
+        topic = stream.topics[0]
+        record_alert_or_fail.database_down = True
+        self.assertFalse(stream.dispatch_alerts(make_stream_alert('ZTF0', 2461051.5), topic))
+        record_alert_or_fail.database_down = False
+        # the log is not empty: new alerts are spilled behind the previous ones
+        self.assertFalse(stream.dispatch_alerts(make_stream_alert('ZTF1', 2461051.5), topic))
+        self.assertEqual(stream.drain_spill(), 2)
+        self.assertEqual([alert['objectId'] for alert in recorded_alerts], ['ZTF0', 'ZTF1'])
+        self.assertTrue(stream.dispatch_alerts(make_stream_alert('ZTF2', 2461051.5), topic))
+        stream.spill.close()
+
+    def test_stream_stops_spilling_under_steady_traffic(self):
+        self.options['TOPIC_HANDLERS'] = {'fink.stream': 'tom_fink.tests.tests.record_alert_or_fail'}
+        stream = FinkAlertStream(**self.options)
+        topic = stream.topics[0]
+        record_alert_or_fail.database_down = True
+        self.assertFalse(stream.dispatch_alerts(make_stream_alert('ZTF0', 2461051.5), topic))
+        record_alert_or_fail.database_down = False
+        self.assertFalse(stream.dispatch_alerts(make_stream_alert('ZTF1', 2461051.5), topic))
+        drain = stream.spill.drain
+
+        def drain_while_alerts_arrive(handle):
+            num_alerts = drain(handle)
+            # spilled in a new segment, after the drainer sealed the previous one
+            self.assertFalse(stream.dispatch_alerts(make_stream_alert('ZTF2', 2461051.5), topic))
+            return num_alerts
+
+        with mock.patch.object(stream.spill, 'drain', side_effect=drain_while_alerts_arrive):
+            self.assertEqual(stream.drain_spill(), 2)
+        with mock.patch.object(stream.spill, 'has_pending') as has_pending:
+            # the next alert replays ZTF2 first, then alerts are handled directly
+            self.assertTrue(stream.dispatch_alerts(make_stream_alert('ZTF3', 2461051.5), topic))
+            self.assertTrue(stream.dispatch_alerts(make_stream_alert('ZTF4', 2461051.5), topic))
+        has_pending.assert_not_called()
+        self.assertFalse(stream.spilling)
+        self.assertEqual([alert['objectId'] for alert in recorded_alerts], ['ZTF0', 'ZTF1', 'ZTF2', 'ZTF3', 'ZTF4'])
+        stream.spill.close()
+
+
+def load_rows(rows):
+    """Return the rows of query_targets with the alerts of each object instead of their reference"""
+    service = FinkDataService()
+    return [
+        {**row, 'reduced_datums': {'photometry': service.load_query_result(row['reduced_datums']['photometry'])}}
+        for row in rows
+    ]
+
+
+def record_alert_or_fail(alert, topic):
+    """Topic handler that raises OperationalError while `database_down` is set"""
+    if record_alert_or_fail.database_down:
+        raise OperationalError('database is down')
+    return record_alert(alert, topic)
+
+
+def ignore_alert(alert, topic):
+    """Topic handler that drops the alerts"""
+    return None
+
+
+recorded_alerts = []
+
+
+def record_alert(alert, topic):
+    """Topic handler that keeps the alerts in `recorded_alerts`"""
+    recorded_alerts.append({'objectId': alert['objectId']})
@@ -0,0 +1,44 @@
+# Copyright (c) 2025 Julien Peloton
+#
+# This file is part of TOM Toolkit
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""Prometheus endpoint of the timing spans of FinkDataService, in the web process"""
+import hmac
+
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+
+from tom_fink.fink import FinkDataService
+
+
+def metrics(request):
+    """Return the timing spans of tom_fink in the Prometheus text format (see `tom_fink.instrumentation`)
+
+    The spans are recorded by the web process that serves the view (each
+    worker process of a WSGI server keeps its own). Scrapers authenticate with
+    `Authorization: Bearer <token>` if DATA_SERVICES['Fink']['metrics_token']
+    is set; otherwise only logged-in staff users can read the metrics.
+    Returns 404 if the instrumentation is disabled.
+    """
+    instrumentation = FinkDataService.get_instrumentation()
+    if not instrumentation.enabled:
+        raise Http404("The Fink instrumentation is disabled")
+    token = FinkDataService.get_configuration('metrics_token')
+    if token:
+        authorization = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+            return HttpResponseForbidden()
+    elif not request.user.is_staff:
+        return HttpResponseForbidden()
+    return HttpResponse(instrumentation.prometheus(), content_type='text/plain; version=0.0.4')